@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2019, salesforce.com, inc.
+# All rights reserved.
+# SPDX-License-Identifier: BSD-3-Clause
+# For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+
+"""Uploads attachments to a page on a local stand-in for a Confluence server
+and reports how many connections it took. The server speaks HTTP/1.1 with
+keep-alive, so a client that reuses its connections opens one per thread,
+however many files it sends.
+
+    python benchmarks/attachment_uploads.py [-n count] [-s size]"""
+
+import os, os.path, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import http.server, json, re, tempfile, threading, time
+
+class ConfluenceStub(http.server.BaseHTTPRequestHandler):
+    """ConfluenceStub: answers just the requests that Confluence.upload_attachment
+makes for new attachments, counting the connections it's asked to handle."""
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    connections = 0
+    attachments = 0
+    lock = threading.Lock()
+
+    def setup(self):
+        with self.lock:
+            ConfluenceStub.connections += 1
+        http.server.BaseHTTPRequestHandler.setup(self)
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, data, content_type = 'application/json'):
+        if not isinstance(data, bytes):
+            data = json.dumps(data).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_body(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def do_GET(self):
+        if self.path.startswith('/rest/applinks/1.0/manifest'):
+            self._send(b'<manifest><version>7.0</version></manifest>', 'application/xml')
+        else: # the page's (empty) list of attachments
+            self._send({'results': [], 'size': 0})
+
+    def do_POST(self):
+        self._read_body()
+        if self.path.endswith('/child/attachment'):
+            with self.lock:
+                ConfluenceStub.attachments += 1
+                attach_id = str(10000 + ConfluenceStub.attachments)
+            self._send({'results': [{'id': attach_id, 'type': 'attachment',
+                                     'title': 'file%s'%attach_id,
+                                     'version': {'number': 1}}]})
+        else: # the attachment's sha256 property
+            key = re.sub('.*/property/', '', self.path)
+            self._send({'key': key, 'value': '', 'version': {'number': 1}})
+
+def main():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description = 'Measures connection reuse when uploading attachments.')
+    parser.add_argument('-n', '--count', type = int, default = 30,
+                        help = 'the number of files to upload (default: 30)')
+    parser.add_argument('-s', '--size', type = int, default = 2000,
+                        help = 'the size of each file in bytes (default: 2000)')
+    args = parser.parse_args()
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), ConfluenceStub)
+    server.daemon_threads = True
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    url = 'http://127.0.0.1:%i'%server.server_port
+
+    # Don't look for (or prompt for) a password for the local server.
+    import keyring
+    keyring.get_password = lambda service, user: 'password'
+    from metro.Confluence import Confluence
+    conf = Confluence(url, 'metro')
+
+    folder = tempfile.mkdtemp()
+    files = []
+    for i in range(args.count):
+        filename = os.path.join(folder, 'image%i.png'%i)
+        with open(filename, 'wb') as f:
+            f.write(os.urandom(args.size))
+        files.append(filename)
+
+    import logging
+    logging.disable(logging.INFO)
+    connections = ConfluenceStub.connections
+    start = time.perf_counter()
+    for filename in files:
+        if not conf.upload_attachment(1, os.path.basename(filename), filename):
+            print('Could not upload %s.'%filename)
+            exit(-1)
+    elapsed = time.perf_counter() - start
+
+    print('Uploaded %i file(s) of %i bytes in %.3fs (%.2f ms each).'%(args.count, args.size, elapsed, 1000*elapsed/args.count))
+    print('Connections accepted by the server: %i'%(ConfluenceStub.connections - connections))
+    print('Connections opened by the client:   %i (including the version check)'%conf.connections_opened())
+    for filename in files:
+        os.remove(filename)
+    os.rmdir(folder)
+
+if __name__ == '__main__':
+    main()
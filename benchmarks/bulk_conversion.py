@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2019, salesforce.com, inc.
+# All rights reserved.
+# SPDX-License-Identifier: BSD-3-Clause
+# For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+
+"""Compares the throughput of markdown_to_xhtml, called once per page, with
+that of markdown_to_xhtml_many, in this process and in pools of worker
+processes, on the benchmark corpus, and checks that they agree.
+
+    python benchmarks/bulk_conversion.py [-n count] [-j jobs] [-c chunk_size]"""
+
+import os, os.path, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import time, warnings
+from corpus import documents
+
+def main():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description = 'Times markdown_to_xhtml_many on the benchmark corpus.')
+    parser.add_argument('-n', '--count', type = int, default = 300,
+                        help = 'the number of generated pages in the corpus (default: 300)')
+    parser.add_argument('-j', '--jobs', type = int, default = os.cpu_count() or 1,
+                        help = 'the number of worker processes (default: the number of CPUs)')
+    parser.add_argument('-c', '--chunk-size', type = int, default = 8,
+                        help = 'the number of pages sent to a worker at a time (default: 8)')
+    args = parser.parse_args()
+    warnings.simplefilter('ignore')
+    import logging
+    logging.disable(logging.INFO)
+
+    from metro.markdown_to_xhtml import markdown_to_xhtml, markdown_to_xhtml_many
+    docs = documents(args.count)
+    items = [(title, md_content, {'table_of_contents': toc, 'auto_gen': auto_gen})
+             for (title, md_content, toc, auto_gen) in docs]
+    print('%i documents on %i CPU(s)'%(len(docs), os.cpu_count() or 1))
+
+    # Build this thread's converter before timing anything.
+    markdown_to_xhtml(*docs[0])
+    start = time.perf_counter()
+    expected = [markdown_to_xhtml(*doc) for doc in docs]
+    elapsed = time.perf_counter() - start
+    print('%-50s %7.1f pages/s'%('markdown_to_xhtml, once per page', len(docs)/elapsed))
+
+    # There are only worker pools to time if more than one job is asked for.
+    runs = [('markdown_to_xhtml_many, jobs = 1', {})]
+    if args.jobs > 1:
+        runs.append(('markdown_to_xhtml_many, jobs = %i'%args.jobs, {'jobs': args.jobs}))
+        runs.append(('markdown_to_xhtml_many, jobs = %i, chunk_size = %i'%(args.jobs, args.chunk_size),
+                     {'jobs': args.jobs, 'chunk_size': args.chunk_size}))
+    for (name, kwargs) in runs:
+        start = time.perf_counter()
+        output = list(markdown_to_xhtml_many(iter(items), **kwargs))
+        elapsed = time.perf_counter() - start
+        print('%-50s %7.1f pages/s%s'%(name, len(docs)/elapsed, '' if output == expected else ' (output differs!)'))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2019, salesforce.com, inc.
+# All rights reserved.
+# SPDX-License-Identifier: BSD-3-Clause
+# For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+
+"""Times markdown_to_xhtml on the benchmark corpus: what it costs to convert
+an almost empty page (the fixed cost of a conversion) and a small page of
+100 to 600 bytes. If a git revision is given with --baseline, the
+markdown_to_xhtml of that revision is timed too, and the two are checked
+for identical output on the whole corpus.
+
+    python benchmarks/converter.py [-r repeats] [--baseline revision]"""
+
+import os, os.path, sys
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+import time, warnings
+from corpus import documents
+
+def load_revision(revision):
+    """load_revision(revision) -> the metro.markdown_to_xhtml module as it was
+at the given git revision."""
+    import subprocess, types
+    source = subprocess.check_output(['git', 'show', '%s:metro/markdown_to_xhtml.py'%revision],
+                                     cwd = root).decode('utf-8')
+    module = types.ModuleType('markdown_to_xhtml_%s'%revision)
+    module.__file__ = 'markdown_to_xhtml.py@%s'%revision
+    exec(compile(source, module.__file__, 'exec'), module.__dict__)
+    return module
+
+def ms_per_document(convert, docs, repeats):
+    """ms_per_document(convert, docs, repeats) -> the mean time in ms it takes 
+to convert one of the given documents, over the given number of passes."""
+    convert(*docs[0])
+    start = time.perf_counter()
+    for i in range(repeats):
+        for doc in docs:
+            convert(*doc)
+    return 1000*(time.perf_counter() - start)/(repeats*len(docs))
+
+def main():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description = 'Times markdown_to_xhtml on the benchmark corpus.')
+    parser.add_argument('-r', '--repeats', type = int, default = 5,
+                        help = 'the number of passes over the documents (default: 5)')
+    parser.add_argument('--baseline', metavar = 'revision', type = str,
+                        help = 'a git revision whose converter to compare against')
+    args = parser.parse_args()
+    warnings.simplefilter('ignore')
+
+    import metro.markdown_to_xhtml
+    converters = [('current', metro.markdown_to_xhtml.markdown_to_xhtml)]
+    if args.baseline is not None:
+        converters.insert(0, (args.baseline, load_revision(args.baseline).markdown_to_xhtml))
+
+    docs = documents()
+    small = [doc for doc in docs if 100 < len(doc[1]) < 600]
+    empty = [('Title', 'x', None, None)]
+    print('%i documents, %i of them small (%i bytes on average)'%(len(docs), len(small), sum(len(doc[1]) for doc in small)//len(small)))
+    for (name, convert) in converters:
+        print('%-10s fixed cost %.3f ms, small page %.3f ms'%(name, ms_per_document(convert, empty, 200*args.repeats),
+                                                             ms_per_document(convert, small, args.repeats)))
+
+    if args.baseline is not None:
+        # A document that makes both converters raise the same kind of 
+        # error counts as converted identically.
+        same = 0
+        for doc in docs:
+            outputs = []
+            for (name, convert) in converters:
+                try:
+                    outputs.append(convert(*doc))
+                except Exception as e:
+                    outputs.append(type(e))
+            same += outputs[0] == outputs[-1]
+        print('%i of %i documents convert identically.'%(same, len(docs)))
+
+if __name__ == '__main__':
+    main()
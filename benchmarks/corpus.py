@@ -0,0 +1,82 @@
+# Copyright (c) 2019, salesforce.com, inc.
+# All rights reserved.
+# SPDX-License-Identifier: BSD-3-Clause
+# For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+
+"""The Markdown documents the conversion benchmarks run on: pages put
+together at random (but the same every time) from fragments that exercise
+Metro's Markdown extensions, each fragment on its own, and the Markdown
+files in the repository."""
+
+import os.path
+
+# Fragments of Markdown, covering macros, code, images, tables, footnotes,
+# raw HTML and things bleach has to remove.
+FRAGMENTS = [
+    "# Title\n\nIntro paragraph with *em* and **strong** and `code`.\n",
+    "## Section\n\nText with a [link](http://example.com \"t\") and <a id=\"anchor\"></a> anchor.\n",
+    "> Info: This is *important* info.\n",
+    "> Note: A note here.\n",
+    "> Warning: Danger zone.\n",
+    "> Info : spaced info\n",
+    "> **Note:** bold note\n",
+    "> *Warning*: em warning\n",
+    "> Panel: My Panel\n> line one of panel\n> line two of panel\n",
+    "> Expand: Click me\n> hidden text\n> more hidden\n",
+    "> ExpandAll\n",
+    "> LiveSearch\n",
+    "> Just a plain quote\n> with two lines\n",
+    "~?inline info?~\n",
+    "~!inline note!~\n",
+    "~%inline warn%~\n",
+    "```python\ndef f(x):\n    return x < 3 and x > 1 & \"q\"\n```\n",
+    "```\nplain fenced <b>code</b>\n```\n",
+    "    indented code\n    more & more\n",
+    "![alt text](images/pic.png)\n",
+    "<img src=\"path/to/other.jpg\" alt=\"Other\" width=\"100\" height=\"50\">\n",
+    "<img src=\"x.gif\">\n",
+    "| a | b |\n|---|:-:|\n| 1 | 2 |\n| <span style=\"color: red\">3</span> | 4 |\n",
+    "<table><colgroup><col width=\"20\"><col></colgroup><tr><td headers=\"h\">x</td></tr></table>\n",
+    "Some text with a ref[^1] and another[^2].\n",
+    "[^1]: <a href=\"http://ref.one\">Ref one</a>\n",
+    "[^2]: <a href=\"http://ref.two\">Ref two</a>\n",
+    "<script>alert('xss')</script>\n",
+    "<p onclick=\"evil()\" style=\"color: blue; background: url(javascript:x)\">styled</p>\n",
+    "<a href=\"javascript:alert(1)\">bad</a>\n",
+    "<iframe src=\"http://evil\"></iframe>\n",
+    "- item 1\n- item 2\n    - nested *a*\n1. one\n2. two\n",
+    "Entities &amp; &lt;tag&gt; \"quotes\" 'single' café ☃\n",
+    "Line with trailing spaces  \nbreak\n",
+    "***\n",
+    "<div><p>div para</p></div>\n",
+    "<b>bold</b> <i>it</i> <abbr title=\"t\">ab</abbr> <u>under</u>\n",
+    "### Heading with `code` and <em>html</em>\n",
+    "Paragraph\nspanning\nlines.\n",
+    "<!-- comment -->\n",
+    "`inline <tag> & stuff`\n",
+]
+
+def documents(count = 300, seed = 42, repository_files = True):
+    """documents(count = 300, seed = 42, repository_files = True) -> a list of
+(title, md_content, table_of_contents, auto_gen) tuples: count pages made of
+fragments chosen with the given random seed, then every fragment by itself,
+then (if repository_files is true) the repository's README and code of
+conduct."""
+    import random
+    rnd = random.Random(seed)
+    docs = []
+    for i in range(count):
+        md_content = '\n'.join(rnd.choice(FRAGMENTS) for _ in range(rnd.randint(1, 12)))
+        title = rnd.choice(['Title', 'Other', 'Section', 'Nope'])
+        toc = rnd.choice([None, None, {'min_level': 2, 'max_level': 4, 'type': 'flat', 'style': 'none'}, {}, {'min_level': 1}])
+        auto_gen = rnd.choice([None, None, 'http://src/file.md'])
+        docs.append((title, md_content, toc, auto_gen))
+    for fragment in FRAGMENTS:
+        docs.append(('Title', fragment, None, None))
+    if not repository_files:
+        return docs
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    for name in ['README.md', 'CODE_OF_CONDUCT.md']:
+        with open(os.path.join(root, name), encoding = 'utf-8') as f:
+            docs.append(('Metro', f.read(), None, None))
+    return docs
@@ -0,0 +1,146 @@
+# Copyright (c) 2019, salesforce.com, inc.
+# All rights reserved.
+# SPDX-License-Identifier: BSD-3-Clause
+# For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+
+class ArchiveMember(object):
+    """ArchiveMember: a file inside an Archive, which can be used in place of a
+filename for the images and attachments of a Page."""
+
+    def __init__(self, archive, info):
+        self.archive = archive
+        self.info = info
+
+    @property
+    def name(self):
+        """The path of the member within its zip file."""
+        return self.info.filename
+
+    @property
+    def size(self):
+        """The uncompressed size of the member in bytes."""
+        return self.info.file_size
+
+    def open(self):
+        """member.open() -> a binary file object from which the member's
+contents are read (and decompressed) as they're needed."""
+        return self.archive.zipfile.open(self.info)
+
+    def __str__(self):
+        return '%s:%s'%(self.archive.filename, self.name)
+
+    def __repr__(self):
+        return 'ArchiveMember(%r)'%str(self)
+
+# Archives opened in this process by unpickling, by filename and root.
+_opened = {}
+
+def _reopen(filename, root):
+    """Returns an Archive for the given zip file, opening it only once per
+process, for Archives and ArchiveMembers passed to other processes."""
+    if (filename, root) not in _opened:
+        _opened[(filename, root)] = Archive(filename, root)
+    return _opened[(filename, root)]
+
+class Archive(object):
+    """Archive: a read-only view of the files in a zip file, which are read
+straight from the zip file rather than being extracted. Whether files and
+folders exist is answered from the zip file's central directory. Archives
+(and their members) can be passed to other processes, which open the zip
+file themselves."""
+
+    def __init__(self, filename, root = ''):
+        """Archive(filename, root = '') -> new Archive for the zip file with the
+given name. Paths are given relative to the root folder within the zip file."""
+        import posixpath
+        from zipfile import ZipFile
+        self.filename = filename
+        self.root = root
+        self.zipfile = ZipFile(filename)
+        self._members = {}
+        self._folders = set(['.'])
+        for info in self.zipfile.infolist():
+            name = posixpath.normpath(info.filename)
+            if not info.is_dir():
+                self._members[name] = info
+            else:
+                self._folders.add(name)
+            # Not every zip file lists the folders it has.
+            folder = posixpath.dirname(name)
+            while folder and folder not in self._folders:
+                self._folders.add(folder)
+                folder = posixpath.dirname(folder)
+
+    def __reduce__(self):
+        return (_reopen, (self.filename, self.root))
+
+    def close(self):
+        """archive.close() -> Closes the underlying zip file."""
+        self.zipfile.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _path(self, path):
+        import posixpath
+        return posixpath.normpath(posixpath.join(self.root, path.replace('\\', '/')))
+
+    def member(self, path):
+        """archive.member(path) -> the ArchiveMember at the given path relative
+to the archive's root, or None if there's no such file."""
+        info = self._members.get(self._path(path))
+        if info is None:
+            return None
+        return ArchiveMember(self, info)
+
+    def isfile(self, path):
+        """archive.isfile(path) -> True if there's a file at the given path
+relative to the archive's root."""
+        return self._path(path) in self._members
+
+    def isdir(self, path):
+        """archive.isdir(path) -> True if there's a folder at the given path
+relative to the archive's root."""
+        return self._path(path) in self._folders
+
+    def find(self, names):
+        """archive.find(names) -> the path relative to the archive's root of
+the file nearest the root with one of the given names, or None if there
+isn't one."""
+        import posixpath
+        prefix = self._path('.')
+        found = []
+        for name in self._members.keys():
+            if posixpath.basename(name) in names and \
+               (prefix == '.' or name.startswith(prefix + '/')):
+                path = name if prefix == '.' else name[len(prefix) + 1:]
+                found.append((path.count('/'), names.index(posixpath.basename(name)), path))
+        if not found:
+            return None
+        return min(found)[2]
+
+def open_file(source, buffering = -1):
+    """open_file(source, buffering = -1) -> a binary file object for the given
+source, which is either a filename or an ArchiveMember."""
+    if isinstance(source, ArchiveMember):
+        return source.open()
+    return open(source, 'rb', buffering = buffering)
+
+def file_size(source):
+    """file_size(source) -> the size in bytes of the given filename or
+ArchiveMember."""
+    if isinstance(source, ArchiveMember):
+        return source.size
+    import os.path
+    return os.path.getsize(source)
+
+def file_basename(source):
+    """file_basename(source) -> the final component of the path of the given
+filename or ArchiveMember."""
+    import posixpath, os.path
+    if isinstance(source, ArchiveMember):
+        return posixpath.basename(source.name)
+    return os.path.basename(source)
@@ -0,0 +1,626 @@
+# Copyright (c) 2019, salesforce.com, inc.
+# All rights reserved.
+# SPDX-License-Identifier: BSD-3-Clause
+# For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+
+import logging
+logger = logging.getLogger()
+
+from metro.Confluence import ConfluenceAPI, ATTACHMENT_HASH_KEY, sha256_file, attachment_hash_property, page_checksum
+from metro.Archive import open_file, file_basename, file_size
+
+def _sized_payload(chunks, size, content_type):
+    """_sized_payload(chunks, size, content_type) -> an aiohttp payload that
+streams the given async iterable of bytes and reports the given size, so that
+it's sent with a Content-Length, as Confluence sends files, and not chunked."""
+    from aiohttp.payload import AsyncIterablePayload
+    class SizedPayload(AsyncIterablePayload):
+        @property
+        def size(self):
+            return size
+    return SizedPayload(chunks, content_type = content_type)
+
+class AsyncConfluence(ConfluenceAPI):
+    """AsyncConfluence: an asyncio proxy object for a Confluence server.
+
+It offers the same operations as Confluence, as coroutines that share one
+pooled HTTP connector, so a single process can keep many requests in flight.
+Both build their requests and keep their caches the same way, in ConfluenceAPI.
+Requires the 'aiohttp' module. Use it as an asynchronous context manager:
+
+    async with AsyncConfluence(url, user) as conf:
+        info = await conf.info(page_id)"""
+
+    def __init__(self, url, username = None, pool_size = 100):
+        """AsyncConfluence(url, username = None, pool_size = 100) -> new asyncio
+proxy for the Confluence server at the given URL, keeping at most pool_size
+connections open to it. Call open() (or use 'async with') before using it."""
+        self._init_api(url, username, pool_size)
+        self.session = None
+
+        # If set, this is called as progress(filename, sent, total) as files
+        # are uploaded.
+        self.progress = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def open(self):
+        """await conf.open() -> Authenticates with the server and opens the
+shared connection pool."""
+        await self._authenticate()
+        logging.info('Connected to %s (v%s)'%(self.base_url, self.version))
+
+    async def close(self):
+        """await conf.close() -> Closes all connections to the server."""
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def _authenticate(self):
+        """Authenticates the user, prompting for a password if need be."""
+
+        # Fetch our username and password.
+        import keyring, getpass
+        if self.user is None:
+            self.user = getpass.getuser()
+        key = 'confluence_{url}'.format(url = self.base_url)
+        self.passwd = keyring.get_password(key, self.user)
+        if self.passwd is None:
+            self.passwd = getpass.getpass(prompt="Password for {user}@{url}: ".format(user = self.user, url = self.base_url))
+            keyring.set_password(key, self.user, self.passwd)
+
+        # We try to authenticate by asking Confluence for its version number.
+        # If this fails, we re-prompt for a password once.
+        logging.info('Authenticating as %s'%self.user)
+        self._open_session()
+        version = await self._get_version()
+        if version == 'unauthorized':
+            self.passwd = getpass.getpass(prompt="Password for {user}@{url}: ".format(user = self.user, url = self.base_url))
+            keyring.set_password(key, self.user, self.passwd)
+            await self.close()
+            self._open_session()
+            version = await self._get_version()
+        if version == 'unauthorized':
+            await self.close()
+            print('Invalid password.')
+            exit(1)
+        self.version = version
+
+    def _open_session(self):
+        """Creates a session whose connector is shared by all requests."""
+        # FIXME: As with Confluence, SSL certificate verification is off.
+        import aiohttp
+        connector = aiohttp.TCPConnector(limit = self.pool_size, ssl = False)
+        self.session = aiohttp.ClientSession(connector = connector,
+                                             auth = aiohttp.BasicAuth(self.user, self.passwd))
+
+    async def _get_version(self):
+        async with self.session.get(self._version_url()) as r:
+            if r.status == 200:
+                return self._parse_version(await r.text())
+            elif r.status == 401: # Unauthorized!
+                logging.info('Could not connect to Confluence server (unauthorized)')
+                return 'unauthorized'
+            else:
+                logging.info('Could not get version for Confluence server: %s (%s)'%(r.reason, await self._details(r)))
+                return '??.??.??'
+
+    async def _details(self, r):
+        """Returns the error message in the given response, if it has one."""
+        try:
+            return (await r.json(content_type = None))['message']
+        except Exception:
+            return 'details not available'
+
+    async def _update_page_checksum(self, page, prop = None):
+        """Stores the checksum of the given page's title and body in its
+'checksum' property. prop is the page's existing checksum property, or None
+if it doesn't have one yet. Returns the checksum, or None on failure."""
+
+        # Create a new checksum for the page.
+        page.checksum = page_checksum(page)
+
+        # Store the page's checksum as a page property, creating the
+        # property if it doesn't exist yet.
+        url = self._property_url(page.id, 'checksum')
+        if prop is not None and 'version' not in prop:
+            # The version wasn't expanded, so look it up. If the property
+            # has gone, we create it again.
+            checksum, checksum_version = await self._get_page_checksum(page.id)
+            prop = None if checksum_version is None else {'version': {'number': checksum_version}}
+        data = self._property_data('checksum', page.checksum, prop)
+        method = self.session.post if prop is None else self.session.put
+        async with method(url, json = data) as r:
+            if r.status != 200:
+                logging.info('Could not store checksum for page "%s": %s (%s)'%(page.title, r.reason, await self._details(r)))
+                return None
+        return page.checksum
+
+    async def _get_page_checksum(self, page_id):
+        async with self.session.get(self._property_url(page_id, 'checksum')) as r:
+            if r.status != 200:
+                if r.status != 404:
+                    logging.info('Could not retrieve checksum for page %i: %s (%s)'%(page_id, r.reason, await self._details(r)))
+                return None, None
+            prop = await r.json()
+        return (prop['value'], prop['version']['number'])
+
+    async def _page_metadata(self, page_id):
+        """Returns the version, ancestors, space and checksum property of the
+page with the given ID, all in one request, or None if they can't be retrieved."""
+        async with self.session.get(self._page_url(page_id, self.METADATA_EXPAND)) as r:
+            if r.status == 200:
+                return await r.json()
+            logging.info('Could not retrieve metadata for page %i: %s (%s)'%(page_id, r.reason, await self._details(r)))
+            return None
+
+    async def info(self, page_id):
+        """await conf.info(page_id) -> a dict containing information for the page
+with the given ID, or None if no such page exists."""
+
+        async with self.session.get(self._page_url(page_id, self.INFO_EXPAND)) as r:
+            if r.status == 200:
+                return await r.json()
+            logging.info('Could not retrieve info for page %i: %s (%s)'%(page_id, r.reason, await self._details(r)))
+            return None
+
+    async def ancestors(self, page_id):
+        """await conf.ancestors(page_id) -> a list of ancestors of the page with
+the given ID."""
+
+        ancestors = self._cached_ancestors(page_id)
+        if ancestors is not None:
+            return ancestors
+
+        async with self.session.get(self._page_url(page_id, 'ancestors')) as r:
+            if r.status != 200:
+                logging.info('Could not retrieve ancestors for page %i: %s (%s)'%(page_id, r.reason, await self._details(r)))
+                return None
+            return (await r.json())['ancestors']
+
+    async def prefetch_space(self, space_key):
+        """await conf.prefetch_space(space_key) -> Loads the titles and ancestors
+of all pages in the space with the given key in a few large requests, as
+Confluence.prefetch_space does. Returns True on success and False otherwise."""
+        results = await self.search('space = "%s" and type = page'%space_key, expand = 'ancestors')
+        if results is None:
+            logging.info('Could not prefetch pages in space %s.'%space_key)
+            return False
+        self._index_space(space_key, results)
+        return True
+
+    async def prefetch(self, page_id):
+        """await conf.prefetch(page_id) -> Prefetches the space containing the
+page with the given ID, unless that's been done already. Returns True on
+success and False otherwise."""
+        if self._known_page(page_id) is not None:
+            return True
+        async with self.session.get(self._page_url(page_id, 'space')) as r:
+            if r.status != 200:
+                logging.info('Could not find the space of page %i: %s'%(page_id, r.reason))
+                return False
+            space_key = (await r.json())['space']['key']
+        return await self.prefetch_space(space_key)
+
+    async def search(self, cql, expand = None):
+        """await conf.search(cql, expand = None) -> a list of the content matching
+the given CQL query, with the given comma-separated properties expanded, or
+None if the search fails."""
+        start = 0
+        results = []
+        while True:
+            url, params = self._search_request(cql, start, expand)
+            async with self.session.get(url, params = params) as r:
+                if r.status != 200:
+                    logging.info('Could not search for "%s": %s (%s)'%(cql, r.reason, await self._details(r)))
+                    return None
+                data = await r.json()
+            results.extend(data['results'])
+            start += len(data['results'])
+            # Confluence may return fewer results than we ask for, so we go
+            # by whether it tells us there's a next batch.
+            if not data['results'] or 'next' not in data.get('_links', {}):
+                break
+        return results
+
+    async def children(self, page_id):
+        """await conf.children(page_id) -> a dict mapping child page titles to
+their IDs, for the page with the given ID, or None if no such ID exists."""
+
+        children = self._cached_children(page_id)
+        if children is not None:
+            return children
+
+        # Confluence limits us to 200 results at a time, so we keep going
+        # back for more until we get a short batch.
+        start = 0
+        results = []
+        while True:
+            async with self.session.get(self._children_url(page_id, start)) as r:
+                if r.status != 200:
+                    if start == 0:
+                        return None
+                    break
+                batch = (await r.json())['page']['results']
+            results.extend(batch)
+            start += len(batch)
+            if len(batch) < self.RESULTS_LIMIT:
+                break
+        return self._cache_children(page_id, results)
+
+    async def create_page(self, parent_id, page):
+        """await conf.create_page(parent_id, page) -> Creates a new page under a
+parent page with the given ID. Returns True if the page is successfully
+created. If a page with the same title exists under that parent page,
+nothing happens (unless the page may be overwritten), and the coroutine
+returns False."""
+
+        # Make sure the page is well-formed.
+        assert(page.title is not None)
+        assert(page.body is not None)
+        pid = self._resolve_parent(parent_id, page)
+
+        # Get information about the parent page, if we don't have it already.
+        known = self._known_page(pid)
+        if known is not None:
+            parent_title, space_key = known
+        else:
+            info = await self.info(pid)
+            if info is None:
+                logging.info('Could not create new page "%s" under nonexistent parent %i.'%(page.title, pid))
+                return False
+            space_key = info['space']['key']
+            parent_title = info['title']
+
+        # See if we already have a page in this set.
+        children = await self.children(pid)
+        if page.title in children:
+            page.id = int(children[page.title])
+            # If we're allowed to overwrite the page, we update it.
+            if page.overwrite:
+                return await self.update_page(page.id, page)
+            else:
+                return False
+
+        # There's no page, so we make a new one.
+        if not await self.post_page(pid, space_key, page, parent_title):
+            return False
+
+        # Now upload images and attachments if need be.
+        await self._upload_files(page, page.overwrite)
+
+        # Stash the ID of the newly created page.
+        self.pages_created[page.title] = page.id
+
+        return True
+
+    async def update_page(self, page_id, page):
+        """await conf.update_page(page_id, page) -> Updates the page with the
+given ID using the content of the given page. Returns True if the update
+succeeds or False if it fails."""
+
+        # Create a checksum for the new page.
+        page.checksum = page_checksum(page)
+
+        # Fetch the page's checksum, version and parent in one request.
+        meta = await self._page_metadata(page_id)
+        if meta is None:
+            return False
+        page.id = page_id
+        page.space_key = meta['space']['key']
+        page.version = int(meta['version']['number'])
+        page.view_url = '%s%s'%(self.view_url, page.id)
+        prop = self._checksum_property(meta)
+        checksum = prop['value'] if prop is not None else None
+
+        # We only update the page itself if its title or checksum has changed.
+        if checksum is None or page.checksum != checksum:
+            # Update the page under its current parent.
+            if not await self.put_page(page, self._parent_of(meta), prop):
+                return False
+        else:
+            logging.info('Did not update content for page "%s" (identical)'%(page.title))
+
+        # Now upload images and attachments if need be.
+        await self._upload_files(page, True)
+
+        return True
+
+    async def post_page(self, parent_id, space_key, page, parent_title = None):
+        """await conf.post_page(parent_id, space_key, page, parent_title = None) ->
+Creates the given page under the parent page with the given ID in the space
+with the given key, without checking whether it exists first, and records
+its checksum. Returns True on success and False otherwise."""
+        if parent_title is None:
+            parent_title = self._parent_title(parent_id)
+        data = self._new_page_data(page, parent_id, space_key)
+        async with self.session.post(self.rest_url, json = data) as r:
+            if r.status != 200:
+                logging.info('Could not create new page "%s" under parent "%s": %s (%s)'%(page.title, parent_title, r.reason, await self._details(r)))
+                return False
+            data = await r.json()
+        self._page_sent(page, data)
+        logging.info('Created new page "%s" (id = %i) under parent "%s"'%(page.title, page.id, parent_title))
+        self._page_posted(page, parent_id, parent_title)
+
+        # A brand-new page has no checksum yet.
+        await self._update_page_checksum(page, None)
+        return True
+
+    async def put_page(self, page, parent_id, checksum_prop = None):
+        """await conf.put_page(page, parent_id, checksum_prop = None) -> Replaces
+the title and body of the existing page with the given page's ID, keeping it
+under the parent with the given ID (None for the top of its space), and
+records its checksum, as Confluence.put_page does. Returns True on success
+and False otherwise."""
+        data = self._page_update_data(page, parent_id)
+        async with self.session.put(self._page_url(page.id), json = data) as r:
+            if r.status != 200:
+                logging.info('Could not update content for page "%s" (id = %i): %s (%s)'%(page.title, page.id, r.reason, await self._details(r)))
+                return False
+            data = await r.json()
+        self._page_sent(page, data)
+        logging.info('Updated content for page "%s" (id = %i)'%(page.title, page.id))
+        self._page_put(page, parent_id)
+
+        # Update the page's checksum.
+        await self._update_page_checksum(page, checksum_prop)
+        return True
+
+    async def delete_page(self, page_id):
+        """await conf.delete_page(page_id) -> Deletes the page with the given ID,
+returning True on success and False otherwise."""
+        async with self.session.delete(self._page_url(page_id)) as r:
+            if r.status == 204:
+                logging.info('Deleted page (id = %i)'%page_id)
+                self._forget_page(page_id)
+                return True
+            logging.info('Could not delete page (id = %i): %s (%s)'%(page_id, r.reason, await self._details(r)))
+            return False
+
+    async def _upload_files(self, page, overwrite):
+        """Uploads the images and attachments of the given page concurrently."""
+        import asyncio
+        uploads = [self.upload_attachment(page.id, file_basename(f), f, overwrite = overwrite)
+                   for f in page.images + page.attachments]
+        await asyncio.gather(*uploads)
+
+    async def _read_chunks(self, f, chunk_size = 1 << 16, progress = None):
+        """Yields the contents of the given open file a chunk at a time. The
+file is read in the loop's default executor, so the event loop never waits
+on the disk (or on decompressing an ArchiveMember). If given, progress is
+called as progress(sent) once each chunk has been sent."""
+        import asyncio
+        loop = asyncio.get_running_loop()
+        sent = 0
+        while True:
+            chunk = await loop.run_in_executor(None, f.read, chunk_size)
+            if not chunk:
+                break
+            yield chunk
+            sent += len(chunk)
+            if progress is not None:
+                progress(sent)
+
+    async def _sha256_file(self, local_filename):
+        """Returns the SHA-256 digest of the given local file, hashed without
+blocking the event loop."""
+        import asyncio
+        return await asyncio.get_running_loop().run_in_executor(None, sha256_file, local_filename)
+
+    async def _post_file(self, url, attachment_filename, local_filename, comment = None, progress = None):
+        """Posts the given local file (a filename or an ArchiveMember) to the
+given attachment URL as multipart form data, returning the response status
+and reason, and either the response body (on success) or the error details.
+The file is streamed a chunk at a time, read off the event loop, with its
+size given up front, as Confluence._post_file does. If given, progress is
+called as progress(filename, sent, total) along the way, counting the bytes
+of the file."""
+        import aiohttp, asyncio, mimetypes, os.path
+        content_type, encoding = mimetypes.guess_type(file_basename(local_filename))
+        if content_type is None:
+            content_type = 'multipart/form-data'
+        name = os.path.basename(attachment_filename)
+        loop = asyncio.get_running_loop()
+        size = await loop.run_in_executor(None, file_size, local_filename)
+        callback = None
+        if progress is not None:
+            callback = lambda sent: progress(name, sent, size)
+        f = await loop.run_in_executor(None, open_file, local_filename)
+        try:
+            form = aiohttp.FormData()
+            form.add_field('file', _sized_payload(self._read_chunks(f, progress = callback),
+                                                  size, content_type),
+                           filename = name, content_type = content_type)
+            if comment is not None:
+                form.add_field('comment', str(comment))
+            async with self.session.post(url, data = form,
+                                         headers = {'X-Atlassian-Token': 'no-check'}) as r:
+                if r.status == 200:
+                    return r.status, r.reason, await r.json()
+                return r.status, r.reason, await self._details(r)
+        finally:
+            await loop.run_in_executor(None, f.close)
+
+    async def _store_attachment_hash(self, attach_id, digest, prop = None):
+        """Records the given SHA-256 digest in the 'sha256' property of the
+attachment with the given ID. prop is the attachment's existing property,
+if it has one. Returns the property as stored, or None on failure."""
+        url = self._property_url(attach_id, ATTACHMENT_HASH_KEY)
+        if prop is not None and 'version' not in prop:
+            # The version isn't always expanded along with the property.
+            async with self.session.get(url) as r:
+                if r.status != 200:
+                    logging.info('Could not retrieve hash for attachment %s: %s'%(attach_id, r.reason))
+                    return None
+                prop = await r.json()
+        data = self._property_data(ATTACHMENT_HASH_KEY, digest, prop)
+        method = self.session.post if prop is None else self.session.put
+        async with method(url, json = data) as r:
+            if r.status != 200:
+                logging.info('Could not store hash for attachment %s: %s'%(attach_id, r.reason))
+                return None
+            return await r.json()
+
+    async def attachments(self, page_id):
+        """await conf.attachments(page_id) -> a dict mapping the filenames of the
+attachments on the page with the given ID to information about them, or None
+if they can't be retrieved. As with Confluence.attachments, the attachments
+are listed once per page and kept up to date as attachments are uploaded."""
+        index = self._cached_attachments(page_id)
+        if index is not None:
+            return index
+
+        # As with children, we page through the attachments till we get a
+        # short batch.
+        start = 0
+        results = []
+        while True:
+            async with self.session.get(self._attachment_list_url(page_id, start)) as r:
+                if r.status != 200:
+                    logging.info('Could not list attachments on page %i: %s (%s)'%(page_id, r.reason, await self._details(r)))
+                    return None
+                batch = (await r.json())['results']
+            results.extend(batch)
+            start += len(batch)
+            if len(batch) < self.RESULTS_LIMIT:
+                break
+        return self._cache_attachments(page_id, results)
+
+    async def _same_content(self, download_url, local_filename):
+        """Returns True if the attachment at the given URL has the same content
+as the given local file, False if not, and None if it can't be downloaded.
+As in _post_file, the local file is read off the event loop."""
+        import asyncio
+        loop = asyncio.get_running_loop()
+        async with self.session.get(download_url) as r:
+            if r.status != 200:
+                return None
+            f = await loop.run_in_executor(None, open_file, local_filename)
+            try:
+                async for old_bytes in r.content.iter_chunked(1 << 16):
+                    new_bytes = await loop.run_in_executor(None, f.read, len(old_bytes))
+                    if new_bytes != old_bytes:
+                        return False
+                return await loop.run_in_executor(None, f.read, 1) == b''
+            finally:
+                await loop.run_in_executor(None, f.close)
+
+    async def post_attachment(self, page_id, attachment_filename, local_filename,
+                              attach_id = None, digest = None, prop = None,
+                              comment = None, progress = None):
+        """await conf.post_attachment(page_id, attachment_filename, local_filename, attach_id = None, digest = None, prop = None, comment = None, progress = None)
+Uploads the given local file to the page with the given ID, as a new
+attachment or, if attach_id is given, as a new version of that attachment,
+without comparing it to what's there, as Confluence.post_attachment does.
+progress (or conf.progress) is called as progress(filename, sent, total)
+while the file is sent. Returns the attachment's info, or None on failure."""
+        if progress is None:
+            progress = self.progress
+        if digest is None:
+            digest = await self._sha256_file(local_filename)
+
+        if attach_id is None:
+            status, reason, details = await self._post_file(self._attachment_url(page_id),
+                                                            attachment_filename,
+                                                            local_filename, comment, progress)
+            if status != 200:
+                logging.info('Could not upload new attachment "%s" to page %i: %s (%s)'%(attachment_filename, page_id, reason, details))
+                return None
+            logging.info('Uploaded new attachment %s'%attachment_filename)
+            attach_info = details['results'][0]
+        else:
+            update_url = self._attachment_url(page_id, attach_id) + '/data'
+            status, reason, details = await self._post_file(update_url, attachment_filename,
+                                                            local_filename, comment, progress)
+            if status != 200:
+                logging.info('Could not update existing attachment "%s" on page %i: %s (%s)'%(attachment_filename, page_id, reason, details))
+                return None
+            logging.info('Updated attachment %s'%attachment_filename)
+            attach_info = details
+        prop = await self._store_attachment_hash(attach_info['id'], digest, prop)
+        self._index_attachment(page_id, attach_info, prop)
+        return attach_info
+
+    async def upload_attachment(self, page_id, attachment_filename,
+                                local_filename, comment = None,
+                                overwrite = False, progress = None):
+        """await conf.upload_attachment(page_id, attachment_filename, local_filename, comment = None, overwrite = False, progress = None)
+Uploads the given local file as an attachment to the page with the given ID.
+progress (or conf.progress) is called as progress(filename, sent, total) while
+it's sent.
+If an attachment already exists with the same filename, it is overwritten if:
+  * the overwrite flag is set to True
+  * the contents of the existing attachment differ from the file being uploaded
+Otherwise, this coroutine has no effect. The same rules apply to the comment
+for the attachment. As with Confluence.upload_attachment, content is compared
+by the SHA-256 hash recorded with the attachment when there is one."""
+        if progress is None:
+            progress = self.progress
+
+        # First we find out whether the page with the given ID already has
+        # an attachment with the given name.
+        index = await self.attachments(page_id)
+        if index is None:
+            return False # Attachments not allowed on this page?
+        attach_info = index.get(attachment_filename)
+
+        # If this page has no such attachment, we create a new one.
+        if attach_info is None:
+            return await self.post_attachment(page_id, attachment_filename, local_filename,
+                                              comment = comment, progress = progress) is not None
+
+        elif overwrite:
+            attach_id = attach_info['id']
+
+            # Compare the existing attachment to what we're uploading, by
+            # hash if one was recorded and by content otherwise. The file is
+            # only hashed (without blocking the event loop) if the hash is
+            # compared or recorded.
+            prop = attachment_hash_property(attach_info)
+            digest = None
+            if prop is not None:
+                digest = await self._sha256_file(local_filename)
+                files_are_identical = (prop['value'] == digest)
+            else:
+                files_are_identical = await self._same_content(self._download_url(attach_info), local_filename)
+                if files_are_identical is None:
+                    logging.info('Could not download existing attachment "%s" on page %i for comparison.'%(attachment_filename, page_id))
+                    files_are_identical = False
+                elif files_are_identical:
+                    digest = await self._sha256_file(local_filename)
+                    prop = await self._store_attachment_hash(attach_id, digest)
+                    self._index_attachment(page_id, attach_info, prop)
+
+            # If they're different, we upload the file, keeping the metadata
+            # we already have.
+            updated = False
+            if not files_are_identical:
+                new_info = await self.post_attachment(page_id, attachment_filename, local_filename,
+                                                      attach_id = attach_id, digest = digest,
+                                                      prop = prop, progress = progress)
+                if new_info is not None:
+                    attach_info = self._attachment_replaced(attach_info, new_info)
+                    updated = True
+            else:
+                logging.info('Did not update attachment %s (identical content)'%attachment_filename)
+
+            # Does the comment need updating?
+            old_comment = attach_info.get('metadata', {}).get('comment')
+            if comment != old_comment:
+                data = self._comment_update_data(attach_info, comment)
+                async with self.session.put(self._attachment_url(page_id, attach_id), json = data) as r:
+                    if r.status == 200:
+                        logging.info('Updated comment for attachment %s'%attachment_filename)
+                        self._comment_updated(attach_info, comment, await r.json())
+                        updated = True
+                    else:
+                        logging.info('Could not update comment for attachment "%s" on page %i: %s (%s)'%(attachment_filename, page_id, r.reason, await self._details(r)))
+                        updated = False
+            return updated
+        return False
@@ -6,6 +6,43 @@
 import logging
 logger = logging.getLogger()
 
+from metro.Archive import open_file, file_size, file_basename
+
+# The content property in which we record the SHA-256 hash of an attachment.
+ATTACHMENT_HASH_KEY = 'sha256'
+
+def sha256_file(filename, chunk_size = 1 << 20):
+    """sha256_file(filename, chunk_size = 1 << 20) -> the hex SHA-256 digest of
+the given file (a filename or an ArchiveMember), which is read a chunk at a 
+time so that large files needn't fit in memory."""
+    import hashlib
+    h = hashlib.sha256()
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    with open_file(filename, buffering = 0) as f:
+        n = f.readinto(buf)
+        while n:
+            h.update(view[:n])
+            n = f.readinto(buf)
+    return h.hexdigest()
+
+def page_checksum(page):
+    """page_checksum(page) -> the checksum Metro stores in the 'checksum' 
+property of a Confluence page to detect changes to its title and body."""
+    import hashlib
+    content = page.title + page.body
+    return hashlib.md5(content.encode('utf-8')).hexdigest()
+
+def attachment_hash_property(attach_info):
+    """attachment_hash_property(attach_info) -> the 'sha256' content property
+expanded in the given attachment info returned by Confluence, or None if
+the attachment has no recorded hash."""
+    props = attach_info.get('metadata', {}).get('properties', {})
+    prop = props.get(ATTACHMENT_HASH_KEY)
+    if isinstance(prop, dict) and 'value' in prop:
+        return prop
+    return None
+
 class Error(Exception):
     """Base class for exceptions in this module."""
     pass
@@ -35,9 +72,9 @@ provided is validated according to these rules:
     * overwrite, if given, must be True or False. This attribute is only used 
       in creating pages.
     * images, if given, must be a list of names of image files (JPEG or PNG) 
-      accessible to the filesystem.
+      accessible to the filesystem, or of ArchiveMembers for such files.
     * attachments, if given, must be a list of names of files accessible to 
-      the filesystem.
+      the filesystem, or of ArchiveMembers.
     * work"""
 
         if title is not None:
@@ -70,25 +107,20 @@ provided is validated according to these rules:
             raise TypeError('overwrite must be a boolean.')
         self.overwrite = overwrite
 
-        import os.path  # for validating image paths.
-
+        # Whether images and attachments exist is up to whoever makes the 
+        # page (Manifest checks them all at once), or is found out when 
+        # they're uploaded.
         if not isinstance(images, list):
             raise TypeError('Page images must be a list of image filenames.')
         else:
             for image in images:
-                if not image.lower().endswith('.png') and \
-                   not image.lower().endswith('.jpg'):
+                if not file_basename(image).lower().endswith('.png') and \
+                   not file_basename(image).lower().endswith('.jpg'):
                     raise TypeError('Page image %s is not a PNG or JPEG file.'%image)
-                if not os.path.isfile(image):
-                    raise FileNotFoundError('Page image %s not found.'%image)
         self.images = images
 
         if not isinstance(attachments, list):
             raise TypeError('Page attachments must be a list of filenames.')
-        else:
-            for attach in attachments:
-                if not os.path.isfile(attach):
-                    raise FileNotFoundError('Page attachment %s not found.'%attach)
         self.attachments = attachments
 
         if auto_gen is not None:
@@ -100,7 +132,6 @@ provided is validated according to these rules:
 
     def __str__(self):
         """String representation of a Page."""
-        import os
         if self.title is not None:
             s = 'Page("%s")\n'%self.title
         else: # self.page_id is not None:
@@ -111,34 +142,374 @@ provided is validated according to these rules:
             else:
                 s += ' Parent page: %s\n'%self.parent_id['title']
         if self.images is not None:
-            s += ' Images: %s\n'%repr([os.path.basename(im) for im in self.images])
+            s += ' Images: %s\n'%repr([file_basename(im) for im in self.images])
         if self.attachments is not None:
-            s += ' Attachments: %s\n'%repr([os.path.basename(im) for im in self.attachments])
+            s += ' Attachments: %s\n'%repr([file_basename(im) for im in self.attachments])
         return s
 
-class Confluence(object):
-    """Confluence: a proxy object for a Confluence server"""
+class ConfluenceAPI(object):
+    """ConfluenceAPI: what Confluence and AsyncConfluence have in common.
+
+It knows how to address the Confluence REST API, what to send it and what to
+make of its answers, and it keeps what we learn about pages and attachments
+along the way. It never talks to the server itself: that's up to the
+subclasses, which send the requests it builds, blocking or asynchronously."""
+
+    # Confluence returns at most this many results per request.
+    RESULTS_LIMIT = 200
 
-    def __init__(self, url, username = None):
-        """Confluence(url, username = None) -> new proxy for Confluence server at the given URL."""
+    # What we ask Confluence to expand when we look up a page's metadata,
+    # its info, or its attachments.
+    METADATA_EXPAND = 'version,ancestors,space,metadata.properties.checksum'
+    INFO_EXPAND = 'title,version,space,body.view.value,metadata'
+    ATTACHMENT_EXPAND = 'version,metadata,metadata.properties.' + ATTACHMENT_HASH_KEY
+
+    def _init_api(self, url, username, pool_size):
+        """Sets up the URLs and caches for the Confluence server at the given URL."""
         self.base_url = url
         self.user = username
+        self.pool_size = pool_size
 
         # Stash REST endpoint and viewing URIs in the options namespace.
         self.rest_url = "{base}/rest/api/content".format(base = self.base_url)
         self.view_url = "{base}/pages/viewpage.action?pageId=".format(base = self.base_url)
 
+        # Keep track of IDs of recently created pages.
+        self.pages_created = {}
+
+        # Cache children of pages.
+        self._children_cache = {}
+
+        # Cache the attachments of pages, indexed by filename.
+        self._attachment_cache = {}
+
+        # Titles, spaces and ancestors of pages we know about, filled in by
+        # prefetching whole spaces.
+        self._page_index = {}
+        self._ancestors_cache = {}
+
+        # Publisher threads share these caches, so they're only read or
+        # written while holding this lock. What we hand back from them is a
+        # copy, so that callers can iterate over it while other threads
+        # carry on.
+        import threading
+        self._cache_lock = threading.Lock()
+
+    def _version_url(self):
+        return '{base}/rest/applinks/1.0/manifest'.format(base = self.base_url)
+
+    def _parse_version(self, text):
+        """Returns the version number in the given applinks manifest."""
+        # The manifest is an XML document. We're looking for
+        # manifest->version.
+        import xml.etree.ElementTree as et
+        root = et.fromstring(text)
+        version = None
+        for v in root.findall('version'):
+            version = v.text
+        return version
+
+    def _page_url(self, page_id, expand = None):
+        url = '{rest}/{pageid}'.format(rest = self.rest_url, pageid = page_id)
+        if expand:
+            url += '?expand=' + expand
+        return url
+
+    def _property_url(self, content_id, key):
+        return '{rest}/{contentid}/property/{key}'.format(rest = self.rest_url,
+                                                         contentid = content_id,
+                                                         key = key)
+
+    def _search_request(self, cql, start, expand = None):
+        """Returns the URL and query parameters for the batch of search results
+starting at the given index."""
+        params = {'cql': cql, 'start': start, 'limit': self.RESULTS_LIMIT}
+        if expand:
+            params['expand'] = expand
+        return '{rest}/search'.format(rest = self.rest_url), params
+
+    def _children_url(self, page_id, start):
+        return '{rest}/{pageid}/child?expand=page&start={start}&limit={limit}'.format(
+            rest = self.rest_url, pageid = page_id, start = start, limit = self.RESULTS_LIMIT)
+
+    def _attachment_url(self, page_id, attach_id = None):
+        url = '{rest}/{pageid}/child/attachment'.format(rest = self.rest_url, pageid = page_id)
+        if attach_id is not None:
+            url += '/' + attach_id
+        return url
+
+    def _attachment_list_url(self, page_id, start):
+        return '{url}?expand={expand}&start={start}&limit={limit}'.format(
+            url = self._attachment_url(page_id), expand = self.ATTACHMENT_EXPAND,
+            start = start, limit = self.RESULTS_LIMIT)
+
+    def _download_url(self, attach_info):
+        return '{base}{dl}'.format(base = self.base_url, dl = attach_info['_links']['download'])
+
+    def _property_data(self, key, value, prop = None):
+        """Returns the body of a request storing the given value in the content
+property with the given key. prop is the property as it stands, including its
+version, or None if there's no such property yet, in which case the body is
+POSTed rather than PUT."""
+        data = {'key': key, 'value': value}
+        if prop is not None:
+            data['version'] = {'number': int(prop['version']['number']) + 1}
+        return data
+
+    def _new_page_data(self, page, parent_id, space_key):
+        """Returns the body of a request creating the given page under the
+parent with the given ID."""
+        return {
+            'type': 'page',
+            'title': page.title,
+            'ancestors': [{'type': 'page', 'id': str(parent_id)}],
+            'space': {'key': space_key},
+            'body': {'storage': {'representation': 'storage',
+                                 'value': page.body}}
+        }
+
+    def _page_update_data(self, page, parent_id):
+        """Returns the body of a request replacing the title and body of the
+given page, which stays under the parent with the given ID (or at the top of
+its space if that's None)."""
+        data = {
+            'id': page.id,
+            'type': 'page',
+            'title': page.title,
+            'version': {'number' : int(page.version) + 1},
+            'body': {'storage': {'representation' : 'storage',
+                                 'value' : page.body}}
+        }
+        if parent_id is not None:
+            data['ancestors'] = [{'type': 'page', 'id': str(parent_id)}]
+        return data
+
+    def _comment_update_data(self, attach_info, comment):
+        """Returns the body of a request setting the comment of the given
+attachment."""
+        return {'id': attach_info['id'],
+                'type': 'attachment',
+                'version': {'number': int(attach_info['version']['number']) + 1},
+                'metadata': {'comment': comment}}
+
+    def _checksum_property(self, meta):
+        """Returns the checksum property expanded in the given page metadata,
+or None if the page has none."""
+        prop = meta.get('metadata', {}).get('properties', {}).get('checksum')
+        if isinstance(prop, dict) and 'value' in prop:
+            return prop
+        return None
+
+    def _parent_of(self, meta):
+        """Returns the ID of the parent of the page with the given metadata, or
+None if it's at the top of its space."""
+        if meta['ancestors']:
+            return int(meta['ancestors'][-1]['id'])
+        return None
+
+    def _resolve_parent(self, parent_id, page):
+        """Returns the ID of the parent under which the given page is created:
+its own parent if it names one, and the given parent otherwise."""
+        # Override the parent_id with the page's entry.
+        pid = parent_id
+        if page.parent_id:
+            pid = page.parent_id
+
+        # If our parent ID is another Page (because this is a child of a page
+        # created in the same manifest), convert it to an ID.
+        if isinstance(pid, Page):
+            if pid.id is not None:
+                pid = pid.id
+            else:
+                pid = int(self.pages_created[pid.title])
+        return pid
+
+    def _parent_title(self, parent_id):
+        with self._cache_lock:
+            return self._page_index.get(parent_id, (str(parent_id), None))[0]
+
+    def _known_page(self, page_id):
+        """Returns the (title, space key) of the page with the given ID if it's
+in the page index, and None otherwise."""
+        with self._cache_lock:
+            return self._page_index.get(page_id)
+
+    def _cached_ancestors(self, page_id):
+        with self._cache_lock:
+            return self._ancestors_cache.get(page_id)
+
+    def _cached_children(self, page_id):
+        with self._cache_lock:
+            children = self._children_cache.get(page_id)
+            return dict(children) if children is not None else None
+
+    def _cache_children(self, page_id, results):
+        """Records the given child page results as the children of the page
+with the given ID, and returns them as a dict mapping titles to IDs."""
+        with self._cache_lock:
+            children = {}
+            for result in results:
+                children[result['title']] = int(result['id'])
+            self._children_cache[page_id] = children
+            return dict(children)
+
+    def _index_space(self, space_key, results):
+        """Records the titles and ancestors of the pages in the given search
+results for the space with the given key."""
+        with self._cache_lock:
+            # Every page gets a children entry, even if it has no children, so
+            # that leaves don't have to be listed either.
+            children = {}
+            for result in results:
+                page_id = int(result['id'])
+                self._page_index[page_id] = (result['title'], space_key)
+                self._ancestors_cache[page_id] = result['ancestors']
+                children.setdefault(page_id, {})
+                if result['ancestors']:
+                    parent_id = int(result['ancestors'][-1]['id'])
+                    children.setdefault(parent_id, {})[result['title']] = page_id
+            self._children_cache.update(children)
+        logging.info('Prefetched %i pages in space %s'%(len(results), space_key))
+
+    def _page_sent(self, page, data):
+        """Fleshes out the given page object with some details from the
+response to creating or updating it."""
+        page.space_key = data['space']['key']
+        page.id = int(data['id'])
+        page.version = int(data['version']['number'])
+        page.view_url = '%s%s'%(self.view_url, page.id)
+
+    def _page_posted(self, page, parent_id, parent_title):
+        """Records the given page, just created under the parent with the given
+ID and title."""
+        with self._cache_lock:
+            # A brand-new page has no attachments or children, so there's
+            # nothing to list.
+            self._attachment_cache[page.id] = {}
+            self._children_cache[page.id] = {}
+
+            # Add the page to the index if we've prefetched its parent.
+            # Otherwise, invalidate the children cache for the parent.
+            # (Another thread may have done this already.)
+            if parent_id in self._page_index:
+                self._page_index[page.id] = (page.title, page.space_key)
+                self._children_cache.setdefault(parent_id, {})[page.title] = page.id
+                if parent_id in self._ancestors_cache:
+                    self._ancestors_cache[page.id] = self._ancestors_cache[parent_id] + \
+                        [{'id': str(parent_id), 'type': 'page', 'title': parent_title}]
+            else:
+                self._children_cache.pop(parent_id, None)
+
+    def _page_put(self, page, parent_id):
+        """Records the new title of the given page, just updated under the
+parent with the given ID."""
+        with self._cache_lock:
+            # The title may have changed, so keep what we know about the
+            # page and its siblings straight.
+            siblings = self._children_cache.get(parent_id)
+            if siblings is not None:
+                for title in [t for t, i in siblings.items() if i == page.id]:
+                    siblings.pop(title, None)
+                siblings[page.title] = page.id
+            if page.id in self._page_index:
+                self._page_index[page.id] = (page.title, page.space_key)
+
+    def _forget_page(self, page_id):
+        """Removes the deleted page with the given ID from the page index and
+caches."""
+        with self._cache_lock:
+            self._attachment_cache.pop(page_id, None)
+            self._page_index.pop(page_id, None)
+            self._ancestors_cache.pop(page_id, None)
+            children = self._children_cache.pop(page_id, None)
+            for parent_id, siblings in list(self._children_cache.items()):
+                if page_id not in siblings.values():
+                    continue
+                if children == {}:
+                    for title in [t for t, i in siblings.items() if i == page_id]:
+                        siblings.pop(title, None)
+                else:
+                    # Confluence moves the children of a deleted page up to its
+                    # parent, so the parent has to be listed again.
+                    self._children_cache.pop(parent_id, None)
+            if children != {}:
+                # Same goes for the ancestors of its descendants.
+                for descendant_id, ancestors in list(self._ancestors_cache.items()):
+                    if any(int(a['id']) == page_id for a in ancestors):
+                        self._ancestors_cache.pop(descendant_id, None)
+
+    def _cached_attachments(self, page_id):
+        with self._cache_lock:
+            index = self._attachment_cache.get(page_id)
+            return dict(index) if index is not None else None
+
+    def _cache_attachments(self, page_id, results):
+        """Records the given attachment results as the attachment index of the
+page with the given ID, and returns the index."""
+        with self._cache_lock:
+            index = {}
+            for result in results:
+                index[result['title']] = result
+            self._attachment_cache[page_id] = index
+            return dict(index)
+
+    def _index_attachment(self, page_id, attach_info, prop = None):
+        """Records the given attachment info, along with its hash property if
+given, in the attachment index of the page with the given ID."""
+        with self._cache_lock:
+            if prop is not None:
+                md = attach_info.setdefault('metadata', {})
+                md.setdefault('properties', {})[ATTACHMENT_HASH_KEY] = prop
+            index = self._attachment_cache.get(page_id)
+            if index is not None:
+                index[attach_info['title']] = attach_info
+
+    def _attachment_replaced(self, attach_info, new_info):
+        """Returns the info of a new version of the given attachment, keeping
+the metadata we already have for it."""
+        with self._cache_lock:
+            md = new_info.setdefault('metadata', {})
+            for key, value in attach_info.get('metadata', {}).items():
+                md.setdefault(key, value)
+            return new_info
+
+    def _comment_updated(self, attach_info, comment, data):
+        """Records the given comment, just stored with the given attachment,
+along with the new version in the response data."""
+        with self._cache_lock:
+            attach_info['version'] = data.get('version', attach_info['version'])
+            attach_info.setdefault('metadata', {})['comment'] = comment
+
+    def attachment_hashes(self, page_id):
+        """conf.attachment_hashes(page_id) -> a dict mapping the filenames of the
+attachments known to be on the page with the given ID to (sha256, version)
+tuples. Only attachments with recorded hashes in an index that has already
+been listed are included, so this never contacts the server."""
+        with self._cache_lock:
+            hashes = {}
+            for filename, attach_info in self._attachment_cache.get(page_id, {}).items():
+                prop = attachment_hash_property(attach_info)
+                if prop is not None and 'version' in attach_info:
+                    hashes[filename] = (prop['value'], int(attach_info['version']['number']))
+            return hashes
+
+class Confluence(ConfluenceAPI):
+    """Confluence: a proxy object for a Confluence server"""
+
+    def __init__(self, url, username = None, pool_size = 10):
+        """Confluence(url, username = None, pool_size = 10) -> new proxy for Confluence server at the given URL.
+At most pool_size connections to the server are kept alive for reuse."""
+        self._init_api(url, username, pool_size)
+
         # Authenticate.
         self._authenticate()
 
         # Get the server version number.
         logging.info('Connected to %s (v%s)'%(self.base_url, self.version))
 
-        # Keep track of IDs of recently created pages.
-        self.pages_created = {}
-
-        # Cache children of pages.
-        self._children_cache = {}
+        # If set, this is called as progress(filename, sent, total) as files
+        # are uploaded.
+        self.progress = None
 
     def _authenticate(self):
         """Authenticates the user, returning a (username, password) tuple."""
@@ -159,15 +530,28 @@ class Confluence(object):
         self.session.auth = (self.user, self.passwd)
         self.session.headers.update({'Content-Type' : 'application/json'})
 
+        # Keep enough connections alive for all the threads that share this
+        # session.
+        from requests.adapters import HTTPAdapter
+        adapter = HTTPAdapter(pool_maxsize = self.pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        # Count the requests each thread makes, so that we can tell what an
+        # operation cost.
+        import threading
+        self._tally = threading.local()
+        self.session.hooks['response'].append(self._count_request)
+
         # FIXME: Turn off SSL certificate verification for now.
-        # FIXME: We have to figure out SSL certificates for our Confluence 
+        # FIXME: We have to figure out SSL certificates for our Confluence
         # FIXME: servers.
         import urllib3
         urllib3.disable_warnings()
         self.session.verify = False
 
         # We try to authenticate by asking Confluence for its version number.
-        # If this fails, we re-prompt for a password and change it. 
+        # If this fails, we re-prompt for a password and change it.
         # Only prompt for a new password once.
         logging.info('Authenticating as %s'%self.user)
         version = self._get_version()
@@ -183,7 +567,7 @@ class Confluence(object):
         else:
             self.version = version
 
-        # Give our session a not-stupid retry policy. 
+        # Give our session a not-stupid retry policy.
         # (From https://www.peterbe.com/plog/best-practice-with-retries-with-requests)
 #        num_retries=3
 #        backoff_factor=0.3
@@ -200,18 +584,10 @@ class Confluence(object):
 #        self.session.mount('https://', adapter)
 
     def _get_version(self):
-        url = '{base}/rest/applinks/1.0/manifest'.format(base = self.base_url)
-        r = self.session.get(url,
+        r = self.session.get(self._version_url(),
                              verify=self.session.verify) # :-( shouldn't need this
         if r.status_code == 200:
-            # The manifest is an XML document. We're looking for 
-            # manifest->version.
-            import xml.etree.ElementTree as et
-            root = et.fromstring(r.text) 
-            version = None
-            for v in root.findall('version'):
-                version = v.text
-            return version
+            return self._parse_version(r.text)
         elif r.status_code == 401: # Unauthorized!
             logging.info('Could not connect to Confluence server (unauthorized)')
             return 'unauthorized'
@@ -224,35 +600,78 @@ class Confluence(object):
             logging.info('Could not get version for Confluence server: %s (%s)'%(r.reason, details))
             return '??.??.??'
 
+    def _count_request(self, r, *args, **kwargs):
+        self._tally.count = getattr(self._tally, 'count', 0) + 1
+
+    def request_count(self):
+        """conf.request_count() -> the number of requests the calling thread has
+made to the server so far."""
+        return getattr(self._tally, 'count', 0)
+
+    def connections_opened(self):
+        """conf.connections_opened() -> the number of connections (and thus
+TCP/TLS handshakes) made to the server so far by this proxy."""
+        count = 0
+        for adapter in set(self.session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                count += pools[key].num_connections
+        return count
+
+    def _post_file(self, url, attachment_filename, local_filename, comment = None, progress = None):
+        """Posts the given local file (a filename or an ArchiveMember) to the
+given attachment URL as multipart form data over our pooled session,
+returning the response. The file is streamed, a chunk at a time. If given,
+progress is called as progress(filename, sent, total) along the way."""
+        import os.path, mimetypes
+        from metro.Multipart import MultipartStream
+        content_type, encoding = mimetypes.guess_type(file_basename(local_filename))
+        if content_type is None:
+            content_type = 'multipart/form-data'
+        name = os.path.basename(attachment_filename)
+        callback = None
+        if progress is not None:
+            callback = lambda sent, total: progress(name, sent, total)
+        body = MultipartStream(progress = callback)
+        body.add_file('file', name, local_filename, content_type)
+        if comment is not None:
+            body.add_field('comment', comment)
+        headers = {'X-Atlassian-Token': 'no-check',
+                   'Content-Type': body.content_type}
+        try:
+            return self.session.post(url, data = body, headers = headers)
+        finally:
+            body.close()
+
     def _error(self, message):
         raise RuntimeError("Confluence: {m}".format(m = message))
 
-    def _update_page_checksum(self, page):
-
-        # Get the page's existing checksum if it exists.
-        checksum, checksum_version = self._get_page_checksum(page.id)
+    def _update_page_checksum(self, page, prop = None):
+        """Stores the checksum of the given page's title and body in its
+'checksum' property. prop is the page's existing checksum property, or None
+if it doesn't have one yet. Returns the checksum, or None on failure."""
 
         # Create a new checksum for the page.
-        import hashlib, json
-        content = page.title + page.body
-        page.checksum = hashlib.md5(content.encode('utf-8')).hexdigest()
-        prop = {'key': 'checksum',
-                'value': page.checksum}
-        if checksum_version is not None:
-            prop['version'] = {'number': checksum_version + 1}
-        data = json.dumps(prop)
+        import json
+        page.checksum = page_checksum(page)
 
         # Store the page's title and checksum as page properties.
-        url = '{rest}/{pageid}/property/checksum'.format(rest = self.rest_url, pageid = page.id)
-        if checksum is not None: # checksum already exists
-            r = self.session.put(url, data = data)
-            if r.status_code != 200: 
+        url = self._property_url(page.id, 'checksum')
+        if prop is not None and 'version' not in prop:
+            # The version wasn't expanded, so look it up. If the property
+            # has gone, we create it again.
+            checksum, checksum_version = self._get_page_checksum(page.id)
+            prop = None if checksum_version is None else {'version': {'number': checksum_version}}
+        data = self._property_data('checksum', page.checksum, prop)
+        if prop is not None: # checksum already exists
+            # Bump the version we already know.
+            r = self.session.put(url, data = json.dumps(data))
+            if r.status_code != 200:
                 logging.info('Could not update checksum for page "%s": %s (%s)'%(page.title, r.reason, r.json()['message']))
                 return None
         else: #checksum doesn't exist yet
             # We need to create this property.
-            data = json.dumps(prop)
-            r = self.session.post(url, data = data)
+            r = self.session.post(url, data = json.dumps(data))
             if r.status_code != 200:
                 logging.info('Could not create checksum for page "%s": %s (%s)'%(page.title, r.reason, r.json()['message']))
                 return None
@@ -260,24 +679,29 @@ class Confluence(object):
 
     def _get_page_checksum(self, page_id):
         # Get the properties associated with this page.
-        import json
-        url = '{rest}/{pageid}/property/checksum'.format(rest = self.rest_url, 
-                                                         pageid = page_id)
-        r = self.session.get(url)
+        r = self.session.get(self._property_url(page_id, 'checksum'))
         if r.status_code != 200:
             if r.status_code == 404:
                 return None, None
             else:
-                logging.info('Could not retrieve checksum for page %i: %s (%s)'%(page_id, r.reason, json()['message']))
+                logging.info('Could not retrieve checksum for page %i: %s (%s)'%(page_id, r.reason, r.json()['message']))
                 return None, None
         return (r.json()['value'], r.json()['version']['number'])
 
+    def _page_metadata(self, page_id):
+        """Returns the version, ancestors, space and checksum property of the
+page with the given ID, all in one request, or None if they can't be retrieved."""
+        r = self.session.get(self._page_url(page_id, self.METADATA_EXPAND))
+        if r.status_code != 200:
+            logging.info('Could not retrieve metadata for page %i: %s (%s)'%(page_id, r.reason, r.json()['message']))
+            return None
+        return r.json()
+
     def info(self, page_id):
         """conf.info(page_id) -> a dict containing information for the page with the given ID,
 or None if no such page exists."""
 
-        url = '{rest}/{pageid}?expand=title,version,space,body.view.value,metadata'.format(rest = self.rest_url, pageid = page_id)
-        r = self.session.get(url, 
+        r = self.session.get(self._page_url(page_id, self.INFO_EXPAND),
                              verify=self.session.verify) # :-( shouldn't need this
         if r.status_code == 200:
             return r.json()
@@ -293,77 +717,114 @@ or None if no such page exists."""
     def ancestors(self, page_id):
         """conf.ancestors(page_id) -> a dict of ancestors of the page with the given ID."""
 
+        ancestors = self._cached_ancestors(page_id)
+        if ancestors is not None:
+            return ancestors
+
         # Get basic page information plus the ancestors properties
-        url = '{rest}/{pageid}?expand=ancestors'.format(rest = self.rest_url, pageid = page_id)
-        r = self.session.get(url)
+        r = self.session.get(self._page_url(page_id, 'ancestors'))
         if r.status_code != 200:
-            logging.info('Could not retrieve ancestors for page %i: %s (%s)'%(page.id, r.reason, r.json()['message']))
+            logging.info('Could not retrieve ancestors for page %i: %s (%s)'%(page_id, r.reason, r.json()['message']))
             return None
         return r.json()['ancestors']
 
+    def prefetch_space(self, space_key):
+        """conf.prefetch_space(space_key) -> Loads the titles and ancestors of all
+pages in the space with the given key in a few large requests, so that
+children, ancestors and create_page can answer questions about them without
+asking the server. Returns True on success and False otherwise."""
+        results = self.search('space = "%s" and type = page'%space_key, expand = 'ancestors')
+        if results is None:
+            logging.info('Could not prefetch pages in space %s.'%space_key)
+            return False
+        self._index_space(space_key, results)
+        return True
+
+    def prefetch(self, page_id):
+        """conf.prefetch(page_id) -> Prefetches the space containing the page
+with the given ID, unless that's been done already. Returns True on success
+and False otherwise."""
+        if self._known_page(page_id) is not None:
+            return True
+        r = self.session.get(self._page_url(page_id, 'space'))
+        if r.status_code != 200:
+            logging.info('Could not find the space of page %i: %s'%(page_id, r.reason))
+            return False
+        return self.prefetch_space(r.json()['space']['key'])
+
+    def search(self, cql, expand = None):
+        """conf.search(cql, expand = None) -> a list of the content matching the
+given CQL query, with the given comma-separated properties expanded, or None if
+the search fails. Results are fetched in as few requests as Confluence allows."""
+        start = 0
+        results = []
+        while True:
+            url, params = self._search_request(cql, start, expand)
+            r = self.session.get(url, params = params)
+            if r.status_code != 200:
+                details = 'details not available'
+                try:
+                    details = r.json()['message']
+                except:
+                    pass
+                logging.info('Could not search for "%s": %s (%s)'%(cql, r.reason, details))
+                return None
+            data = r.json()
+            results.extend(data['results'])
+            start += len(data['results'])
+            # Confluence may return fewer results than we ask for, so we go
+            # by whether it tells us there's a next batch.
+            if not data['results'] or 'next' not in data.get('_links', {}):
+                break
+        return results
+
     def children(self, page_id):
-        """conf.children(page_id) -> a dict mapping child page IDs to their titles, 
+        """conf.children(page_id) -> a dict mapping child page IDs to their titles,
 for the page with the given ID, or None if no such ID exists."""
 
-        if page_id in self._children_cache.keys():
-            return self._children_cache[page_id]
-        else: 
-            # Confluence seems to limit us to 200 results max. But it does 
-            # let us specify which results to start at, so we can keep going 
-            # back till we exhaust the results.
-            limit = 200
-            url = '{rest}/{pageid}/child?expand=page&limit={limit}'.format(rest = self.rest_url, pageid = page_id, limit = limit)
-            r = self.session.get(url)
-            if r.status_code == 200:
-                children = {}
-                results = r.json()['page']['results']
-                for r in results:
-                    children[r['title']] = int(r['id'])
-                # Keep going back for more until there are fewer than 
-                # Confluence's undocumented results limit.
-                start = limit
-                while len(results) == limit:
-                    url = '{rest}/{pageid}/child?expand=page&start={start}&limit={limit}'.format(rest = self.rest_url, pageid = page_id, start = start, limit = limit)
-                    r = self.session.get(url)
-                    if r.status_code == 200:
-                        results = r.json()['page']['results']
-                        for r in results:
-                            children[r['title']] = int(r['id'])
-                    start += len(results)
-                self._children_cache[page_id] = children
-                return children
-            else:
-                return None
+        children = self._cached_children(page_id)
+        if children is not None:
+            return children
+
+        # Confluence seems to limit us to 200 results max. But it does
+        # let us specify which results to start at, so we can keep going
+        # back till we exhaust the results.
+        start = 0
+        results = []
+        while True:
+            r = self.session.get(self._children_url(page_id, start))
+            if r.status_code != 200:
+                if start == 0:
+                    return None
+                break
+            batch = r.json()['page']['results']
+            results.extend(batch)
+            start += len(batch)
+            if len(batch) < self.RESULTS_LIMIT:
+                break
+        return self._cache_children(page_id, results)
 
     def create_page(self, parent_id, page):
         """conf.create_page(parent_id, page) -> Creates a new page under a parent page with the given ID.
-Returns True if the page is successfully created. If a page with the same title exists under that parent page, 
+Returns True if the page is successfully created. If a page with the same title exists under that parent page,
 nothing happens, and the function returns False."""
 
         # Make sure the page is well-formed.
         assert(page.title is not None)
         assert(page.body is not None)
+        pid = self._resolve_parent(parent_id, page)
 
-        # Override the parent_id with the page's entry.
-        pid = parent_id
-        if page.parent_id:
-            pid = page.parent_id
-
-        # If our parent ID is another Page (because this is a child of a page 
-        # created in the same manifest), convert it to an ID.
-        if isinstance(pid, Page):
-            if pid.parent_id:
-                pid = pid.id
-            else:
-                pid = int(self.pages_created[pid.title])
-
-        # Get information about the parent page.
-        info = self.info(pid)
-        if info is None:
-            logging.info('Could not create new page "%s" under nonexistent parent %i.'%(page.title, pid))
-            return False
-        space_key = info['space']['key']
-        parent_title = info['title']
+        # Get information about the parent page, if we don't have it already.
+        known = self._known_page(pid)
+        if known is not None:
+            parent_title, space_key = known
+        else:
+            info = self.info(pid)
+            if info is None:
+                logging.info('Could not create new page "%s" under nonexistent parent %i.'%(page.title, pid))
+                return False
+            space_key = info['space']['key']
+            parent_title = info['title']
 
         # See if we already have a page in this set.
         children = self.children(pid)
@@ -371,52 +832,26 @@ nothing happens, and the function returns False."""
             page.id = int(children[page.title])
             # If we're allowed to overwrite the page, we update it.
             if page.overwrite:
-                self.update_page(page.id, page)
-                return True
+                return self.update_page(page.id, page)
             else:
                 return False
 
         # There's no page, so we make a new one.
-        data = {
-            'type': 'page',
-            'title': page.title,
-            'ancestors': [{'type': 'page', 'id': str(pid)}],
-            'space': {'key': space_key},
-            'body': {'storage': {'representation': 'storage',
-                                 'value': page.body}}
-        }
-        import json
-        r = self.session.post(self.rest_url, data = json.dumps(data))
-
-        # Flesh out the page object with some details from the transaction.
-        if r.status_code == 200:
-            data = r.json()
-            page.space_key = data['space']['key']
-            page.id = int(data['id'])
-            page.version = int(data['version']['number'])
-            page.view_url = '%s%s'%(self.view_url, page.id)
-            logging.info('Created new page "%s" (id = %i) under parent "%s"'%(page.title, page.id, parent_title))
-            self._update_page_checksum(page)
-
-            # Invalidate the children cache for this page.
-            del self._children_cache[pid]
-        else:
-            logging.info('Could not create new page "%s" under parent "%s": %s (%s)'%(page.title, parent_title, r.reason, r.json()['message']))
+        if not self.post_page(pid, space_key, page, parent_title):
             return False
 
         # Now upload images if need be.
-        import os.path
         for image in page.images:
-            self.upload_attachment(page.id, 
-                                   os.path.basename(image), 
-                                   image, 
+            self.upload_attachment(page.id,
+                                   file_basename(image),
+                                   image,
                                    overwrite = page.overwrite)
 
         # Update attachments if need be.
         for attachment in page.attachments:
-            self.upload_attachment(page.id, 
-                                   os.path.basename(attachment), 
-                                   attachment, 
+            self.upload_attachment(page.id,
+                                   file_basename(attachment),
+                                   attachment,
                                    overwrite = page.overwrite)
 
         # Stash the ID of the newly created page.
@@ -425,213 +860,293 @@ nothing happens, and the function returns False."""
         return True
 
     def update_page(self, page_id, page):
-        """conf.update(page) -> Updates the page the given ID using the content 
+        """conf.update(page) -> Updates the page the given ID using the content
 of the given page. Returns True if the update succeeds or False if it fails."""
 
         # Create a checksum for the new page.
-        import hashlib
-        content = page.title + page.body
-        page.checksum = hashlib.md5(content.encode('utf-8')).hexdigest()
-
-        # Get the page's properties.
-        checksum, checksum_version = self._get_page_checksum(page_id)
+        page.checksum = page_checksum(page)
+
+        # Fetch everything we need to know about the page in one go: its
+        # checksum tells us whether it has changed, and its version and
+        # parent are needed to update it.
+        start_count = self.request_count()
+        meta = self._page_metadata(page_id)
+        if meta is None:
+            return False
+        page.id = page_id
+        page.space_key = meta['space']['key']
+        page.version = int(meta['version']['number'])
+        page.view_url = '%s%s'%(self.view_url, page.id)
+        prop = self._checksum_property(meta)
+        checksum = prop['value'] if prop is not None else None
 
         # We only update the page itself if its title or checksum has changed.
         if checksum is None or page.checksum != checksum:
-            # Retrieve and bump the version number.
-            info = self.info(page_id)
-            ver = int(info['version']['number']) + 1
-
-            # Figure out the parent page.
-            ancestors = self.ancestors(page_id)
-            anc = ancestors[-1]
-            del anc['_links']
-            del anc['_expandable']
-            del anc['extensions']
-
-            # Assemble our request.
-            data = {
-                'id': page.id,
-                'type': 'page',
-                'title': page.title,
-                'version': {'number' : ver},
-                'ancestors': [anc],
-                'body': {'storage': {'representation' : 'storage',
-                                     'value' : page.body}}
-            }
-
-            # Do it.
-            import json
-            data = json.dumps(data)
-            url = '{rest}/{pageid}'.format(rest = self.rest_url, pageid = page.id)
-            r = self.session.put(url, data = data)
-
-            if r.status_code == 200:
-                # Flesh out the page object with some details from the transaction.
-                data = r.json()
-                page.space_key = data['space']['key']
-                page.id = int(data['id'])
-                page.version = data['version']['number']
-                page.view_url = '%s%s'%(self.view_url, page.id)
-                logging.info('Updated content for page "%s" (id = %i)'%(page.title, page.id))
-
-                # Update the page's checksum.
-                self._update_page_checksum(page)
-            else:
-                logging.info('Could not update content for page "%s" (id = %i): %s (%s)'%(page.title, page.id, r.reason, r.json()['message']))
+            # Update the page under its current parent.
+            if not self.put_page(page, self._parent_of(meta), prop):
                 return False
         else:
             logging.info('Did not update content for page "%s" (identical)'%(page.title))
 
         # Now upload images if need be.
-        import os.path
         for image in page.images:
-            self.upload_attachment(page.id, 
-                                   os.path.basename(image), 
-                                   image, 
+            self.upload_attachment(page.id,
+                                   file_basename(image),
+                                   image,
                                    overwrite = True)
 
         # Update attachments if need be.
         for attachment in page.attachments:
-            self.upload_attachment(page.id, 
-                                   os.path.basename(attachment), 
-                                   attachment, 
+            self.upload_attachment(page.id,
+                                   file_basename(attachment),
+                                   attachment,
                                    overwrite = True)
 
+        logging.info('Made %i requests for page "%s" (id = %i)'%(self.request_count() - start_count, page.title, page.id))
+        return True
+
+    def post_page(self, parent_id, space_key, page, parent_title = None):
+        """conf.post_page(parent_id, space_key, page, parent_title = None) -> Creates the given
+page under the parent page with the given ID in the space with the given key,
+without checking whether it exists first, and records its checksum. Returns
+True on success and False otherwise."""
+        if parent_title is None:
+            parent_title = self._parent_title(parent_id)
+        import json
+        data = self._new_page_data(page, parent_id, space_key)
+        r = self.session.post(self.rest_url, data = json.dumps(data))
+        if r.status_code != 200:
+            logging.info('Could not create new page "%s" under parent "%s": %s (%s)'%(page.title, parent_title, r.reason, r.json()['message']))
+            return False
+        self._page_sent(page, r.json())
+        logging.info('Created new page "%s" (id = %i) under parent "%s"'%(page.title, page.id, parent_title))
+        self._page_posted(page, parent_id, parent_title)
+
+        # A brand-new page has no checksum yet.
+        self._update_page_checksum(page, None)
+        return True
+
+    def put_page(self, page, parent_id, checksum_prop = None):
+        """conf.put_page(page, parent_id, checksum_prop = None) -> Replaces the title and
+body of the existing page with the given page's ID, keeping it under the parent
+with the given ID (None for the top of its space), and records its checksum.
+page.version must be the page's current version on the server, and
+checksum_prop its existing checksum property (or None if it has none).
+Returns True on success and False otherwise."""
+        import json
+        data = self._page_update_data(page, parent_id)
+        r = self.session.put(self._page_url(page.id), data = json.dumps(data))
+        if r.status_code != 200:
+            logging.info('Could not update content for page "%s" (id = %i): %s (%s)'%(page.title, page.id, r.reason, r.json()['message']))
+            return False
+        self._page_sent(page, r.json())
+        logging.info('Updated content for page "%s" (id = %i)'%(page.title, page.id))
+        self._page_put(page, parent_id)
+
+        # Update the page's checksum.
+        self._update_page_checksum(page, checksum_prop)
         return True
 
     def delete_page(self, page_id):
         """conf.delete_page(page_id)
 Deletes the page with the given ID, returning True on success and False otherwise."""
-        url = '{rest}/{pageid}'.format(rest = self.rest_url, pageid = page_id)
-        r = self.session.delete(url)
+        r = self.session.delete(self._page_url(page_id))
         if r.status_code == 204:
-            logging.info('Deleted page (id = %i)'%page.id)
+            logging.info('Deleted page (id = %i)'%page_id)
+            self._forget_page(page_id)
             return True
         else:
-            logging.info('Could not delete page (id = %i): %s (%s)'%(page.id, r.reason, r.json()['message']))
+            logging.info('Could not delete page (id = %i): %s (%s)'%(page_id, r.reason, r.json()['message']))
+            return False
+
+    def _store_attachment_hash(self, attach_id, digest, prop = None):
+        """Records the given SHA-256 digest in the 'sha256' property of the
+attachment with the given ID. prop is the attachment's existing property,
+if it has one. Returns the property as stored, or None on failure."""
+        import json
+        url = self._property_url(attach_id, ATTACHMENT_HASH_KEY)
+        if prop is not None and 'version' not in prop:
+            # The version isn't always expanded along with the property.
+            r = self.session.get(url)
+            if r.status_code != 200:
+                logging.info('Could not retrieve hash for attachment %s: %s'%(attach_id, r.reason))
+                return None
+            prop = r.json()
+        data = self._property_data(ATTACHMENT_HASH_KEY, digest, prop)
+        if prop is None:
+            r = self.session.post(url, data = json.dumps(data))
+        else:
+            r = self.session.put(url, data = json.dumps(data))
+        if r.status_code != 200:
+            logging.info('Could not store hash for attachment %s: %s'%(attach_id, r.reason))
+            return None
+        return r.json()
+
+    def attachments(self, page_id):
+        """conf.attachments(page_id) -> a dict mapping the filenames of the
+attachments on the page with the given ID to information about them, or None
+if they can't be retrieved. The attachments are listed once per page and
+kept up to date as attachments are uploaded."""
+        index = self._cached_attachments(page_id)
+        if index is not None:
+            return index
+
+        # As with children, we page through the attachments till we get a
+        # short batch.
+        start = 0
+        results = []
+        while True:
+            r = self.session.get(self._attachment_list_url(page_id, start))
+            if r.status_code != 200:
+                logging.info('Could not list attachments on page %i: %s (%s)'%(page_id, r.reason, r.json()['message']))
+                return None
+            batch = r.json()['results']
+            results.extend(batch)
+            start += len(batch)
+            if len(batch) < self.RESULTS_LIMIT:
+                break
+        return self._cache_attachments(page_id, results)
+
+    def _download_matches(self, attach_info, local_filename):
+        """Downloads the given existing attachment and compares it to the given
+local file. Returns True if their contents are identical."""
+        size = attach_info.get('extensions', {}).get('fileSize')
+        if size is not None and int(size) != file_size(local_filename):
             return False
 
-    def upload_attachment(self, page_id, attachment_filename, 
-                          local_filename, comment = None, 
-                          overwrite = False):
-        """conf.upload_attachment(page_id, attachment_filename, local_filename, comment = None, overwrite = False)
-Uploads the given local file as an attachment to the page with the given ID. 
+        # Closing the streamed response hands its connection back to
+        # the pool.
+        with self.session.get(self._download_url(attach_info), stream=True) as r:
+            if r.status_code == 200:
+                # Compare its contents to the file we're uploading, a chunk at a time.
+                chunk_size = 1024
+                with open_file(local_filename) as f:
+                    for old_bytes in r.iter_content(chunk_size = chunk_size):
+                        new_bytes = f.read(chunk_size)
+                        if new_bytes[:] != old_bytes[:]:
+                            return False
+                    return f.read(1) == b''
+            elif r.status_code == 500:
+                logging.info('Got internal server error from Confluence for attachment "%s".'%attach_info['title'])
+            else:
+                logging.info('Could not download existing attachment "%s" for comparison: %s (%s)'%(attach_info['title'], r.reason, r.json()['message']))
+        return False
+
+    def post_attachment(self, page_id, attachment_filename, local_filename,
+                        attach_id = None, digest = None, prop = None,
+                        comment = None, progress = None):
+        """conf.post_attachment(page_id, attachment_filename, local_filename, attach_id = None, digest = None, prop = None, comment = None, progress = None)
+Uploads the given local file (a filename or an ArchiveMember) to the page with
+the given ID, as a new attachment or, if attach_id is given, as a new version
+of that attachment, without comparing it to what's there. Its SHA-256 hash
+(digest, if it's already known) is recorded; prop is the attachment's
+existing hash property, if it has one. Returns the attachment's info, or None
+on failure."""
+        if progress is None:
+            progress = self.progress
+        if digest is None:
+            digest = sha256_file(local_filename)
+
+        # The Confluence REST API requires a multipart-encoded POST for
+        # creating and updating attachments.
+        if attach_id is None:
+            r = self._post_file(self._attachment_url(page_id), attachment_filename, local_filename, comment, progress)
+            if r.status_code != 200:
+                logging.info('Could not upload new attachment "%s" to page %i: %s (%s)'%(attachment_filename, page_id, r.reason, r.json()['message']))
+                return None
+            logging.info('Uploaded new attachment %s'%attachment_filename)
+            attach_info = r.json()['results'][0]
+        else:
+            update_url = self._attachment_url(page_id, attach_id) + '/data'
+            r = self._post_file(update_url, attachment_filename, local_filename, comment, progress)
+            if r.status_code != 200:
+                logging.info('Could not update existing attachment "%s" on page %i: %s (%s)'%(attachment_filename, page_id, r.reason, r.json()['message']))
+                return None
+            logging.info('Updated attachment %s'%attachment_filename)
+            attach_info = r.json()
+        prop = self._store_attachment_hash(attach_info['id'], digest, prop)
+        self._index_attachment(page_id, attach_info, prop)
+        return attach_info
+
+    def upload_attachment(self, page_id, attachment_filename,
+                          local_filename, comment = None,
+                          overwrite = False, progress = None):
+        """conf.upload_attachment(page_id, attachment_filename, local_filename, comment = None, overwrite = False, progress = None)
+Uploads the given local file (a filename or an ArchiveMember) as an attachment
+to the page with the given ID. Files are streamed, so they needn't fit in
+memory; progress (or conf.progress) is called as progress(filename, sent, total)
+while they're sent.
 If an attachment already exists with the same filename, it is overwritten if:
   * the overwrite flag is set to True
   * the contents of the existing attachment differ from the file being uploaded
-Otherwise, this method has no effect. The same rules apply to the comment 
-for the attachment."""
-        attach_url = '{rest}/{pageid}/child/attachment'.format(rest = self.rest_url, pageid = page_id)
-        # First we find out whether the page with the given ID already has 
+Otherwise, this method has no effect. The same rules apply to the comment
+for the attachment.
+
+Each uploaded attachment carries a SHA-256 hash of its content in a 'sha256'
+content property, so that unchanged files can be recognized without
+downloading them. Attachments without a recorded hash are downloaded and
+compared once, and the hash is recorded if they match."""
+        if progress is None:
+            progress = self.progress
+
+        # First we find out whether the page with the given ID already has
         # an attachment with the given name.
-        url = '{attach}?filename={file}'.format(attach = attach_url, file = attachment_filename)
-        r = self.session.get(url)
-        if r.status_code == 200:
-            attach_info = r.json()
-            attachment_exists = len(attach_info['results']) > 0
-        else: 
-            logging.info('Could not query attachment "%s" on page %i: %s (%s)'%(attachment_filename, page_id, r.reason, r.json()['message']))
+        index = self.attachments(page_id)
+        if index is None:
             return False # Attachments not allowed on this page?
+        attach_info = index.get(attachment_filename)
 
         # If this page has no such attachment, we create a new one.
-        import requests, os.path, mimetypes
-        if not attachment_exists:
-            # The Confluence REST API requires a multipart-encoded POST 
-            # for creating new attachments.
-            headers = {'X-Atlassian-Token': 'no-check'}
-            content_type, encoding = mimetypes.guess_type(local_filename)
-            if content_type is None:
-                content_type = 'multipart/form-data'
-            files = {'file': (os.path.basename(attachment_filename), open(local_filename, 'rb'), content_type)}
-            if comment is not None:
-                files['comment'] = str(comment)
-
-            # For some reason, this POST doesn't work when we use our usual
-            # session (headers not set up properly?). So we just open a new session 
-            # for the upload.
-            r = requests.post(attach_url, 
-                              files = files,
-                              headers = headers,
-                              auth=self.session.auth,
-                              verify=self.session.verify)
-            if r.status_code == 200:
-                logging.info('Uploaded new attachment %s'%attachment_filename)
-                return True
-            else:
-                logging.info('Could not upload new attachment "%s" to page %i: %s (%s)'%(attachment_filename, page_id, r.reason, r.json()['message']))
-                return False
+        if attach_info is None:
+            return self.post_attachment(page_id, attachment_filename, local_filename,
+                                        comment = comment, progress = progress) is not None
 
         elif overwrite:
-            attach_info = attach_info['results'][0]
             attach_id = attach_info['id']
 
-            # If we're told to overwrite the existing attachment, 
-            # we get the current content so that we can compare it to 
-            # what we're uploading.
-
-            # Download the existing attachment.
-            download_url = '{base}{dl}'.format(base = self.base_url, dl = attach_info['_links']['download'])
-            r = requests.get(download_url, 
-                             stream=True, 
-                             auth=self.session.auth,
-                             verify=self.session.verify)
-            if r.status_code == 200:
-                # Compare its contents to the file we're uploading, a chunk at a time.
-                files_are_identical = True
-                chunk_size = 1024
-                with open(local_filename, 'rb') as f:
-                    for old_bytes in r.iter_content(chunk_size = chunk_size):
-                        new_bytes = f.read(chunk_size)
-                        if new_bytes[:] != old_bytes[:]:
-                            files_are_identical = False
-                            break
-            elif r.status_code == 500:
-                logging.info('Got internal server error from Confluence for attachment "%s" on page %i.'%(attachment_filename, page_id))
-                files_are_identical = False
+            # If we're told to overwrite the existing attachment, we compare
+            # the hash recorded for it to that of the file we're uploading.
+            # If there's no hash, we compare the content itself. Either way,
+            # the file is only hashed if the hash is compared or recorded.
+            prop = attachment_hash_property(attach_info)
+            digest = None
+            if prop is not None:
+                digest = sha256_file(local_filename)
+                files_are_identical = (prop['value'] == digest)
             else:
-                logging.info('Could not download existing attachment "%s" on page %i for comparison: %s (%s)'%(attachment_filename, page_id, r.reason, r.json()['message']))
-                files_are_identical = False
-
-            # If they're different, we upload the file.
+                files_are_identical = self._download_matches(attach_info, local_filename)
+                if files_are_identical:
+                    digest = sha256_file(local_filename)
+                    prop = self._store_attachment_hash(attach_id, digest)
+                    self._index_attachment(page_id, attach_info, prop)
+
+            # If they're different, we upload the file, keeping the metadata
+            # we already have.
             if not files_are_identical:
-                update_url = attach_url + '/' + attach_id + '/data'
-                headers = {'X-Atlassian-Token': 'no-check'}
-                content_type, encoding = mimetypes.guess_type(local_filename)
-                if content_type is None:
-                    content_type = 'multipart/form-data'
-                files = {'file': (os.path.basename(attachment_filename), open(local_filename, 'rb'), content_type)}
-
-                r = requests.post(update_url, 
-                                  files = files,
-                                  headers = headers,
-                                  auth=self.session.auth,
-                                  verify=self.session.verify)
-                if r.status_code == 200:
-                    logging.info('Updated attachment %s'%attachment_filename)
+                new_info = self.post_attachment(page_id, attachment_filename, local_filename,
+                                                attach_id = attach_id, digest = digest,
+                                                prop = prop, progress = progress)
+                if new_info is not None:
+                    attach_info = self._attachment_replaced(attach_info, new_info)
                     updated = True
                 else:
-                    logging.info('Could not update existing attachment "%s" on page %i: %s (%s)'%(attachment_filename, page_id, r.reason, r.json()['message']))
                     updated = False
             else:
                 updated = False
                 logging.info('Did not update attachment %s (identical content)'%attachment_filename)
 
             # Does the comment need updating?
-            old_comment = None
-            if 'metadata' in attach_info.keys():
-                md = attach_info['metadata']
-                if 'comment' in md.keys():
-                    old_comment = md['comment']
+            old_comment = attach_info.get('metadata', {}).get('comment')
             if (comment != old_comment):
-                comment_url = attach_url + '/' + attach_id
-                data = {'comment': comment}
-                r = self.session.put(url, data=data)
+                import json
+                data = self._comment_update_data(attach_info, comment)
+                r = self.session.put(self._attachment_url(page_id, attach_id), data=json.dumps(data))
                 if r.status_code == 200:
                     logging.info('Updated comment for attachment %s'%attachment_filename)
+                    self._comment_updated(attach_info, comment, r.json())
                     updated = True
                 else:
-                    logging.info('Could not update comment for attachment "%s" on page %i: %s (%s)'%(attachment_filename, page.id, r.reason, r.json()['message']))
+                    logging.info('Could not update comment for attachment "%s" on page %i: %s (%s)'%(attachment_filename, page_id, r.reason, r.json()['message']))
                     updated = False
             return updated
 
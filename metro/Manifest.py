@@ -12,47 +12,294 @@ Attributes:
     def __init__(self, message):
         self.message = message
 
+class PageSource(object):
+    """PageSource: the title, front matter and Markdown body of a page file, 
+which is read just once."""
+
+    # How much of a file we look at to figure out its encoding.
+    prefix_size = 1 << 16
+
+    # The front matter we recognize, in the order we look for it.
+    front_matter_keys = ['title', 'excerpt', 'toc', 'tags']
+
+    def __init__(self, filename):
+        """PageSource(filename) -> new PageSource for the Markdown file with the given name 
+(or in the given ArchiveMember)."""
+        from metro.Archive import open_file
+        self.filename = filename
+        try:
+            with open_file(filename) as f:
+                data = f.read()
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            raise ManifestError('The page file %s is not a valid file.'%filename)
+        self._scan(self._decode(data))
+
+    def _decode(self, data):
+        """Decodes the given file contents as UTF-8 or, failing that, as 
+Latin-1 (Quip does this), and splits them into lines with universal newlines."""
+        import codecs, io
+        encoding = 'utf-8'
+        try:
+            # An incomplete character at the end of the prefix is fine.
+            codecs.getincrementaldecoder('utf-8')().decode(data[:self.prefix_size], final = False)
+        except UnicodeDecodeError:
+            encoding = 'latin-1'
+        try:
+            text = data.decode(encoding)
+        except UnicodeDecodeError:
+            text = data.decode('latin-1')
+        return io.StringIO(text, newline = None).readlines()
+
+    def _scan(self, lines):
+        """Finds the title, front matter and body in the given lines, in one pass."""
+        # The title comes from the first top-level heading. Jekyll-formatted 
+        # markdown documents have front matter at the top between lines of 
+        # three dashes:
+        # ---
+        # title: SQL Support Summary
+        # excerpt: SDB SQL support as compared to PostgreSQL
+        # toc: false
+        # tags: [dml,ddl,queries]
+        # ---
+        # Everything from the first such line to the last is left out of the 
+        # body, and the last value given for each key wins.
+        self.title = None
+        self.front_matter = {}
+        first = last = None
+        for i, line in enumerate(lines):
+            if self.title is None and line.startswith('# '):
+                self.title = line.replace('# ', '').strip()
+            if line == '---\n':
+                if first is None:
+                    first = i
+                last = i
+            if line.startswith('---'):
+                continue
+            for key in self.front_matter_keys:
+                if line.startswith(key + ': '):
+                    self.front_matter[key] = line.replace(key + ': ', '').strip()
+                    break
+        if self.title is None:
+            self.title = 'Untitled'
+        self.has_dashes = first is not None
+        if first is None:
+            self.markdown = ''.join(lines)
+        else:
+            self.markdown = ''.join(lines[:first] + lines[last + 1:])
+
+def _convert(source, table_of_contents, auto_gen, render_cache):
+    """Converts the Markdown in the given PageSource to XHTML, or fetches it 
+from the given RenderCache if it's there."""
+    key = None
+    if render_cache is not None:
+        key = render_cache.key(source.title, source.markdown, table_of_contents, auto_gen)
+        body = render_cache.get(key)
+        if body is not None:
+            return body
+    from metro.markdown_to_xhtml import markdown_to_xhtml
+    body = markdown_to_xhtml(source.title, source.markdown, 
+                             table_of_contents = table_of_contents, 
+                             auto_gen = auto_gen)
+    if key is not None:
+        render_cache.put(key, body)
+    return body
+
+def _log_missing_front_matter(page_file):
+    """Notes that the given page file has no front matter."""
+    import logging
+    logging.info('The page file %s has no front matter (no lines of three dashes).'%page_file)
+
+def _render_page_file(args):
+    """Converts the given page file to XHTML in a worker process for 
+Manifest.rendered, returning the body, the front matter and whether the file 
+had any lines of dashes."""
+    (page_file, table_of_contents, auto_gen, render_cache) = args
+    source = PageSource(page_file)
+    body = _convert(source, table_of_contents, auto_gen, render_cache)
+    return (body, source.front_matter, source.has_dashes)
+
+def is_jsonl_manifest(manifest_file):
+    """is_jsonl_manifest(manifest_file) -> True if the manifest file with the 
+given name is in the JSON Lines format, going by its extension."""
+    return manifest_file.lower().endswith(('.jsonl', '.ndjson'))
+
+def open_manifest(manifest_file, archive = None):
+    """open_manifest(manifest_file, archive = None) -> a text file object for 
+the manifest file with the given name, in the given Archive if there is one."""
+    if archive is None:
+        return open(manifest_file, 'r')
+    import io
+    return io.TextIOWrapper(archive.member(manifest_file).open(), encoding = 'utf-8')
+
+def read_json_manifest(json_file, archive = None):
+    """read_json_manifest(json_file, archive = None) -> the contents of the given JSON manifest 
+file (in the given Archive if there is one), whose "pages" are each a dict with any child 
+pages nested under "children"."""
+    import json
+    with open_manifest(json_file, archive) as f:
+        manifest = json.loads(f.read())
+    # Validate the dictionary.
+    if not isinstance(manifest, dict) or 'pages' not in manifest.keys():
+        raise ManifestError('The JSON manifest file has no "pages" entry.')
+    pages = manifest['pages']
+    if not isinstance(pages, list):
+        raise ManifestError('The "pages" entry in the JSON manifest file is not a list.')
+    for page in pages:
+        if not isinstance(page, dict):
+            raise ManifestError('Each page in the "pages" entry for the JSON manifest file must be a JSON object.')
+    return manifest
+
+def convert_to_jsonl(json_file, jsonl_file):
+    """convert_to_jsonl(json_file, jsonl_file) -> number of pages
+Writes the pages in the given JSON manifest file to a new JSON Lines manifest 
+file with the given name, one page per line, parents first. Pages with 
+children are given a "key", which their children name as their "parent". 
+Anything else in the JSON manifest goes in a "manifest" object on the first 
+line. Returns the number of pages written."""
+    import json
+    manifest = read_json_manifest(json_file)
+    pages = manifest['pages']
+    count = 0
+    with open(jsonl_file, 'w') as f:
+        others = dict((k, v) for (k, v) in manifest.items() if k != 'pages')
+        if others:
+            f.write(json.dumps({'manifest': others}) + '\n')
+        # Go depth first, so that parents always come before their children.
+        stack = [(page, None) for page in reversed(pages)]
+        while stack:
+            (page, parent) = stack.pop()
+            record = dict((k, v) for (k, v) in page.items() if k != 'children')
+            if parent is not None:
+                # Children are always created under their parent.
+                record.pop('parent_id', None)
+            count += 1
+            children = page.get('children', [])
+            if children:
+                record['key'] = 'page-%i'%count
+                stack.extend((child, record['key']) for child in reversed(children))
+            if parent is not None:
+                record['parent'] = parent
+            f.write(json.dumps(record) + '\n')
+    return count
+
+class DirectoryIndex(object):
+    """DirectoryIndex: the contents of folders, each listed once with 
+os.scandir, against which the existence of files and folders is checked 
+without looking each of them up."""
+
+    def __init__(self):
+        self._listings = {} # folder -> {name: (is_dir, is_file)}, or None if it isn't one
+
+    def _listing(self, folder):
+        import os, os.path
+        folder = os.path.normpath(folder)
+        if folder not in self._listings:
+            try:
+                with os.scandir(folder) as entries:
+                    # Both follow symlinks, so a broken link is neither.
+                    self._listings[folder] = dict((entry.name, (entry.is_dir(), entry.is_file()))
+                                                  for entry in entries)
+            except OSError:
+                self._listings[folder] = None
+        return self._listings[folder]
+
+    def isdir(self, path):
+        """index.isdir(path) -> True if the given path is a folder."""
+        return self._listing(path) is not None
+
+    def isfile(self, path):
+        """index.isfile(path) -> True if the given path is a file, or a link to 
+one, as with os.path.isfile."""
+        import os, os.path
+        (folder, name) = os.path.split(os.path.normpath(path))
+        listing = self._listing(folder or os.curdir)
+        if listing is None:
+            return False
+        if name in listing:
+            return listing[name][1]
+        # Names needn't match the listing exactly on a case-insensitive 
+        # filesystem, so we ask it about the ones that don't.
+        return os.path.isfile(path)
+
+def error_message(e):
+    """error_message(e) -> the message of the given exception."""
+    return e.message if isinstance(e, ManifestError) else str(e)
+
+def problem_report(manifest_file, errors):
+    """problem_report(manifest_file, errors) -> a message listing the given 
+problems with the manifest with the given name."""
+    lines = ['The manifest %s has %i problem(s):'%(manifest_file, len(errors))]
+    for e in errors:
+        lines.append('  %s'%error_message(e))
+    return '\n'.join(lines)
+
 class Manifest(object):
     """Manifest: an object representing the contents of a Metro manifest file."""
 
-    def __init__(self, json_file):
-        """Manifest(json_file) -> new Manifest object created from the 
-given JSON file with the given absolute path."""
+    def __init__(self, json_file, archive = None, lazy = False, render_jobs = 1, render_cache = None, 
+                 index = None):
+        """Manifest(json_file, archive = None, lazy = False, render_jobs = 1, render_cache = None, 
+         index = None) -> new Manifest object created from the 
+given JSON file with the given absolute path. If archive is given, json_file is 
+the path of the manifest within that Archive, from which page files, images and 
+attachments are all read without being extracted. If lazy is True, pages are converted to 
+XHTML only when render is called for them, and their bodies are None till then.
+If render_jobs is more than 1, pages are converted that many at a time in 
+separate processes. If a RenderCache is given, pages that have been converted 
+before are fetched from it instead. If a SourceIndex is given, pages whose 
+inputs haven't changed since they were last published go in pages_unchanged, 
+without being read, instead of pages_to_create or pages_to_update."""
         import os.path
+        if not isinstance(render_jobs, int) or render_jobs < 1:
+            raise ValueError('render_jobs must be a positive integer.')
         if not isinstance(json_file, str):
             raise TypeError('json_file must be the name of a file containing a JSON manifest.')
-        elif not os.path.isfile(json_file):
+        elif not (archive.isfile(json_file) if archive is not None else os.path.isfile(json_file)):
             raise FileNotFoundError('The JSON manifest file %s was not found.'%json_file)
 
         # Extract the prefix for all the files from the manifest filename.
         # We will prepend this prefix to all filenames in pages.
         self.prefix = os.path.dirname(json_file)
-        # Parse the manifest into a big dictionary.
-        import json
-        with open(json_file, 'r') as f:
-            manifest = json.loads(f.read())
-        # Validate the dictionary and populate the Manifest with it.
-        if 'pages' not in manifest.keys():
-            raise ManifestError('The JSON manifest file has no "pages" entry.')
-        pages = manifest['pages']
-        if not isinstance(pages, list):
-            raise ManifestError('The "pages" entry in the JSON manifest file is not a list.')
-        import os
-        for page in pages:
-            if not isinstance(page, dict):
-                raise ManifestError('Each page in the "pages" entry for the JSON manifest file must be a JSON object.')
-            self.validate_page(page)
-
-        # Now populate our page lists.
+        self.archive = archive
+        self.lazy = lazy
+        self.render_jobs = render_jobs
+        self.render_cache = render_cache
+        # Archives know what's in them already.
+        self._directory = archive if archive is not None else DirectoryIndex()
+        self._sources = {} # id(page) -> (file_path, table_of_contents, auto_gen)
+        self.index = index
+        self._fingerprints = {} # id(page) -> (key, fingerprint)
+        if index is not None:
+            # Pages in zip files are keyed by the zip file's name.
+            self._index_name = os.path.abspath(archive.filename if archive is not None else json_file)
+            self._known = index.entries(self._index_name)
         self.pages_to_create = []
         self.pages_to_update = []
         self.pages_to_delete = []
-        for page in pages:
-            self._add_page(page)
+        self.pages_unchanged = []
+        if is_jsonl_manifest(json_file):
+            # Pages are validated and added a line at a time.
+            self._read_jsonl(json_file)
+        else:
+            # Parse the manifest into a big dictionary, and check everything 
+            # in it before we start.
+            pages = read_json_manifest(json_file, archive)['pages']
+            errors = self.validate_pages(pages)
+            if errors:
+                raise ManifestError(problem_report(json_file, errors))
+
+            # Now populate our page lists.
+            for page in pages:
+                self._add_page(page)
+
+        # Convert the pages all at once if we're doing it in parallel.
+        if render_jobs > 1 and not lazy:
+            for (page, body) in self.rendered(self.pages_to_create + self.pages_to_update):
+                pass
 
     def _add_page(self, page):
         import os.path
-        folder = os.path.join(self.prefix, page['folder']) or self.prefix
+        folder = os.path.join(self.prefix, page.get('folder', '')) or self.prefix
 
         # Do we want a table of contents?
         toc = None
@@ -66,20 +313,13 @@ given JSON file with the given absolute path."""
 
         if page['operation'] == 'create':
             file_path = os.path.join(folder, page['file'])
+            (key, fingerprint) = self._fingerprint(page, folder, file_path)
+            unchanged = self._skip_unchanged(page, key, fingerprint)
+            if unchanged is not None:
+                return unchanged
 
-            # Get the title and/or body from the file.
-            (title, body) = self.parse_page_body(file_path, 
-                                                 table_of_contents = toc,
-                                                 auto_gen = auto_gen)
-
-            # Get the front matter on markdown file
-            front_matter = self._evaluate_front_matter(file_path)
-
-            # Overwrite the title with any specified one.
-            if 'title' in page.keys():
-                title = page['title']
-            else:
-                title = front_matter['title']
+            # Get the title and body from the file.
+            (title, body) = self._load_page(page, file_path, toc, auto_gen)
 
             overwrite = False
             if 'overwrite' in page.keys():
@@ -99,11 +339,11 @@ given JSON file with the given absolute path."""
 
             images = []
             if 'images' in page.keys():
-                images = [os.path.join(folder, im) for im in page['images']]
+                images = [self._asset(page, folder, im) for im in page['images']]
 
             attachments = []
             if 'attachments' in page.keys():
-                attachments = [os.path.join(folder, a) for a in page['attachments']]
+                attachments = [self._asset(page, folder, a) for a in page['attachments']]
 
             # Append this page to our list.
             from metro.Confluence import Page
@@ -115,6 +355,8 @@ given JSON file with the given absolute path."""
                             attachments = attachments,
                             auto_gen = auto_gen)
             self.pages_to_create.append(new_page)
+            self._sources[id(new_page)] = (file_path, toc, auto_gen)
+            self._fingerprints[id(new_page)] = (key, fingerprint)
 
             # Are there child pages in here?
             children = []
@@ -126,33 +368,28 @@ given JSON file with the given absolute path."""
                 # For now, 'parent_id' points to the new Page object. 
                 child['parent_id'] = new_page
                 self._add_page(child)
+            return new_page
 
         elif page['operation'] == 'update':
             file_path = os.path.join(folder, page['file'])
+            (key, fingerprint) = self._fingerprint(page, folder, file_path)
+            unchanged = self._skip_unchanged(page, key, fingerprint)
+            if unchanged is not None:
+                return unchanged
 
-            # Get the title and/or body from the file.
-            (title, body) = self.parse_page_body(file_path,
-                                                 table_of_contents = toc,
-                                                 auto_gen = auto_gen)
-
-            # Get the front matter on markdown file
-            front_matter = self._evaluate_front_matter(file_path)
-
-            # Overwrite the title with any specified one.
-            if 'title' in page.keys():
-                title = page['title']
-            else:
-                title = front_matter['title']
+            # Get the title and body from the file.
+            (title, body) = self._load_page(page, file_path, toc, auto_gen)
 
             images = []
             if 'images' in page.keys():
-                images = [os.path.join(folder, im) for im in page['images']]
+                images = [self._asset(page, folder, im) for im in page['images']]
 
             attachments = []
             if 'attachments' in page.keys():
-                attachments = [os.path.join(folder, a) for a in page['attachments']]
+                attachments = [self._asset(page, folder, a) for a in page['attachments']]
 
             # Append this page to our list.
+            from metro.Confluence import Page
             updated_page = Page(title = title, 
                                 body = body, 
                                 page_id = int(page['page_id']),
@@ -160,6 +397,8 @@ given JSON file with the given absolute path."""
                                 attachments = attachments,
                                 auto_gen = auto_gen)
             self.pages_to_update.append(updated_page)
+            self._sources[id(updated_page)] = (file_path, toc, auto_gen)
+            self._fingerprints[id(updated_page)] = (key, fingerprint)
 
             # Are there child pages in here?
             children = []
@@ -169,34 +408,296 @@ given JSON file with the given absolute path."""
             # Handle the children.
             for child in children:
                 child['parent_id'] = page['page_id']
-                self.add_page(child)
+                self._add_page(child)
+            return updated_page
 
         else: # page['operation'] == 'delete'
             # Append this page to our delete list.
+            from metro.Confluence import Page
             page_to_delete = Page(page_id = int(page['page_id']))
             self.pages_to_delete.append(page_to_delete)
+            return page_to_delete
+
+    def _read_jsonl(self, jsonl_file):
+        """Validates and adds the pages in the given JSON Lines manifest, one 
+line at a time. A page with a "parent" is created under the page whose "key" 
+is given, which must come earlier. As in JSON manifests, pages under a page 
+being deleted are ignored, as is anything else about the manifest, which is 
+given in a "manifest" object on the first line."""
+        import json
+        keys = {} # key -> Page or page ID, or None for pages we're ignoring
+        errors = []
+        first_line = None
+        with open_manifest(jsonl_file, self.archive) as f:
+            for (line_number, line) in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                if first_line is None:
+                    first_line = line_number
+                try:
+                    page = json.loads(line)
+                except ValueError as e:
+                    errors.append(ManifestError('Line %i is not valid JSON: %s'%(line_number, e)))
+                    continue
+                if not isinstance(page, dict):
+                    errors.append(ManifestError('Line %i is not a JSON object.'%line_number))
+                    continue
+                if line_number == first_line and list(page.keys()) == ['manifest']:
+                    continue
+                key = page.pop('key', None)
+                parent = page.pop('parent', None)
+                if parent is not None and keys.get(parent, False) is None:
+                    # Its parent is being deleted.
+                    if key is not None:
+                        keys[key] = None
+                    continue
+
+                problems = self.page_errors(page)
+                if 'children' in page.keys():
+                    problems.append(ManifestError('Pages in a JSON Lines manifest give their parent\'s "parent" key instead of "children".'))
+                if key is not None and key in keys:
+                    problems.append(ManifestError('The key "%s" is used by more than one page in the manifest.'%key))
+                if parent is not None:
+                    if parent not in keys:
+                        problems.append(ManifestError('The parent "%s" of the page must come before it.'%parent))
+                    elif 'parent_id' in page.keys():
+                        problems.append(ManifestError('A page can\'t have both a "parent" and a "parent_id".'))
+                errors += [ManifestError('Line %i: %s'%(line_number, error_message(e))) for e in problems]
+                if errors:
+                    # Keep checking the rest of the manifest, but there's no 
+                    # point adding any more pages.
+                    if key is not None:
+                        keys.setdefault(key, None if page.get('operation') == 'delete' else False)
+                    continue
+
+                if parent is not None:
+                    page['parent_id'] = keys[parent]
+                new_page = self._add_page(page)
+                if key is not None:
+                    if page['operation'] == 'delete':
+                        new_page = None
+                    elif page['operation'] == 'update':
+                        # Its children go under it by ID, as in JSON manifests.
+                        new_page = page['page_id']
+                    keys[key] = new_page
+        if errors:
+            raise ManifestError(problem_report(jsonl_file, errors))
+
+    def _fingerprint(self, page, folder, file_path):
+        """Returns the key and fingerprint of the given manifest page for our 
+SourceIndex, or (None, None) if we don't have one. The key identifies the 
+page by where it goes and which file it comes from."""
+        if self.index is None:
+            return (None, None)
+        import os.path
+        from metro.Confluence import Page
+        if page['operation'] == 'update':
+            key = 'update %s'%page['page_id']
+        else:
+            parent = page.get('parent_id')
+            if isinstance(parent, Page):
+                parent = self._fingerprints[id(parent)][0]
+            key = '%s > %s'%(parent or '', os.path.relpath(file_path, self.prefix))
+            if 'title' in page.keys():
+                key += ' (%s)'%page['title']
+        if self.archive is not None:
+            sources = [self._asset(page, folder, page['file'])]
+        else:
+            sources = [file_path]
+        sources += [self._asset(page, folder, f) for f in page.get('images', []) + page.get('attachments', [])]
+        return (key, self.index.fingerprint(page, sources))
+
+    def _skip_unchanged(self, page, key, fingerprint):
+        """If the index says the given manifest page was published with the 
+given fingerprint, adds it and its children to pages_unchanged and returns 
+the Page standing in for it. Pages created under a page that has changed are 
+never skipped, in case their parent is created anew."""
+        if key is None:
+            return None
+        from metro.Confluence import Page
+        known = self._known.get(key)
+        parent = page.get('parent_id')
+        if known is None or known['fingerprint'] != fingerprint or \
+           (isinstance(parent, Page) and parent.id is None):
+            return None
+        unchanged = Page(title = known['title'], page_id = int(known['page_id']))
+        self.pages_unchanged.append(unchanged)
+        self._fingerprints[id(unchanged)] = (key, fingerprint)
+        for child in page.get('children', []):
+            child['parent_id'] = unchanged
+            self._add_page(child)
+        return unchanged
+
+    def record_sources(self, pages):
+        """manifest.record_sources(pages) -> Records the inputs of the given 
+pages of the manifest, which have been published, in the manifest's 
+SourceIndex, so that they're skipped next time if they haven't changed. 
+Other pages are forgotten, so that they're tried again."""
+        entries = {}
+        for page in pages:
+            if id(page) in self._fingerprints and page.id is not None:
+                (key, fingerprint) = self._fingerprints[id(page)]
+                entries[key] = {'fingerprint': fingerprint, 'page_id': page.id, 'title': page.title}
+        self.index.replace(self._index_name, entries)
+
+    def _asset(self, page_dict, folder, filename):
+        """Returns the path of the given image or attachment in the given page
+folder, or its ArchiveMember if we're reading assets from an archive (or None
+if it isn't there)."""
+        import os.path
+        if self.archive is not None:
+            return self.archive.member(os.path.join(folder, filename))
+        return os.path.join(folder, filename)
+
+    def _page_file(self, file_path):
+        """Returns the given page file, or its ArchiveMember if we're reading 
+from an archive."""
+        if self.archive is None:
+            return file_path
+        member = self.archive.member(file_path)
+        if member is None:
+            raise ManifestError('The page file %s is not a valid file.'%file_path)
+        return member
+
+    def _load_page(self, page, file_path, toc, auto_gen):
+        """Returns the title and body of the given manifest page, whose 
+Markdown is in the given file. If we're lazy, the body is None, and the file 
+is only read if we need its front matter for the title."""
+        if self.lazy:
+            if 'title' in page.keys():
+                return (page['title'], None)
+            return (PageSource(self._page_file(file_path)).front_matter['title'], None)
+        if self.render_jobs > 1:
+            # The page is converted along with the others once they're all 
+            # loaded, and gets its title from its front matter then.
+            return (page.get('title'), None)
+
+        # Get the title, body and front matter from the file.
+        source = PageSource(self._page_file(file_path))
+        (title, body) = self.render_page_body(source, 
+                                              table_of_contents = toc,
+                                              auto_gen = auto_gen)
+
+        # Overwrite the title with any specified one.
+        if 'title' in page.keys():
+            title = page['title']
+        else:
+            title = source.front_matter['title']
+        return (title, body)
+
+    def render(self, page):
+        """manifest.render(page) -> the body of the given page, which is 
+converted from Markdown to XHTML first if it hasn't been already."""
+        if page.body is None and id(page) in self._sources:
+            (file_path, toc, auto_gen) = self._sources[id(page)]
+            (title, page.body) = self.parse_page_body(file_path, 
+                                                      table_of_contents = toc, 
+                                                      auto_gen = auto_gen)
+        return page.body
+
+    def rendered(self, pages):
+        """manifest.rendered(pages) -> iterator of (page, body) tuples
+Converts the given pages to XHTML, render_jobs at a time in separate 
+processes if render_jobs is more than 1, yielding each with its body in the 
+order given. Pages that already have a body aren't converted again. Raises 
+ManifestError, naming the page file, if a page can't be converted."""
+        if self.render_jobs == 1:
+            for page in pages:
+                yield (page, self.render(page))
+            return
+
+        from concurrent.futures import ProcessPoolExecutor
+        from collections import deque
+        with ProcessPoolExecutor(max_workers = self.render_jobs) as executor:
+            # Keep every worker busy without queueing up every page at once.
+            pending = deque()
+            pages = iter(pages)
+            while True:
+                while len(pending) < 4 * self.render_jobs:
+                    page = next(pages, None)
+                    if page is None:
+                        break
+                    future = None
+                    if page.body is None and id(page) in self._sources:
+                        (file_path, toc, auto_gen) = self._sources[id(page)]
+                        future = executor.submit(_render_page_file, 
+                                                 (self._page_file(file_path), toc, auto_gen, self.render_cache))
+                    pending.append((page, future))
+                if not pending:
+                    break
+                (page, future) = pending.popleft()
+                if future is not None:
+                    file_path = self._sources[id(page)][0]
+                    try:
+                        (body, front_matter, has_dashes) = future.result()
+                        if page.title is None:
+                            page.title = front_matter['title']
+                    except Exception as e:
+                        for (p, f) in pending:
+                            if f is not None:
+                                f.cancel()
+                        message = e.message if isinstance(e, ManifestError) else '%s: %s'%(type(e).__name__, e)
+                        raise ManifestError('Could not convert the page file %s: %s'%(file_path, message))
+                    if not has_dashes:
+                        _log_missing_front_matter(file_path)
+                    page.body = body
+                yield (page, page.body)
+
+    def release(self, page):
+        """manifest.release(page) -> Frees the body of the given page if the 
+manifest is lazy. It's rendered again if it's needed again."""
+        if self.lazy and id(page) in self._sources:
+            page.body = None
 
     def validate_page(self, page_dict):
+        """manifest.validate_page(page_dict) -> Raises the first problem found 
+with the given manifest page, if there is one."""
+        errors = self.page_errors(page_dict)
+        if errors:
+            raise errors[0]
+
+    def validate_pages(self, pages):
+        """manifest.validate_pages(pages) -> list of problems
+Checks the given manifest pages and their children (other than those of 
+pages being deleted, which are ignored), returning a list of exceptions 
+describing everything that's wrong with them."""
+        errors = []
+        for page in pages:
+            errors += self.page_errors(page)
+            if page.get('operation') in ['create', 'update'] and isinstance(page.get('children', []), list):
+                children = [child for child in page.get('children', []) if isinstance(child, dict)]
+                if len(children) < len(page.get('children', [])):
+                    errors.append(ManifestError('Each child of a page in the manifest must be a JSON object.'))
+                errors += self.validate_pages(children)
+        return errors
+
+    def page_errors(self, page_dict):
+        """manifest.page_errors(page_dict) -> list of problems
+Checks the given manifest page, returning a list of exceptions describing 
+everything that's wrong with it. Folders are listed once each, and files 
+are checked against those listings."""
+        errors = []
+
         # Figure out the operation and use that to determine whether we have 
         # enough data to work with.
         if 'operation' not in page_dict.keys():
-            raise ManifestError('A page in the manifest is missing the "operation" entry.')
+            return [ManifestError('A page in the manifest is missing the "operation" entry.')]
         if page_dict['operation'] not in ['create', 'update', 'delete']:
-            raise ManifestError('Invalid operation found for manifest page: %s'%page_dict['operation'])
+            return [ManifestError('Invalid operation found for manifest page: %s'%page_dict['operation'])]
         if page_dict['operation'] == 'create':
 #            if 'parent_id' not in page_dict.keys():
-#                raise ManifestError('The "create" operation for a page requires a parent_id.')
+#                errors.append(ManifestError('The "create" operation for a page requires a parent_id.'))
             if 'file' not in page_dict.keys():
-                raise ManifestError('The "create" operation for a page requires a file.')
+                errors.append(ManifestError('The "create" operation for a page requires a file.'))
         elif page_dict['operation'] == 'update':
             if 'page_id' not in page_dict.keys():
-                raise ManifestError('The "update" operation for a page requires a page_id.')
+                errors.append(ManifestError('The "update" operation for a page requires a page_id.'))
             if 'file' not in page_dict.keys():
-                raise ManifestError('The "update" operation for a page requires a file.')
+                errors.append(ManifestError('The "update" operation for a page requires a file.'))
         else: # page_dict['operation'] == 'delete'
             # We need the page_id attribute to delete a page.
             if 'page_id' not in page_dict.keys():
-                raise ManifestError('The "delete" operation for a page requires a page_id.')
+                errors.append(ManifestError('The "delete" operation for a page requires a page_id.'))
 
         # Now that we know whether we have all the data we need, validate 
         # each datum.
@@ -207,7 +708,7 @@ given JSON file with the given absolute path."""
             if page_id < 0:
                 raise ValueError()
         except ValueError:
-            raise ManifestError('The "page_id" attribute for a page must be a non-negative integer.')
+            errors.append(ManifestError('The "page_id" attribute for a page must be a non-negative integer.'))
         except:
             pass
 
@@ -217,7 +718,7 @@ given JSON file with the given absolute path."""
             if parent_id < 0:
                 raise ValueError()
         except ValueError:
-            raise ManifestError('The "parent_id" attribute for a page must be a non-negative integer.')
+            errors.append(ManifestError('The "parent_id" attribute for a page must be a non-negative integer.'))
         except:
             pass
 
@@ -225,7 +726,7 @@ given JSON file with the given absolute path."""
         if 'title' in page_dict.keys():
             title = page_dict['title']
             if not isinstance(title, str):
-                raise ManifestError('The "title" attribute for a page must be a string.')
+                errors.append(ManifestError('The "title" attribute for a page must be a string.'))
 
         # Folder (if given)
         import os.path
@@ -233,80 +734,79 @@ given JSON file with the given absolute path."""
         if 'folder' in page_dict.keys():
             folder_name = page_dict['folder']
             if not isinstance(folder_name, str):
-                raise ManifestError('The "folder" attribute for a page must be a string.')
+                errors.append(ManifestError('The "folder" attribute for a page must be a string.'))
+                return errors
             folder = os.path.join(self.prefix, folder_name) 
-            if not os.path.isdir(folder):
-                raise ManifestError('The page folder %s is not a valid directory.'%folder)
+            if not self._directory.isdir(folder):
+                errors.append(ManifestError('The page folder %s is not a valid directory.'%folder))
+                return errors
 
         # File (if given)
         if 'file' in page_dict.keys():
             file_name = page_dict['file']
             if not isinstance(file_name, str):
-                raise ManifestError('The "file" attribute for a page must be a string.')
-            file_path = os.path.join(folder, file_name) 
-            if not os.path.isfile(file_path):
-                raise ManifestError('The page file %s is not a valid file.'%file_path)
+                errors.append(ManifestError('The "file" attribute for a page must be a string.'))
+            elif page_dict['operation'] != 'delete':
+                file_path = os.path.join(folder, file_name)
+                if not self._directory.isfile(file_path):
+                    errors.append(ManifestError('The page file %s is not a valid file.'%file_path))
 
         # Overwrite directive (only used for create operation)
         if 'overwrite' in page_dict.keys():
             overwrite = page_dict['overwrite']
             if not isinstance(overwrite, bool) and overwrite not in ['true', 'false']:
-                raise ManifestError('The "overwrite" page attribute must be true or false.')
-            overwrite = (overwrite == True) or (overwrite == 'true')
+                errors.append(ManifestError('The "overwrite" page attribute must be true or false.'))
 
         # Images (if given)
         if 'images' in page_dict.keys():
             images = page_dict['images']
             if not isinstance(images, list):
-                raise ManifestError('The "images" attribute for a page must be a list.')
+                errors.append(ManifestError('The "images" attribute for a page must be a list.'))
+                images = []
             for image in images:
                 if not image.lower().endswith('.png') and \
                    not image.lower().endswith('.jpg'):
-                    raise TypeError('Page image %s is not a PNG or JPEG file.'%image)
-                im_file = os.path.join(folder, image)
-                if not os.path.isfile(im_file):
-                    raise FileNotFoundError('Page image %s not found.'%image)
+                    errors.append(TypeError('Page image %s is not a PNG or JPEG file.'%image))
+                    continue
+                if not self._has_asset(page_dict, folder, image):
+                    errors.append(FileNotFoundError('Page image %s not found.'%image))
 
         # Attachments (if given)
         if 'attachments' in page_dict.keys():
             attachments = page_dict['attachments']
             if not isinstance(attachments, list):
-                raise ManifestError('The "attachments" attribute for a page must be a list.')
+                errors.append(ManifestError('The "attachments" attribute for a page must be a list.'))
+                attachments = []
             for attach in attachments:
-                a_file = os.path.join(folder, attach)
-                if not os.path.isfile(a_file):
-                    raise FileNotFoundError('Page attachment %s not found.'%attach)
+                if not self._has_asset(page_dict, folder, attach):
+                    errors.append(FileNotFoundError('Page attachment %s not found.'%attach))
+        return errors
+
+    def _has_asset(self, page_dict, folder, filename):
+        """Returns True if the given image or attachment of the given page is there."""
+        if self.archive is not None:
+            return self._asset(page_dict, folder, filename) is not None
+        return self._directory.isfile(self._asset(page_dict, folder, filename))
 
     def parse_page_body(self, page_file, 
                         table_of_contents = None, 
                         auto_gen = None):
         """manifest.parse_page_body(page_file, table_of_contents = None, auto_gen = None) -> (title, body)
 Parse the page file and extract the page's title and body separately."""
-        lines = self._read_lines(page_file)
-
-        # Fetch the title from the lines.
-        title = 'Untitled'
-        for i in range(len(lines)):
-            if lines[i].startswith('# '):
-                title = lines[i].replace('# ', '').strip()
-                break
-
-        # Removing a part between '---' from Jekyll-formatted markdown file.
-        # Otherwise, throws an exception and print out a message
-        try:
-            first_occurrence = lines.index('---\n')
-            last_occurrence = len(lines) - lines[::-1].index('---\n') - 1
-            for index in range(first_occurrence, last_occurrence + 1):
-                lines.pop(first_occurrence)
-        except ValueError as e:
-            print(e)
-
-        # Now convert the Markdown content to Confluence XHTML.
-        from metro.markdown_to_xhtml import markdown_to_xhtml
-        body = markdown_to_xhtml(title, ''.join(lines), 
-                                 table_of_contents = table_of_contents, 
-                                 auto_gen = auto_gen)
-        return (title, body)
+        return self.render_page_body(PageSource(self._page_file(page_file)), 
+                                     table_of_contents = table_of_contents,
+                                     auto_gen = auto_gen)
+
+    def render_page_body(self, source, 
+                         table_of_contents = None, 
+                         auto_gen = None):
+        """manifest.render_page_body(source, table_of_contents = None, auto_gen = None) -> (title, body)
+Converts the Markdown in the given PageSource to Confluence XHTML, returning 
+its title and body."""
+        if not source.has_dashes:
+            _log_missing_front_matter(source.filename)
+        body = _convert(source, table_of_contents, auto_gen, self.render_cache)
+        return (source.title, body)
 
     def __str__(self):
         """String representation of a Manifest."""
@@ -337,42 +837,6 @@ Parse the page file and extract the page's title and body separately."""
 	
 
     def _evaluate_front_matter(self, markdown_file):
-        # Jekyll-formatted markdown documents have a section of front matter at the top with three dashes.
-        # ---
-        # title: SQL Support Summary
-        # excerpt: SDB SQL support as compared to PostgreSQL
-        # toc: false
-        # tags: [dml,ddl,queries]
-        # ---
-        # We want to recognize each value inside dashes.
-        inside_dash = False
-        lines = self._read_lines(markdown_file)
-        
-        front_matter = {}
-        for i in range(len(lines)):
-            if lines[i].startswith('---'):
-                inside_dash = not inside_dash
-            elif lines[i].startswith('title: '):
-                front_matter['title'] = lines[i].replace('title: ', '').strip()
-            elif lines[i].startswith('excerpt: '):
-                front_matter['excerpt'] = lines[i].replace('excerpt: ', '').strip()
-            elif lines[i].startswith('toc: '):
-                front_matter['toc'] = lines[i].replace('toc: ', '').strip()
-            elif lines[i].startswith('tags: '):
-                front_matter['tags'] = lines[i].replace('tags: ', '').strip()
-            elif lines[i].startswith('---') and inside_dash:
-                break
-        return front_matter
-        
-    def _read_lines(self, file_to_read):
-        # Try utf-8 encoding first.
-        with open(file_to_read, mode='r', encoding='utf-8') as f:
-            try:
-                lines = f.readlines()
-            except UnicodeDecodeError:
-                # Drat. Must be regular ASCII. Quip does this.
-                f.close()
-                with open(file_to_read, mode='r', encoding='latin-1') as f:
-                    lines = f.readlines()
-        return lines
-
+        # Jekyll-formatted markdown documents have a section of front matter 
+        # at the top with three dashes. See PageSource.
+        return PageSource(self._page_file(markdown_file)).front_matter
@@ -0,0 +1,97 @@
+# Copyright (c) 2019, salesforce.com, inc.
+# All rights reserved.
+# SPDX-License-Identifier: BSD-3-Clause
+# For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+
+class MultipartStream(object):
+    """MultipartStream: a multipart/form-data request body that is read a
+chunk at a time, so that files of any size can be uploaded without being
+loaded into memory. Pass it as the data of a request, along with its
+content_type as the Content-Type header."""
+
+    # How much of a file we read at a time.
+    chunk_size = 1 << 16
+
+    def __init__(self, progress = None):
+        """MultipartStream(progress = None) -> new, empty multipart body. If
+given, progress is called as progress(sent, total) each time a chunk of the
+body is read."""
+        import uuid
+        self.boundary = uuid.uuid4().hex
+        self.progress = progress
+        self._parts = [] # (header bytes, source or bytes, size)
+        self._chunks = None
+        self._buffer = bytearray()
+        self._sent = 0
+
+    @property
+    def content_type(self):
+        """The Content-Type header for the body, including its boundary."""
+        return 'multipart/form-data; boundary=%s'%self.boundary
+
+    def _header(self, name, filename = None, content_type = None):
+        disposition = 'form-data; name="%s"'%name
+        if filename is not None:
+            disposition += '; filename="%s"'%filename.replace('"', '%22')
+        header = '--%s\r\nContent-Disposition: %s\r\n'%(self.boundary, disposition)
+        if content_type is not None:
+            header += 'Content-Type: %s\r\n'%content_type
+        return (header + '\r\n').encode('utf-8')
+
+    def add_field(self, name, value):
+        """stream.add_field(name, value) -> Adds a text field to the body."""
+        value = str(value).encode('utf-8')
+        self._parts.append((self._header(name), value, len(value)))
+
+    def add_file(self, name, filename, source, content_type = None):
+        """stream.add_file(name, filename, source, content_type = None)
+Adds a file part with the given filename to the body. Its content is read
+from source (a filename or an ArchiveMember) when the body is sent."""
+        from metro.Archive import file_size
+        self._parts.append((self._header(name, filename, content_type), source, file_size(source)))
+
+    def __len__(self):
+        trailer = len('--%s--\r\n'%self.boundary)
+        return sum(len(header) + size + 2 for (header, source, size) in self._parts) + trailer
+
+    def _generate(self):
+        """Yields the body as a sequence of bytes objects."""
+        from metro.Archive import open_file
+        for (header, source, size) in self._parts:
+            yield header
+            if isinstance(source, bytes):
+                yield source
+            else:
+                with open_file(source) as f:
+                    chunk = f.read(self.chunk_size)
+                    while chunk:
+                        yield chunk
+                        chunk = f.read(self.chunk_size)
+            yield b'\r\n'
+        yield ('--%s--\r\n'%self.boundary).encode('utf-8')
+
+    def read(self, size = -1):
+        """stream.read(size = -1) -> up to size bytes of the body, or the rest of
+it if size is negative. Returns b'' at the end of the body."""
+        if self._chunks is None:
+            self._chunks = self._generate()
+        buf = self._buffer
+        while size < 0 or len(buf) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            buf += chunk
+        if size < 0 or size > len(buf):
+            size = len(buf)
+        data = bytes(buf[:size])
+        del buf[:size]
+        self._sent += len(data)
+        if self.progress is not None and data:
+            self.progress(self._sent, len(self))
+        return data
+
+    def close(self):
+        """stream.close() -> Closes any file the body is being read from."""
+        if self._chunks is not None:
+            self._chunks.close()
+            self._chunks = None
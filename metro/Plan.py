@@ -0,0 +1,285 @@
+# Copyright (c) 2019, salesforce.com, inc.
+# All rights reserved.
+# SPDX-License-Identifier: BSD-3-Clause
+# For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+
+import logging
+logger = logging.getLogger()
+
+from metro.Confluence import Page, page_checksum, sha256_file, attachment_hash_property
+from metro.Archive import ArchiveMember, file_basename
+
+class Plan(object):
+    """Plan: the changes needed to publish a Metro manifest to a Confluence
+server, worked out in advance with a few bulk queries so that they can be
+reviewed, saved as JSON, and carried out later by Publisher.apply without
+looking anything else up.
+
+A plan is a list of steps, each a dict with an 'action' that is one of
+  * 'create': create a new page (under 'parent_id', or under the page
+    created by step 'parent_step')
+  * 'update': replace the title and body of page 'page_id'
+  * 'identical': page 'page_id' is up to date
+  * 'exists': page 'page_id' exists and isn't to be overwritten
+  * 'delete': delete page 'page_id'
+  * 'missing': the page (or its parent) doesn't exist, as explained in
+    'message'
+Steps that create or update pages list their images and attachments under
+'files', each with an 'action' of 'create', 'update' or 'identical'."""
+
+    def __init__(self, server, steps = None):
+        """Plan(server, steps = None) -> new Plan with the given steps for the
+Confluence server with the given URL."""
+        self.server = server
+        self.steps = steps or []
+
+    @classmethod
+    def build(cls, confluence, manifest, parent_id = None, batch_size = 100):
+        """Plan.build(confluence, manifest, parent_id = None, batch_size = 100) -> new Plan
+Works out what it would take to publish the given manifest to the given
+Confluence server. parent_id is used as the parent of pages that don't name
+their own. Remote pages and attachments are fetched with bulk searches for
+batch_size pages at a time."""
+        plan = cls(confluence.base_url)
+        plan._confluence = confluence
+        plan._manifest = manifest if getattr(manifest, 'lazy', False) else None
+        plan._batch_size = batch_size
+        plan._plan_creates(manifest.pages_to_create, parent_id)
+        plan._plan_updates(manifest.pages_to_update)
+        plan._plan_files()
+        plan._plan_deletes(manifest.pages_to_delete)
+        del plan._confluence, plan._manifest, plan._batch_size
+        return plan
+
+    @classmethod
+    def load(cls, plan_file):
+        """Plan.load(plan_file) -> the Plan saved in the JSON file with the given name."""
+        import json
+        with open(plan_file, 'r') as f:
+            data = json.load(f)
+        if not isinstance(data, dict) or 'server' not in data or 'steps' not in data:
+            raise ValueError('%s does not contain a Metro plan.'%plan_file)
+        return cls(data['server'], data['steps'])
+
+    def save(self, plan_file):
+        """plan.save(plan_file) -> Writes the plan to the JSON file with the given name."""
+        import json
+        with open(plan_file, 'w') as f:
+            json.dump(self.to_dict(), f, indent = 1)
+
+    def to_dict(self):
+        """plan.to_dict() -> a dict holding the plan, suitable for JSON."""
+        return {'server': self.server, 'steps': self.steps}
+
+    def _search(self, cql, ids, expand):
+        """Runs the given CQL query (with a %s for a list of IDs) for the given
+IDs, a batch at a time, returning all the results."""
+        ids = sorted(ids)
+        results = []
+        for i in range(0, len(ids), self._batch_size):
+            batch = ids[i:i + self._batch_size]
+            found = self._confluence.search(cql%','.join(str(id) for id in batch), expand = expand)
+            if found is None:
+                raise RuntimeError('Could not search %s for the pages in the manifest.'%self.server)
+            results.extend(found)
+        return results
+
+    def _step(self, action, page, **fields):
+        step = {'step': len(self.steps), 'action': action, 'title': page.title, 'page_id': page.id}
+        step.update(fields)
+        self.steps.append(step)
+        return step
+
+    def _set_content(self, step, page):
+        """Adds the content and files of the given page to the given step.
+Pages are only rendered and their files hashed once we know the step will
+create or update them."""
+        import os.path
+        if self._manifest is not None:
+            self._manifest.render(page)
+        step['checksum'] = page_checksum(page)
+        step['body'] = page.body
+        if self._manifest is not None:
+            self._manifest.release(page)
+        step['files'] = []
+        for source in page.images + page.attachments:
+            f = {'filename': file_basename(source)}
+            if isinstance(source, ArchiveMember):
+                f['archive'] = os.path.abspath(source.archive.filename)
+                f['file'] = source.name
+            else:
+                f['file'] = os.path.abspath(source)
+            f['sha256'] = sha256_file(source)
+            step['files'].append(f)
+
+    def _compare(self, step, page, remote, parent_id):
+        """Decides whether the given step's page, which exists on the server
+with the given info, needs updating. parent_id is None for a page at the top
+of its space."""
+        self._set_content(step, page)
+        step['page_id'] = int(remote['id'])
+        step['parent_id'] = parent_id
+        step['space_key'] = remote['space']['key']
+        step['version'] = int(remote['version']['number'])
+        prop = remote.get('metadata', {}).get('properties', {}).get('checksum')
+        step['remote_checksum'] = None
+        step['checksum_version'] = None
+        if isinstance(prop, dict) and 'value' in prop:
+            step['remote_checksum'] = prop['value']
+            if 'version' in prop:
+                step['checksum_version'] = int(prop['version']['number'])
+        if step['remote_checksum'] == step['checksum']:
+            step['action'] = 'identical'
+        else:
+            step['action'] = 'update'
+
+    def _plan_creates(self, pages, parent_id):
+        """Plans the creation of the given pages, looking up their parents and
+siblings a level of the page tree at a time."""
+        parents = {}  # parent ID -> parent info, or None if it doesn't exist
+        children = {} # parent ID -> {title: child info}
+        steps = {}    # id(Page) -> step
+        pending = []
+        for page in pages:
+            step = self._step(None, page, parent_id = None, parent_step = None)
+            steps[id(page)] = step
+            pending.append((page, step))
+
+        while pending:
+            # Figure out which parents we need to know about.
+            wanted = set()
+            for (page, step) in pending:
+                pid = page.parent_id or parent_id
+                if isinstance(pid, Page):
+                    pid = steps[id(pid)]['page_id']
+                if isinstance(pid, int) and pid not in children:
+                    wanted.add(pid)
+            if wanted:
+                for info in self._search('id in (%s)', wanted, 'space'):
+                    parents[int(info['id'])] = info
+                for pid in wanted:
+                    children[pid] = {}
+                for info in self._search('type = page and parent in (%s)', wanted,
+                                         'ancestors,version,space,metadata.properties.checksum'):
+                    children[int(info['ancestors'][-1]['id'])][info['title']] = info
+
+            # Settle every page whose parent we now know about.
+            still_pending = []
+            for (page, step) in pending:
+                pid = page.parent_id or parent_id
+                if isinstance(pid, Page):
+                    parent = steps[id(pid)]
+                    if parent['action'] is None or (parent['page_id'] is not None and parent['page_id'] not in children):
+                        still_pending.append((page, step))
+                        continue
+                    if parent['action'] == 'create':
+                        step.update(action = 'create', parent_step = parent['step'],
+                                    space_key = parent['space_key'])
+                        self._set_content(step, page)
+                        continue
+                    if parent['page_id'] is None:
+                        step.update(action = 'missing', message = 'parent page "%s" will not exist'%parent['title'])
+                        continue
+                    pid = parent['page_id']
+                if pid is None:
+                    step.update(action = 'missing', message = 'no parent page given')
+                elif parents.get(pid) is None:
+                    step.update(action = 'missing', message = 'parent page %i not found'%pid)
+                elif page.title in children[pid]:
+                    remote = children[pid][page.title]
+                    if page.overwrite:
+                        self._compare(step, page, remote, pid)
+                    else:
+                        step.update(action = 'exists', page_id = int(remote['id']), parent_id = pid)
+                else:
+                    step.update(action = 'create', parent_id = pid,
+                                space_key = parents[pid]['space']['key'])
+                    self._set_content(step, page)
+            if len(still_pending) == len(pending) and not wanted:
+                raise RuntimeError('Could not work out the parents of the pages in the manifest.')
+            pending = still_pending
+
+    def _plan_updates(self, pages):
+        """Plans the updates of the given pages."""
+        remote = {}
+        for info in self._search('id in (%s)', set(page.id for page in pages),
+                                 'ancestors,version,space,metadata.properties.checksum'):
+            remote[int(info['id'])] = info
+        for page in pages:
+            info = remote.get(page.id)
+            if info is None:
+                self._step('missing', page, message = 'page %i not found'%page.id)
+                continue
+            # A page at the top of its space has no parent.
+            parent_id = int(info['ancestors'][-1]['id']) if info['ancestors'] else None
+            self._compare(self._step(None, page), page, info, parent_id)
+
+    def _plan_files(self):
+        """Plans the uploads of the images and attachments of pages that
+already exist."""
+        existing = [step for step in self.steps
+                    if step['action'] in ('update', 'identical') and step['files']]
+        remote = {}
+        for info in self._search('type = attachment and container in (%s)',
+                                 set(step['page_id'] for step in existing),
+                                 'version,container,metadata.properties.sha256'):
+            remote[(int(info['container']['id']), info['title'])] = info
+        for step in self.steps:
+            for f in step.get('files', []):
+                info = remote.get((step['page_id'], f['filename']))
+                if info is None:
+                    f['action'] = 'create'
+                    continue
+                f['attach_id'] = info['id']
+                f['remote_sha256'] = None
+                f['hash_version'] = None
+                prop = attachment_hash_property(info)
+                if prop is not None:
+                    f['remote_sha256'] = prop['value']
+                    if 'version' in prop:
+                        f['hash_version'] = int(prop['version']['number'])
+                # Attachments without a recorded hash are replaced.
+                f['action'] = 'identical' if f['remote_sha256'] == f['sha256'] else 'update'
+
+    def _plan_deletes(self, pages):
+        """Plans the deletions of the given pages."""
+        remote = {}
+        for info in self._search('id in (%s)', set(page.id for page in pages), None):
+            remote[int(info['id'])] = info
+        for page in pages:
+            if page.id in remote:
+                step = self._step('delete', page)
+                step['title'] = remote[page.id]['title']
+            else:
+                self._step('missing', page, message = 'page %i not found'%page.id)
+
+    def __str__(self):
+        """String representation of a Plan."""
+        s = 'Metro Plan for %s:\n\n'%self.server
+        counts = {}
+        uploads = 0
+        for step in self.steps:
+            counts[step['action']] = counts.get(step['action'], 0) + 1
+            if step['title'] is not None:
+                name = '"%s"'%step['title']
+                if step['page_id'] is not None:
+                    name += ' (id = %i)'%step['page_id']
+            else:
+                name = '(id = %s)'%step['page_id']
+            s += ' %-9s %s'%(step['action'], name)
+            if step['action'] == 'create':
+                if step['parent_step'] is not None:
+                    s += ' under "%s"'%self.steps[step['parent_step']]['title']
+                else:
+                    s += ' under page %i'%step['parent_id']
+            if step.get('message'):
+                s += ': %s'%step['message']
+            s += '\n'
+            for f in step.get('files', []):
+                if f['action'] != 'identical':
+                    s += '   %-7s %s\n'%(f['action'], f['filename'])
+                    uploads += 1
+        s += '\n%i steps: %s\n'%(len(self.steps),
+                                 ', '.join('%i %s'%(counts[k], k) for k in sorted(counts.keys())))
+        s += '%i file(s) to upload\n'%uploads
+        return s
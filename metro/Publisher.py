@@ -0,0 +1,351 @@
+# Copyright (c) 2019, salesforce.com, inc.
+# All rights reserved.
+# SPDX-License-Identifier: BSD-3-Clause
+# For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+
+import logging
+logger = logging.getLogger()
+
+from metro.Confluence import Page, page_checksum, sha256_file
+from metro.Archive import file_basename
+
+class PublishResult(object):
+    """PublishResult: the outcome of a single page operation run by a Publisher."""
+
+    def __init__(self, operation, page):
+        self.operation = operation
+        self.page = page
+        self.status = 'pending'
+        self.message = None
+        self.elapsed = 0.0
+        self.requests = 0
+        self.step = None
+
+    @property
+    def name(self):
+        """A human-readable name for the page this result refers to."""
+        if self.page.title is None:
+            return '(id = %s)'%self.page.id
+        name = '"%s"'%self.page.title
+        if self.page.id is not None:
+            name += ' (id = %i)'%self.page.id
+        return name
+
+    def __str__(self):
+        """String representation of a PublishResult."""
+        s = '%-7s %-9s %s [%.2fs, %i requests]'%(self.operation, self.status, self.name,
+                                                  self.elapsed, self.requests)
+        if self.message:
+            s += ': %s'%self.message
+        return s
+
+class Publisher(object):
+    """Publisher: runs the operations of a Metro manifest against a Confluence
+server, publishing independent pages concurrently."""
+
+    def __init__(self, confluence, jobs = 1, state = None):
+        """Publisher(confluence, jobs = 1, state = None) -> new Publisher that sends 
+pages to the given Confluence server using at most the given number of 
+concurrent jobs. If state is a SyncState, pages it records as already 
+published with the same content are skipped without contacting the server, 
+and the state is updated with every page that is published."""
+        if not isinstance(jobs, int) or jobs < 1:
+            raise ValueError('jobs must be a positive integer.')
+        self.confluence = confluence
+        self.jobs = jobs
+        self.state = state
+        self.manifest = None
+        self.results = []
+
+    def publish(self, manifest, parent_id = None):
+        """publisher.publish(manifest, parent_id = None) -> list of PublishResults
+Creates, updates and deletes the pages in the given manifest. Pages created
+under another page of the same manifest wait for their parent to be
+created; everything else runs as soon as a worker is free. If parent_id
+is given, it is used as the parent of pages that don't name their own.
+Deletions run after all creations and updates have finished. The pages of a 
+lazy manifest are rendered just before they're published, and released after. 
+Pages the manifest found unchanged since the last run are reported as such."""
+        self.results = []
+        self.manifest = manifest if getattr(manifest, 'lazy', False) else None
+        for page in getattr(manifest, 'pages_unchanged', []):
+            result = self._task('skip', page)[0]
+            result.status = 'unchanged'
+            result.message = 'inputs unchanged since the last run'
+
+        # Build the dependency graph: a page created under another Page in
+        # this manifest can't be created until its parent has an ID.
+        tasks = []
+        dependents = {}
+        for page in manifest.pages_to_create:
+            task = self._task('create', page, parent_id)
+            if isinstance(page.parent_id, Page):
+                dependents.setdefault(id(page.parent_id), []).append(task)
+            else:
+                tasks.append(task)
+        for page in manifest.pages_to_update:
+            tasks.append(self._task('update', page))
+        self._run(tasks, dependents)
+
+        # Deletions go last, since they may remove pages the other
+        # operations refer to.
+        tasks = [self._task('delete', page) for page in manifest.pages_to_delete]
+        self._run(tasks, {})
+
+        return self.results
+
+    def apply(self, plan):
+        """publisher.apply(plan) -> list of PublishResults
+Carries out the steps of the given Plan, without looking anything up on the 
+server first. Pages created under another page created by the plan wait for 
+their parent; everything else runs as soon as a worker is free. Deletions run 
+after everything else has finished. Steps fail if the server has changed in 
+the meantime, in which case a new plan should be made."""
+        if plan.server != self.confluence.base_url:
+            raise RuntimeError('The plan is for %s, not %s.'%(plan.server, self.confluence.base_url))
+        self.results = []
+        self.manifest = None
+
+        # Images and attachments may come from zip files.
+        from metro.Archive import Archive
+        self._archives = {}
+        for step in plan.steps:
+            for f in step.get('files', []):
+                if 'archive' in f and f['archive'] not in self._archives:
+                    self._archives[f['archive']] = Archive(f['archive'])
+
+        pages = {}
+        tasks = []
+        dependents = {}
+        deletions = []
+        for step in plan.steps:
+            page = Page(title = step.get('title'), body = step.get('body'), page_id = step.get('page_id'))
+            page.space_key = step.get('space_key')
+            page.version = step.get('version')
+            pages[step['step']] = page
+            task = self._task(step['action'], page)
+            task[0].step = step
+            if step['action'] == 'delete':
+                deletions.append(task)
+            elif step.get('parent_step') is not None:
+                page.parent_id = pages[step['parent_step']]
+                dependents.setdefault(id(page.parent_id), []).append(task)
+            else:
+                tasks.append(task)
+        try:
+            self._run(tasks, dependents)
+            self._run(deletions, {})
+        finally:
+            for archive in self._archives.values():
+                archive.close()
+        return self.results
+
+    def report(self):
+        """publisher.report() -> a string summarizing the outcome of each page
+operation in the last call to publish."""
+        s = 'Metro Publishing Report:\n\n'
+        counts = {}
+        for result in self.results:
+            s += ' %s\n'%result
+            counts[result.status] = counts.get(result.status, 0) + 1
+        s += '\n%i operations: %s\n'%(len(self.results),
+                                      ', '.join('%i %s'%(counts[k], k) for k in sorted(counts.keys())))
+        return s
+
+    @property
+    def failed(self):
+        """A list of results for operations that failed or were skipped."""
+        return [r for r in self.results if r.status in ('failed', 'skipped')]
+
+    def _task(self, operation, page, parent_id = None):
+        result = PublishResult(operation, page)
+        self.results.append(result)
+        return (result, parent_id)
+
+    def _run(self, tasks, dependents):
+        """Runs the given tasks on a bounded pool of workers, scheduling each
+task's dependents once it has finished."""
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+        with ThreadPoolExecutor(max_workers = self.jobs) as executor:
+            running = {}
+            for task in tasks:
+                running[executor.submit(self._execute, *task)] = task
+            while running:
+                done, _ = wait(running.keys(), return_when = FIRST_COMPLETED)
+                for future in done:
+                    result, parent_id = running.pop(future)
+                    future.result() # Re-raise anything _execute didn't handle.
+                    children = dependents.pop(id(result.page), [])
+                    if result.page.id is not None:
+                        # The parent exists (whether or not we just created
+                        # it), so its children can go now.
+                        for child in children:
+                            running[executor.submit(self._execute, *child)] = child
+                    else:
+                        self._skip(children, dependents, result.page)
+
+    def _skip(self, tasks, dependents, parent):
+        """Marks the given tasks and all of their descendants as skipped."""
+        for (result, parent_id) in tasks:
+            result.status = 'skipped'
+            result.message = 'parent page "%s" was not published'%parent.title
+            logging.info('Skipped page %s: %s'%(result.name, result.message))
+            self._skip(dependents.pop(id(result.page), []), dependents, result.page)
+
+    def _parent_id(self, page, parent_id):
+        """Returns the ID of the page under which the given page is created."""
+        pid = page.parent_id or parent_id
+        if isinstance(pid, Page):
+            pid = pid.id
+        return pid
+
+    def _unchanged(self, result, parent_id):
+        """Returns True if the state records the page in the given result as
+already published with the same title, body and attachments, in which case
+the page is fleshed out from the state and the result marked accordingly."""
+        page = result.page
+        server = self.confluence.base_url
+        if result.operation == 'create':
+            record = self.state.lookup(server, self._parent_id(page, parent_id), page.title)
+            if record is not None and not page.overwrite:
+                # The page exists, and we wouldn't touch it anyway.
+                page.id = record.page_id
+                result.status = 'exists'
+                return True
+        else:
+            record = self.state.find(server, page.id)
+        if record is None or record.checksum != page_checksum(page):
+            return False
+
+        hashes = self.state.attachments(server, record.page_id)
+        for filename in page.images + page.attachments:
+            known = hashes.get(file_basename(filename))
+            if known is None or known[0] != sha256_file(filename):
+                return False
+
+        page.id = record.page_id
+        page.space_key = record.space_key
+        page.version = record.version
+        page.checksum = record.checksum
+        page.view_url = '%s%s'%(self.confluence.view_url, page.id)
+        result.status = 'unchanged'
+        logging.info('Did not publish page %s (unchanged since last run)'%result.name)
+        return True
+
+    def _record(self, result, parent_id):
+        """Records the outcome of the given successful operation in the state."""
+        page = result.page
+        server = self.confluence.base_url
+        if result.operation == 'delete':
+            self.state.forget(server, page.id)
+            return
+        if page.version is None or page.checksum is None:
+            return
+        pid = None
+        if result.operation == 'create':
+            pid = self._parent_id(page, parent_id)
+        # Only attachments the server has confirmed are recorded, so a failed
+        # upload is retried next time.
+        self.state.record(server, page, pid, self.confluence.attachment_hashes(page.id))
+
+    def _apply(self, result):
+        """Carries out the plan step for the given result."""
+        step = result.step
+        page = result.page
+        action = step['action']
+        if action == 'missing':
+            result.status = 'failed'
+            result.message = step.get('message')
+            return
+        elif action == 'exists':
+            result.status = 'exists'
+            return
+        elif action == 'create':
+            parent_id = step.get('parent_id')
+            if step.get('parent_step') is not None:
+                parent_id = page.parent_id.id
+            ok = self.confluence.post_page(parent_id, step['space_key'], page)
+        elif action == 'update':
+            prop = None
+            if step.get('remote_checksum') is not None:
+                prop = {}
+                if step.get('checksum_version') is not None:
+                    prop['version'] = {'number': step['checksum_version']}
+            ok = self.confluence.put_page(page, step['parent_id'], prop)
+        elif action == 'delete':
+            ok = self.confluence.delete_page(page.id)
+        else: # action == 'identical'
+            ok = True
+        if not ok:
+            result.status = 'failed'
+            return
+
+        # Upload any new or changed files.
+        problems = []
+        uploads = 0
+        for f in step.get('files', []):
+            if f['action'] == 'identical':
+                continue
+            if 'archive' in f:
+                source = self._archives[f['archive']].member(f['file'])
+            else:
+                source = f['file']
+            if source is None or sha256_file(source) != f['sha256']:
+                problems.append('%s has changed since the plan was made'%f['filename'])
+                continue
+            prop = None
+            if f.get('remote_sha256') is not None:
+                prop = {}
+                if f.get('hash_version') is not None:
+                    prop['version'] = {'number': f['hash_version']}
+            attach_info = self.confluence.post_attachment(page.id, f['filename'], source,
+                                                          attach_id = f.get('attach_id'),
+                                                          digest = f['sha256'], prop = prop)
+            if attach_info is None:
+                problems.append('could not upload %s'%f['filename'])
+            uploads += 1
+        if problems:
+            result.status = 'failed'
+            result.message = '; '.join(problems)
+        elif action == 'identical' and uploads == 0:
+            result.status = 'unchanged'
+        else:
+            result.status = 'done'
+
+    def _execute(self, result, parent_id):
+        """Runs a single page operation, recording its outcome in result."""
+        import time
+        start = time.time()
+        start_count = self.confluence.request_count()
+        page = result.page
+        try:
+            if self.manifest is not None and result.operation != 'delete':
+                self.manifest.render(page)
+            if result.step is not None:
+                self._apply(result)
+            elif self.state is not None and result.operation != 'delete' and \
+               self._unchanged(result, parent_id):
+                pass
+            elif result.operation == 'create':
+                if self.confluence.create_page(parent_id, page):
+                    result.status = 'done'
+                elif page.id is not None:
+                    result.status = 'exists'
+                else:
+                    result.status = 'failed'
+            elif result.operation == 'update':
+                ok = self.confluence.update_page(page.id, page)
+                result.status = 'done' if ok else 'failed'
+            else: # result.operation == 'delete'
+                ok = self.confluence.delete_page(page.id)
+                result.status = 'done' if ok else 'failed'
+            if self.state is not None and result.status == 'done':
+                self._record(result, parent_id)
+        except Exception as e:
+            result.status = 'failed'
+            result.message = str(e)
+            logging.info('Could not %s page %s: %s'%(result.operation, result.name, e))
+        if self.manifest is not None:
+            self.manifest.release(page)
+        result.elapsed = time.time() - start
+        result.requests = self.confluence.request_count() - start_count
@@ -0,0 +1,163 @@
+# Copyright (c) 2019, salesforce.com, inc.
+# All rights reserved.
+# SPDX-License-Identifier: BSD-3-Clause
+# For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+
+import logging
+logger = logging.getLogger()
+
+class RenderCache(object):
+    """RenderCache: an on-disk cache of the Confluence XHTML converted from
+Markdown, so that pages that haven't changed aren't converted again.
+
+Bodies are stored in files named for the SHA-256 hash of the page's title,
+Markdown and conversion options, along with a stamp identifying the converter
+(its source and the versions of markdown and bleach), so that upgrading
+either invalidates the cache. When the cache grows past its maximum size, the
+least recently used bodies are removed. RenderCache objects can be passed to
+other processes, each of which keeps its own tally of the cache's size."""
+
+    # The default maximum size of the cache in bytes.
+    default_max_size = 256 << 20
+
+    _stamp = None
+
+    def __init__(self, path = None, max_size = None):
+        """RenderCache(path = None, max_size = None) -> new RenderCache kept in
+the folder with the given path (by default, metro/render in the user's cache
+folder), which is created if it doesn't exist. The cache is kept under
+max_size bytes."""
+        import os, os.path
+        if path is None:
+            cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+            path = os.path.join(cache_home, 'metro', 'render')
+        self.path = path
+        self.max_size = max_size or self.default_max_size
+        self._size = None # Bytes in the cache, counted when we first add to it.
+        os.makedirs(path, exist_ok = True)
+
+    @classmethod
+    def stamp(cls):
+        """RenderCache.stamp() -> a string identifying the Markdown converter,
+which changes whenever it or the packages it uses do."""
+        if cls._stamp is None:
+            import hashlib, os.path
+            from importlib.metadata import version, PackageNotFoundError
+            h = hashlib.sha256()
+            with open(os.path.join(os.path.dirname(__file__), 'markdown_to_xhtml.py'), 'rb') as f:
+                h.update(f.read())
+            for package in ['markdown', 'bleach']:
+                try:
+                    h.update(('%s %s\n'%(package, version(package))).encode('utf-8'))
+                except PackageNotFoundError:
+                    h.update(('%s unknown\n'%package).encode('utf-8'))
+            cls._stamp = h.hexdigest()
+        return cls._stamp
+
+    def key(self, title, markdown, table_of_contents = None, auto_gen = None):
+        """cache.key(title, markdown, table_of_contents = None, auto_gen = None) -> key
+Returns the key under which the body converted from the given page content
+with the given options is cached."""
+        import hashlib, json
+        h = hashlib.sha256()
+        h.update(json.dumps([self.stamp(), title, table_of_contents, auto_gen],
+                            sort_keys = True).encode('utf-8'))
+        h.update(b'\0')
+        h.update(markdown.encode('utf-8', 'surrogatepass'))
+        return h.hexdigest()
+
+    def _file(self, key):
+        import os.path
+        return os.path.join(self.path, key[:2], key[2:] + '.xhtml')
+
+    def get(self, key):
+        """cache.get(key) -> the body cached under the given key, or None if
+there isn't one."""
+        import os
+        filename = self._file(key)
+        try:
+            with open(filename, 'rb') as f:
+                body = f.read().decode('utf-8')
+            # Mark the body as recently used.
+            os.utime(filename)
+        except FileNotFoundError:
+            return None
+        except (OSError, UnicodeDecodeError) as e:
+            logging.info('Could not read %s from the render cache: %s'%(key, e))
+            return None
+        return body
+
+    def put(self, key, body):
+        """cache.put(key, body) -> Caches the given body under the given key,
+making room for it if need be."""
+        import os, os.path, tempfile
+        filename = self._file(key)
+        data = body.encode('utf-8')
+        try:
+            os.makedirs(os.path.dirname(filename), exist_ok = True)
+            # Write the body under a temporary name so that no one ever
+            # reads half of it.
+            (fd, temp_name) = tempfile.mkstemp(dir = os.path.dirname(filename), suffix = '.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(temp_name, filename)
+        except OSError as e:
+            logging.info('Could not write %s to the render cache: %s'%(key, e))
+            return
+        if self._size is None:
+            self._size = self.size()
+        else:
+            self._size += len(data)
+        if self._size > self.max_size:
+            self.evict()
+
+    def _entries(self):
+        """Returns a list of (mtime, size, filename) tuples for the bodies in
+the cache."""
+        import os
+        entries = []
+        for folder in os.scandir(self.path):
+            if not folder.is_dir():
+                continue
+            for entry in os.scandir(folder.path):
+                if entry.name.endswith('.xhtml'):
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+        return entries
+
+    def size(self):
+        """cache.size() -> the number of bytes of bodies in the cache."""
+        return sum(size for (mtime, size, filename) in self._entries())
+
+    def evict(self):
+        """cache.evict() -> Removes the least recently used bodies until the
+cache is at most three quarters of its maximum size."""
+        import os
+        entries = sorted(self._entries())
+        size = sum(size for (mtime, size, filename) in entries)
+        target = self.max_size * 3 // 4
+        removed = 0
+        for (mtime, entry_size, filename) in entries:
+            if size <= target:
+                break
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+            removed += 1
+        self._size = size
+        logging.info('Removed %i page(s) from the render cache in %s.'%(removed, self.path))
+
+    def clear(self):
+        """cache.clear() -> Removes everything from the cache."""
+        import os
+        for (mtime, size, filename) in self._entries():
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+        self._size = 0
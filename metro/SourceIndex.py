@@ -0,0 +1,81 @@
+# Copyright (c) 2019, salesforce.com, inc.
+# All rights reserved.
+# SPDX-License-Identifier: BSD-3-Clause
+# For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+
+import logging
+logger = logging.getLogger()
+
+class SourceIndex(object):
+    """SourceIndex: a JSON file recording fingerprints of the inputs of the
+pages in a manifest (the page file, its images and attachments, and its entry
+in the manifest) as of the last run that published them, along with the
+pages' IDs and titles. A Manifest given a SourceIndex skips the pages whose
+inputs haven't changed without reading them.
+
+A file's fingerprint is its path, size and modification time, plus its
+SHA-256 hash if hashes is True; files in zip archives are fingerprinted with
+their size and CRC. Fingerprints also cover the Markdown converter (see
+RenderCache.stamp), so that pages are converted again when it changes.
+Entries are kept separately for each Confluence server and manifest."""
+
+    def __init__(self, path, server, hashes = False):
+        """SourceIndex(path, server, hashes = False) -> new SourceIndex stored
+in the JSON file with the given path, which is created when the index is
+saved, for pages published to the Confluence server with the given URL. If
+hashes is True, files are hashed as well as stat'ed."""
+        import json, os.path
+        self.path = path
+        self.server = server
+        self.hashes = hashes
+        self._data = {'servers': {}}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                data = json.load(f)
+            if not isinstance(data, dict) or not isinstance(data.get('servers'), dict):
+                raise ValueError('%s does not contain a Metro source index.'%path)
+            self._data = data
+        self._manifests = self._data['servers'].setdefault(server, {})
+
+    def fingerprint(self, page_dict, sources):
+        """index.fingerprint(page_dict, sources) -> fingerprint
+Returns the fingerprint of a page with the given manifest entry whose inputs
+are the given sources (filenames or ArchiveMembers)."""
+        import hashlib, json, os
+        from metro.Archive import ArchiveMember
+        from metro.RenderCache import RenderCache
+        files = []
+        for source in sources:
+            if isinstance(source, ArchiveMember):
+                files.append([source.name, source.size, source.info.CRC])
+                continue
+            st = os.stat(source)
+            entry = [source, st.st_size, st.st_mtime_ns]
+            if self.hashes:
+                from metro.Confluence import sha256_file
+                entry.append(sha256_file(source))
+            files.append(entry)
+        # Where the page goes is part of its key, not its fingerprint.
+        options = dict((k, v) for (k, v) in page_dict.items() if k not in ['children', 'parent_id'])
+        data = json.dumps([RenderCache.stamp(), options, files], sort_keys = True, default = str)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def entries(self, manifest):
+        """index.entries(manifest) -> a dict mapping the keys of the pages
+recorded for the manifest with the given name to dicts with their
+'fingerprint', 'page_id' and 'title'."""
+        return self._manifests.get(manifest, {})
+
+    def replace(self, manifest, entries):
+        """index.replace(manifest, entries) -> Replaces the pages recorded for
+the manifest with the given name with the given entries."""
+        self._manifests[manifest] = entries
+
+    def save(self):
+        """index.save() -> Writes the index to its file."""
+        import json, os, os.path, tempfile
+        folder = os.path.dirname(os.path.abspath(self.path))
+        (fd, temp_name) = tempfile.mkstemp(dir = folder, suffix = '.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self._data, f, indent = 1, sort_keys = True)
+        os.replace(temp_name, self.path)
@@ -0,0 +1,211 @@
+# Copyright (c) 2019, salesforce.com, inc.
+# All rights reserved.
+# SPDX-License-Identifier: BSD-3-Clause
+# For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+
+import logging
+logger = logging.getLogger()
+
+class PageRecord(object):
+    """PageRecord: what a SyncState remembers about a page Metro has published."""
+
+    def __init__(self, server, page_id, parent_id, title, space_key, version, checksum):
+        self.server = server
+        self.page_id = page_id
+        self.parent_id = parent_id
+        self.title = title
+        self.space_key = space_key
+        self.version = version
+        self.checksum = checksum
+
+class SyncState(object):
+    """SyncState: a local SQLite database recording the state of the pages and
+attachments Metro has published, so that unchanged pages can be skipped on
+later runs without asking Confluence about them.
+
+Pages are recorded by server and ID, and can be looked up by server, parent
+ID and title (which also determines the space). For each page we keep its
+version, the checksum of its title and body, and the SHA-256 hash and version
+of each of its attachments. SyncState objects can be shared between threads."""
+
+    _schema = """
+CREATE TABLE IF NOT EXISTS pages (
+    server TEXT NOT NULL,
+    page_id INTEGER NOT NULL,
+    parent_id INTEGER,
+    title TEXT NOT NULL,
+    space_key TEXT,
+    version INTEGER NOT NULL,
+    checksum TEXT NOT NULL,
+    PRIMARY KEY (server, page_id)
+);
+CREATE UNIQUE INDEX IF NOT EXISTS pages_by_title ON pages (server, parent_id, title);
+CREATE TABLE IF NOT EXISTS attachments (
+    server TEXT NOT NULL,
+    page_id INTEGER NOT NULL,
+    filename TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    PRIMARY KEY (server, page_id, filename)
+);
+"""
+
+    def __init__(self, path):
+        """SyncState(path) -> new SyncState stored in the SQLite database at the
+given path, which is created if it doesn't exist."""
+        import sqlite3, threading
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread = False)
+        self._db.execute('PRAGMA journal_mode = WAL')
+        self._db.execute('PRAGMA synchronous = NORMAL')
+        self._db.executescript(self._schema)
+        self._db.commit()
+
+    def close(self):
+        """state.close() -> Closes the underlying database."""
+        with self._lock:
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _record(self, row):
+        if row is None:
+            return None
+        return PageRecord(*row)
+
+    def find(self, server, page_id):
+        """state.find(server, page_id) -> the PageRecord for the page with the
+given ID on the given server, or None if it hasn't been recorded."""
+        with self._lock:
+            row = self._db.execute('SELECT server, page_id, parent_id, title, space_key, version, checksum '
+                                   'FROM pages WHERE server = ? AND page_id = ?',
+                                   (server, page_id)).fetchone()
+        return self._record(row)
+
+    def lookup(self, server, parent_id, title):
+        """state.lookup(server, parent_id, title) -> the PageRecord for the page
+with the given title under the parent with the given ID on the given server,
+or None if it hasn't been recorded."""
+        with self._lock:
+            row = self._db.execute('SELECT server, page_id, parent_id, title, space_key, version, checksum '
+                                   'FROM pages WHERE server = ? AND parent_id = ? AND title = ?',
+                                   (server, parent_id, title)).fetchone()
+        return self._record(row)
+
+    def pages(self, server):
+        """state.pages(server) -> a list of PageRecords for all pages recorded
+for the given server."""
+        with self._lock:
+            rows = self._db.execute('SELECT server, page_id, parent_id, title, space_key, version, checksum '
+                                    'FROM pages WHERE server = ? ORDER BY page_id',
+                                    (server,)).fetchall()
+        return [self._record(row) for row in rows]
+
+    def attachments(self, server, page_id):
+        """state.attachments(server, page_id) -> a dict mapping the filenames of
+the recorded attachments of the given page to (sha256, version) tuples."""
+        with self._lock:
+            rows = self._db.execute('SELECT filename, sha256, version FROM attachments '
+                                    'WHERE server = ? AND page_id = ?',
+                                    (server, page_id)).fetchall()
+        return dict((filename, (sha256, version)) for (filename, sha256, version) in rows)
+
+    def record(self, server, page, parent_id = None, attachments = {}):
+        """state.record(server, page, parent_id = None, attachments = {})
+Records the given page, just published to the given server, along with a dict
+mapping the filenames of its attachments to (sha256, version) tuples. The
+page's id, version, space_key and checksum must be set. If parent_id is None,
+any parent ID already recorded for the page is kept."""
+        with self._lock, self._db:
+            if parent_id is not None:
+                # Another page may have had this title under this parent
+                # before someone deleted it.
+                self._db.execute('DELETE FROM pages WHERE server = ? AND parent_id = ? AND title = ? AND page_id != ?',
+                                 (server, parent_id, page.title, page.id))
+            self._db.execute('INSERT INTO pages (server, page_id, parent_id, title, space_key, version, checksum) '
+                             'VALUES (?, ?, ?, ?, ?, ?, ?) '
+                             'ON CONFLICT (server, page_id) DO UPDATE SET '
+                             'parent_id = coalesce(excluded.parent_id, pages.parent_id), '
+                             'title = excluded.title, space_key = excluded.space_key, '
+                             'version = excluded.version, checksum = excluded.checksum',
+                             (server, page.id, parent_id, page.title, page.space_key,
+                              int(page.version), page.checksum))
+            self._db.execute('DELETE FROM attachments WHERE server = ? AND page_id = ?',
+                             (server, page.id))
+            self._db.executemany('INSERT INTO attachments (server, page_id, filename, sha256, version) '
+                                 'VALUES (?, ?, ?, ?, ?)',
+                                 [(server, page.id, filename, sha256, version)
+                                  for filename, (sha256, version) in attachments.items()])
+
+    def forget(self, server, page_id):
+        """state.forget(server, page_id) -> Removes the page with the given ID
+and its attachments from the state, so that it's checked with the server
+the next time it's published."""
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM pages WHERE server = ? AND page_id = ?', (server, page_id))
+            self._db.execute('DELETE FROM attachments WHERE server = ? AND page_id = ?', (server, page_id))
+
+    def forget_attachment(self, server, page_id, filename):
+        """state.forget_attachment(server, page_id, filename) -> Removes the
+attachment with the given filename on the given page from the state."""
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM attachments WHERE server = ? AND page_id = ? AND filename = ?',
+                             (server, page_id, filename))
+
+    def verify(self, confluence, batch_size = 100):
+        """state.verify(confluence, batch_size = 100) -> (pages, attachments)
+Reconciles the state recorded for the given Confluence server with what's
+actually there, using bulk searches for batch_size pages at a time. Pages
+and attachments that have been edited, moved or deleted since Metro last
+published them are forgotten. Returns the numbers of pages and attachments
+forgotten."""
+        server = confluence.base_url
+        records = self.pages(server)
+        pages_forgotten = 0
+        attachments_forgotten = 0
+        for i in range(0, len(records), batch_size):
+            batch = records[i:i + batch_size]
+            ids = ','.join(str(record.page_id) for record in batch)
+
+            # Pages whose version or checksum has moved on were edited by hand.
+            results = confluence.search('id in (%s)'%ids,
+                                        expand = 'version,metadata.properties.checksum')
+            if results is None:
+                raise RuntimeError('Could not verify the state of pages on %s.'%server)
+            remote = dict((int(r['id']), r) for r in results)
+            stale = set()
+            for record in batch:
+                r = remote.get(record.page_id)
+                checksum = None
+                if r is not None:
+                    prop = r.get('metadata', {}).get('properties', {}).get('checksum')
+                    if isinstance(prop, dict):
+                        checksum = prop.get('value')
+                if r is None or int(r['version']['number']) != record.version or checksum != record.checksum:
+                    logging.info('Page "%s" (id = %i) has changed on the server.'%(record.title, record.page_id))
+                    self.forget(server, record.page_id)
+                    stale.add(record.page_id)
+                    pages_forgotten += 1
+
+            # Attachments that were deleted or re-uploaded by hand.
+            results = confluence.search('type = attachment and container in (%s)'%ids,
+                                        expand = 'version,container')
+            if results is None:
+                raise RuntimeError('Could not verify the state of attachments on %s.'%server)
+            remote = {}
+            for r in results:
+                remote[(int(r['container']['id']), r['title'])] = int(r['version']['number'])
+            for record in batch:
+                if record.page_id in stale:
+                    continue
+                for filename, (sha256, version) in self.attachments(server, record.page_id).items():
+                    if remote.get((record.page_id, filename)) != version:
+                        logging.info('Attachment "%s" on page %i has changed on the server.'%(filename, record.page_id))
+                        self.forget_attachment(server, record.page_id, filename)
+                        attachments_forgotten += 1
+        return (pages_forgotten, attachments_forgotten)
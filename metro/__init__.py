@@ -15,6 +15,13 @@ logger.setLevel(logging.INFO)
 
 from metro.Manifest import Manifest
 from metro.Confluence import Confluence
+from metro.AsyncConfluence import AsyncConfluence
+from metro.Publisher import Publisher
+from metro.SyncState import SyncState
+from metro.Archive import Archive
+from metro.Plan import Plan
+from metro.RenderCache import RenderCache
+from metro.SourceIndex import SourceIndex
 
 # metro module test
 # use this section to test authenticated connection to confluence
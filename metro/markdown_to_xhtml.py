@@ -3,215 +3,496 @@
 # SPDX-License-Identifier: BSD-3-Clause
 # For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
 
-def markdown_to_xhtml(title, 
-                      md_content, 
-                      table_of_contents = None, 
-                      auto_gen = None):
-    """markdown_to_xhtml(md_content, table_of_contents = None, auto_gen = None) -> xhtml_content
-Given a (UTF-8) string containing Markdown content, this function returns a
-(UTF-8) string containing the Confluence XHTML version of the content."""
+import os, re, threading
+import logging
+logger = logging.getLogger()
+from markdown.treeprocessors import Treeprocessor
+
+class XhtmlConverter(object):
+    """XhtmlConverter: converts Markdown to Confluence XHTML. The Markdown
+converter and the bleach Cleaner are built once, when the XhtmlConverter is
+created, and reused for every document it converts. Large documents are
+converted a section at a time, in parallel, since Markdown takes more than
+twice as long to convert twice as much. An XhtmlConverter must only be used
+by one thread at a time."""
     # This code was pilfered from md2conf.py in
     # https://github.com/RittmanMead/md_to_conf.
-    import re
-
-    def convert_macros(xhtml):
-        infoTag = '<p><ac:structured-macro ac:name="info"><ac:rich-text-body><p>'
-        noteTag = infoTag.replace('info','note')
-        warningTag = infoTag.replace('info','warning')
-        closeTag = '</p></ac:rich-text-body></ac:structured-macro></p>\n'
-    
-        # Convert custom Info/Note/Warning tags into macros
-        xhtml = xhtml.replace('<p>~?', infoTag).replace('?~</p>', closeTag)
-        xhtml = xhtml.replace('<p>~!', noteTag).replace('!~</p>', closeTag)
-        xhtml = xhtml.replace('<p>~%', warningTag).replace('%~</p>', closeTag)
-        
-        # Convert block quotes into macros
-        quotes = re.findall('<blockquote>(.*?)</blockquote>', xhtml, re.DOTALL)
-        cleaned_quotes = []
-        if quotes:
-            # Python's Markdown converter makes weird assumptions about stuff in the 
-            # blockquote environment. Go through the quotes and remove erroneous <p>, </p> tags.
-            # This is kludgey, but solving the real problem here is Hard.
-            for i in range(len(quotes)):
-                q = quotes[i]
-                # Inspect each line. If we find a multi-line markup thingy, remove the paragraph
-                # tags surrounding the first line.
-                lines = q.split('\n')
-                j = 0
-                while j < len(lines):
-                    line = lines[j]
-                    if 'Panel:' in line or 'Expand:' in line:
-                        lines[j] = line.replace('<p>', '')
-                        lines[j+1] = lines[j+1].replace('</p>', '')
-                        j += 2
-                    else:
-                        j += 1
-                cleaned_quotes.append('\n'.join(lines))
-
-            for i in range(len(cleaned_quotes)):
-                q = cleaned_quotes[i]
-                # Break the block quote chunk into separate paragraphs.
-                if '</p>' in q:
-                    paras = [p + '</p>' for p in q.split('</p>')][:-1]
-                else:
-                    paras = [q]
-                macroTag = ''
-                for p in paras:
-                    info = re.search('^<.*>Info', p.strip(), re.IGNORECASE)
-                    note = re.search('^<.*>Note', p.strip(), re.IGNORECASE)
-                    warning = re.search('^<.*>Warning', p.strip(), re.IGNORECASE)
-                    panel = re.search('Panel:', p.strip(), re.IGNORECASE)
-                    expand = re.search('Expand:', p.strip(), re.IGNORECASE)
-                    expand_all = re.search('ExpandAll', p.strip(), re.IGNORECASE)
-                    livesearch = re.search('LiveSearch', p.strip(), re.IGNORECASE)
-            
-                    if info:
-                        cleanTag = strip_type(p, 'Info')
-                        macroTag += cleanTag.replace('<p>', infoTag).replace('</p>', closeTag).strip() + '\n'
-                    elif note:
-                        cleanTag = strip_type(p, 'Note')
-                        macroTag += cleanTag.replace('<p>', noteTag).replace('</p>', closeTag).strip() + '\n'
-                    elif warning:
-                        cleanTag = strip_type(p, 'Warning')
-                        macroTag += cleanTag.replace('<p>', warningTag).replace('</p>', closeTag).strip() + '\n'
-                    elif panel:
-                        cleanTag = strip_type(p, 'Panel')
-                        lines = cleanTag.split('\n')
-                        title = lines[0].replace('<p>', '')
-                        body = '\n'.join(lines[1:]) + '\n'
-                        cleanTag = '<p>' + body
-                        panelTag = '<p><ac:structured-macro ac:name="panel">' + \
-                                   '<ac:parameter ac:name="title">%s</ac:parameter>'%title + \
-                                   '<ac:rich-text-body><p>\n'
-                        macroTag += panelTag + body + closeTag
-                    elif expand:
-                        cleanTag = strip_type(p, 'Expand')
-                        lines = cleanTag.split('\n')
-                        title = lines[0].replace('<p>', '')
-                        body = '\n'.join(lines[1:]) + '\n'
-                        cleanTag = '<p>' + body
-                        expandTag = '<p><ac:structured-macro ac:name="expand">' + \
-                                    '<ac:parameter ac:name="title">%s</ac:parameter>'%title + \
-                                    '<ac:rich-text-body><p>\n'
-                        macroTag += expandTag + body + closeTag
-                    elif expand_all:
-                        macroTag += '<ac:structured-macro ac:name="expand-collapse-all"/>'
-                    elif livesearch:
-                        macroTag += '<p><ac:structured-macro ac:name="livesearch">' + \
-                                    '<ac:parameter ac:name="spaceKey"><ri:space ri:space-key="@self"/></ac:parameter>' + \
-                                    '<ac:parameter ac:name="placeholder">Search this space</ac:parameter>' + \
-                                    '</ac:structured-macro></p>\n'
-            
-                if len(macroTag) > 0:
-                    xhtml = xhtml.replace('<blockquote>%s</blockquote>'%quotes[i], macroTag)
+
+    # What survives sanitization.
+    allowed_tags = ['a', 'abbr', 'acronym', 'b', 'blockquote', 'col', 'colgroup', 'pre', 'code', 'em',
+                    'i', 'li', 'ol', 'strong', 'ul', 'p', 'h1', 'h2', 'h3',
+                    'h4', 'h5', 'h6', 'img', 'table', 'th', 'thead', 'tbody', 'tr', 'td']
+    allowed_attrs = {'a': ['href', 'title', 'id'],
+                     'abbr': ['title'],
+                     'acronym': ['title'],
+                     'col': ['width'],
+                     'colgroup': ['valign'],
+                     'img': ['alt', 'src', 'width', 'height'],
+                     '*': ['style'],
+                     'th': ['id'],
+                     'td': ['headers']}
+                     #'td': ['style', 'headers']}
+    allowed_styles = ['color', 'font-family', 'width']
+
+    info_tag = '<p><ac:structured-macro ac:name="info"><ac:rich-text-body><p>'
+    note_tag = info_tag.replace('info','note')
+    warning_tag = info_tag.replace('info','warning')
+    close_tag = '</p></ac:rich-text-body></ac:structured-macro></p>\n'
+
+    # Patterns used in converting documents, compiled once.
+    _info_re = re.compile('^<.*>Info', re.IGNORECASE)
+    _note_re = re.compile('^<.*>Note', re.IGNORECASE)
+    _warning_re = re.compile('^<.*>Warning', re.IGNORECASE)
+    _panel_re = re.compile('Panel:', re.IGNORECASE)
+    _expand_re = re.compile('Expand:', re.IGNORECASE)
+    _expand_all_re = re.compile('ExpandAll', re.IGNORECASE)
+    _livesearch_re = re.compile('LiveSearch', re.IGNORECASE)
+    _code_lang_re = re.compile('code class="(.*)"')
+    _code_content_re = re.compile(r'<pre><code.*?>(.*?)<\/code><\/pre>', re.DOTALL)
+    _image_re = re.compile('<img.*?>', re.DOTALL)
+    _src_re = re.compile('src="(.*?)"')
+    _alt_re = re.compile('alt="(.*?)"')
+    _width_re = re.compile('width="(.*?)"')
+    _height_re = re.compile('height="(.*?)"')
+    _ref_re = re.compile(r'\n(\[\^(\d)\].*)|<p>(\[\^(\d)\].*)')
+    _href_re = re.compile('href="(.*?)"')
+    _p_tag_re = re.compile('</?p>')
+    _footnote_re = re.compile(r'\[\^([^\]]+)\]')
+    _col_re = re.compile(r'(<col(?:>|\s.*?>))')
+    _tag_re = re.compile('<.*?>')
+
+    # Everything convert_storage_format rewrites, as a single pattern, and
+    # what it rewrites within block quotes. ("this bleach cleaner doesn't
+    # work for some of xhtml format", so <col> tags are closed here.)
+    _inner_patterns = [r'(?P<code><pre><code.*?>.*?<\/code><\/pre>)',
+                       r'(?P<image><img.*?>)',
+                       r'(?P<col><col(?:>|\s[^\n]*?>))']
+    _storage_re = re.compile('|'.join([r'(?P<quote><blockquote>(?P<quoted>.*?)</blockquote>)'] + _inner_patterns),
+                             re.DOTALL)
+    _inner_re = re.compile('|'.join(_inner_patterns), re.DOTALL)
+
+    # The patterns stripping the type from the start of each kind of macro.
+    # (These have always replaced at most 2 matches, case-sensitively.)
+    _strip_patterns = ['%s:\\s', '%s\\s:\\s', '<.*?>%s:\\s<.*?>', '<.*?>%s\\s:\\s<.*?>',
+                       '<(em|strong)>%s:<.*?>\\s', '<(em|strong)>%s\\s:<.*?>\\s',
+                       '<(em|strong)>%s<.*?>:\\s', '<(em|strong)>%s\\s<.*?>:\\s']
+    _strip_res = {}
+    for type in ['Info', 'Note', 'Warning', 'Panel', 'Expand']:
+        _strip_res[type] = []
+        for pattern in _strip_patterns:
+            _strip_res[type].append(re.compile(pattern%type))
+    del type, pattern
+
+    # Documents longer than this many characters are split into sections at
+    # top-level headings, which are converted in parallel. Each section is at
+    # least section_size characters long.
+    large_document = 1 << 18
+    section_size = 1 << 16
+
+    # Raw HTML that splitting a document mustn't break up: comments, CDATA
+    # sections, processing instructions, declarations and tags.
+    _html_re = re.compile('<!--|-->|<!\\[CDATA\\[|\\]\\]>|<\\?|\\?>|<!|>|<(/?)([a-zA-Z][a-zA-Z0-9]*)')
+    _raw_ends = {'<!--': '-->', '<![CDATA[': ']]>', '<?': '?>', '<!': '>'}
+    _code_span_re = re.compile('(`+).*?\\1')
+    _void_tags = set(['area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link',
+                      'meta', 'param', 'source', 'track', 'wbr'])
+
+    # The ways HTML can be sanitized.
+    sanitizers = ['tree', 'bleach']
+
+    def __init__(self, jobs = None, sanitizer = 'tree'):
+        """XhtmlConverter(jobs = None, sanitizer = 'tree') -> new XhtmlConverter. The sections of
+large documents are converted up to jobs at a time in separate processes (by
+default, one per CPU), except in worker processes and threads other than the
+main one, where they're converted one after another. If sanitizer is 'tree', HTML is sanitized by a
+TreeSanitizer where possible, falling back to bleach; if it's 'bleach', bleach
+always sanitizes it."""
+        import markdown
+        from markdown.blockprocessors import ReferenceProcessor
+        from bleach.sanitizer import Cleaner, INVISIBLE_CHARACTERS_RE
+        if sanitizer not in self.sanitizers:
+            raise ValueError('sanitizer must be one of %s.'%', '.join(self.sanitizers))
+        self.jobs = jobs
+        self.sanitizer = sanitizer
+        self._reference_re = ReferenceProcessor.RE
+        self._markdown = markdown.Markdown(extensions = ['markdown.extensions.tables',
+                                                         'markdown.extensions.fenced_code'])
+        # (Yes, we're kind of abusing bleach here.)
+        self._cleaner = Cleaner(tags = self.allowed_tags, attributes = self.allowed_attrs,
+                                styles = self.allowed_styles)
+        self._tree_sanitizer = None
+        if sanitizer == 'tree':
+            # Sanitize the tree once everything else is done with it.
+            self._tree_sanitizer = TreeSanitizer(self._markdown, self._cleaner)
+            self._markdown.treeprocessors.register(self._tree_sanitizer, 'sanitize', -10)
+            # bleach replaces these characters, which we leave to it.
+            self._invisible_re = INVISIBLE_CHARACTERS_RE
+
+    def convert(self, title, md_content, table_of_contents = None, auto_gen = None):
+        """converter.convert(title, md_content, table_of_contents = None, auto_gen = None) -> xhtml_content
+Given a (UTF-8) string containing Markdown content, this method returns a
+(UTF-8) string containing the Confluence XHTML version of the content."""
+        # Convert to XHTML.
+        if len(md_content) > self.large_document:
+            xhtml = self.render_sections(md_content)
+        else:
+            xhtml = self.render(md_content)
+        # Toss the first line if it matches our title.
+        xhtml_lines = xhtml.split('\n')
+        if title in xhtml_lines[0]:
+            xhtml_lines = xhtml_lines[1:]
+        # Now handle Confluence-specific stuff.
+        xhtml = '\n'.join(xhtml_lines)
+        xhtml = self.convert_inline_macros(xhtml)
+        xhtml = self.convert_storage_format(xhtml)
+        xhtml = self.process_refs(xhtml)
+
+        if table_of_contents:
+            xhtml = self.add_table_of_contents(xhtml, table_of_contents)
+        if auto_gen:
+            xhtml = self.add_auto_gen(xhtml, auto_gen)
         return xhtml
-    
-    def convert_code_blocks(xhtml):
-        codeBlocks = re.findall('<pre><code.*?>.*?<\/code><\/pre>', xhtml, re.DOTALL)
-        if codeBlocks:
-            for tag in codeBlocks:
-                confML = '<ac:structured-macro ac:name="code">'
-#                confML += '<ac:parameter ac:name="theme">Midnight</ac:parameter>'
-                confML += '<ac:parameter ac:name="linenumbers">true</ac:parameter>'
-            
-                lang = re.search('code class="(.*)"', tag)
-                if lang:
-                    lang = lang.group(1)
+
+    def render(self, md_content):
+        """converter.render(md_content) -> the sanitized HTML for the given Markdown."""
+        if self._tree_sanitizer is not None:
+            self._tree_sanitizer.enabled = not self._invisible_re.search(md_content)
+        xhtml = self._markdown.reset().convert(md_content)
+        if self._tree_sanitizer is not None and self._tree_sanitizer.sanitized:
+            # bleach writes the only empty tag that's left as HTML, not XHTML.
+            return xhtml.replace(' />', '>')
+        # Sanitize HTML within.
+        return self._cleaner.clean(xhtml)
+
+    def render_sections(self, md_content):
+        """converter.render_sections(md_content) -> the sanitized HTML for the
+given Markdown, rendered a section at a time, in parallel."""
+        import multiprocessing
+        sections = self.split_sections(md_content)
+        jobs = min(self.jobs or os.cpu_count() or 1, len(sections))
+        if multiprocessing.parent_process() is not None or \
+           threading.current_thread() is not threading.main_thread():
+            # Whoever started this process or thread is already spreading the
+            # work out, and forking from a thread isn't safe.
+            jobs = 1
+        if jobs > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers = jobs) as executor:
+                sections = list(executor.map(_render_section, sections,
+                                             [self.sanitizer]*len(sections)))
+        else:
+            sections = [self.render(section) for section in sections]
+        return '\n'.join(section for section in sections if section)
+
+    def split_sections(self, md_content):
+        """converter.split_sections(md_content) -> a list of sections of the
+given Markdown that can be rendered separately. Sections start at headings
+outside of code blocks and raw HTML, and every section gets a copy of the
+document's reference definitions, so that links to them work anywhere. A
+document whose structure isn't clear is left in one piece."""
+        from markdown.extensions.fenced_code import FencedBlockPreprocessor
+        if '\r' in md_content:
+            # Markdown turns some of these into line breaks.
+            return [md_content]
+        lines = md_content.split('\n')
+
+        # Find the lines in fenced code blocks, paired up the way Markdown
+        # pairs them.
+        fenced = [False]*len(lines)
+        text = md_content.expandtabs(self._markdown.tab_length)
+        (pos, line_no) = (0, 0)
+        for m in FencedBlockPreprocessor.FENCED_BLOCK_RE.finditer(text):
+            first = line_no + text.count('\n', pos, m.start())
+            last = first + text.count('\n', m.start(), m.end())
+            for j in range(first, last + 1):
+                fenced[j] = True
+            (pos, line_no) = (m.end(), last)
+
+        starts = [0]
+        references = []
+        open_tags = {}       # How deeply each HTML tag is nested.
+        raw_end = None       # What ends the comment, CDATA section, etc. we're in.
+        after_html = False   # Whether the last non-blank line had raw HTML.
+        size = 0
+        reference_end = 0    # The line after the last reference definition.
+        block_start = 0      # The first line of the current block.
+        for (i, line) in enumerate(lines):
+            size += len(line) + 1
+            if fenced[i]:
+                after_html = False
+                continue
+            elif not line.strip():
+                block_start = i + 1
+                continue
+            elif i < reference_end:
+                continue
+            elif line.startswith('#') and not lines[i-1].strip() and not after_html and \
+                 not raw_end and not open_tags and size - len(line) - 1 >= self.section_size:
+                starts.append(i)
+                size = len(line) + 1
+            if line.lstrip(' ').startswith('['):
+                m = self._reference_re.match('\n'.join(lines[i:i+3]))
+                if m and (raw_end or open_tags or
+                          any('|' in prev for prev in lines[block_start:i])):
+                    # Markdown may or may not see this one (a table takes
+                    # its block whole, for one).
+                    return [md_content]
+                elif m:
+                    # Definitions vanish, so they don't count as the last line.
+                    references.append(m.group(0))
+                    reference_end = i + m.group(0).count('\n') + 1
+                    continue
+            # A line that's in (or ends) a comment, CDATA section and so on
+            # counts as raw HTML too.
+            after_html = '<' in line or raw_end is not None
+            if after_html:
+                raw_end = self._track_html(line, open_tags, raw_end)
+        if raw_end or open_tags:
+            # We can't tell where this HTML ends, so Markdown might not either.
+            return [md_content]
+        if references:
+            references = '\n\n' + '\n\n'.join(references) + '\n'
+        else:
+            references = ''
+        starts.append(len(lines))
+        return ['\n'.join(lines[starts[k]:starts[k+1]]) + references
+                for k in range(len(starts) - 1)]
+
+    def _track_html(self, line, open_tags, raw_end):
+        """Counts the HTML tags the given line opens and closes into
+open_tags, returning what ends the comment, CDATA section, processing
+instruction or declaration the line ends in, if any (raw_end, for the one it
+starts in). (An HTML parser carries tags that aren't closed, even inline ones,
+on to what follows.) When in doubt, tags are taken to be open: those in
+comments are counted, and those closed in code are not. Tags in code spans
+outside of raw HTML don't count."""
+        code = line.startswith('    ') or line.startswith('\t')
+        spans = []
+        if '\\`' not in line:
+            spans = [m.span() for m in self._code_span_re.finditer(line)]
+            if sum(line.count('`', a, b) for (a, b) in spans) != line.count('`'):
+                # A code span might carry on to the next line.
+                code = True
+                spans = []
+        for m in self._html_re.finditer(line):
+            if m.group(0) in self._raw_ends:
+                if not raw_end:
+                    raw_end = self._raw_ends[m.group(0)]
+            elif not m.group(2):
+                if m.group(0) == raw_end:
+                    raw_end = None
+            else:
+                tag = m.group(2).lower()
+                if tag in self._void_tags:
+                    continue
+                elif not raw_end and not open_tags and any(a <= m.start() < b for (a, b) in spans):
+                    continue
+                elif m.group(1):
+                    if raw_end or code or any(a <= m.start() < b for (a, b) in spans):
+                        continue
+                    depth = open_tags.get(tag, 0) - 1
+                else:
+                    depth = open_tags.get(tag, 0) + 1
+                if depth > 0:
+                    open_tags[tag] = depth
                 else:
-                    lang = 'none'
-                
-                confML = confML + '<ac:parameter ac:name="language">' + lang + '</ac:parameter>'
-                content = re.search('<pre><code.*?>(.*?)<\/code><\/pre>', tag, re.DOTALL).group(1)
-                content = '<ac:plain-text-body><![CDATA[' + content + ']]></ac:plain-text-body>'
-                confML = confML + content + '</ac:structured-macro>'
-                confML = confML.replace('&lt;', '<').replace('&gt;', '>')
-                confML = confML.replace('&quot;', '"').replace('&amp;', '&')
-            
-                xhtml = xhtml.replace(tag, confML)
-    
+                    open_tags.pop(tag, None)
+        return raw_end
+
+    def convert_inline_macros(self, xhtml):
+        # Convert custom Info/Note/Warning tags into macros
+        xhtml = xhtml.replace('<p>~?', self.info_tag).replace('?~</p>', self.close_tag)
+        xhtml = xhtml.replace('<p>~!', self.note_tag).replace('!~</p>', self.close_tag)
+        xhtml = xhtml.replace('<p>~%', self.warning_tag).replace('%~</p>', self.close_tag)
         return xhtml
 
-    def convert_images(xhtml):
+    def convert_storage_format(self, xhtml):
+        # Block quotes, code blocks, images and columns are rewritten in a
+        # single pass, each as it's found. Code blocks and images within block
+        # quotes, and images and columns within code blocks, are rewritten too.
+        return self._storage_re.sub(self._storage_element, xhtml)
+
+    def _storage_element(self, match):
+        """Returns the Confluence storage format for the given match of
+_storage_re or _inner_re."""
+        kind = match.lastgroup
+        if kind == 'quote':
+            macro = self.convert_quote(match.group('quoted'))
+            if macro is None:
+                macro = match.group(0)
+            return self._inner_re.sub(self._storage_element, macro)
+        elif kind == 'code':
+            confML = self.convert_code_block(match.group(0))
+            confML = self._col_re.sub(r'\1</col>', confML)
+            return self._image_re.sub(self._image_element, confML)
+        elif kind == 'image':
+            return self._image_element(match)
+        else: # kind == 'col'
+            return match.group(0) + '</col>'
+
+    def _image_element(self, match):
+        return self.convert_image(match.group(0))
+
+    def convert_quote(self, q):
+        """Returns the macros for the block quote with the given contents, or
+None if it doesn't hold any."""
+        infoTag = self.info_tag
+        noteTag = self.note_tag
+        warningTag = self.warning_tag
+        closeTag = self.close_tag
+
+        # Python's Markdown converter makes weird assumptions about stuff in the
+        # blockquote environment. Remove erroneous <p>, </p> tags.
+        # This is kludgey, but solving the real problem here is Hard.
+        # Inspect each line. If we find a multi-line markup thingy, remove the paragraph
+        # tags surrounding the first line.
+        lines = q.split('\n')
+        j = 0
+        while j < len(lines):
+            line = lines[j]
+            if 'Panel:' in line or 'Expand:' in line:
+                lines[j] = line.replace('<p>', '')
+                lines[j+1] = lines[j+1].replace('</p>', '')
+                j += 2
+            else:
+                j += 1
+        q = '\n'.join(lines)
+
+        # Break the block quote chunk into separate paragraphs.
+        if '</p>' in q:
+            paras = [p + '</p>' for p in q.split('</p>')][:-1]
+        else:
+            paras = [q]
+        macroTag = ''
+        for p in paras:
+            stripped = p.strip()
+            if self._info_re.search(stripped):
+                cleanTag = self.strip_type(p, 'Info')
+                macroTag += cleanTag.replace('<p>', infoTag).replace('</p>', closeTag).strip() + '\n'
+            elif self._note_re.search(stripped):
+                cleanTag = self.strip_type(p, 'Note')
+                macroTag += cleanTag.replace('<p>', noteTag).replace('</p>', closeTag).strip() + '\n'
+            elif self._warning_re.search(stripped):
+                cleanTag = self.strip_type(p, 'Warning')
+                macroTag += cleanTag.replace('<p>', warningTag).replace('</p>', closeTag).strip() + '\n'
+            elif self._panel_re.search(stripped):
+                cleanTag = self.strip_type(p, 'Panel')
+                lines = cleanTag.split('\n')
+                title = lines[0].replace('<p>', '')
+                body = '\n'.join(lines[1:]) + '\n'
+                panelTag = '<p><ac:structured-macro ac:name="panel">' + \
+                           '<ac:parameter ac:name="title">%s</ac:parameter>'%title + \
+                           '<ac:rich-text-body><p>\n'
+                macroTag += panelTag + body + closeTag
+            elif self._expand_re.search(stripped):
+                cleanTag = self.strip_type(p, 'Expand')
+                lines = cleanTag.split('\n')
+                title = lines[0].replace('<p>', '')
+                body = '\n'.join(lines[1:]) + '\n'
+                expandTag = '<p><ac:structured-macro ac:name="expand">' + \
+                            '<ac:parameter ac:name="title">%s</ac:parameter>'%title + \
+                            '<ac:rich-text-body><p>\n'
+                macroTag += expandTag + body + closeTag
+            elif self._expand_all_re.search(stripped):
+                macroTag += '<ac:structured-macro ac:name="expand-collapse-all"/>'
+            elif self._livesearch_re.search(stripped):
+                macroTag += '<p><ac:structured-macro ac:name="livesearch">' + \
+                            '<ac:parameter ac:name="spaceKey"><ri:space ri:space-key="@self"/></ac:parameter>' + \
+                            '<ac:parameter ac:name="placeholder">Search this space</ac:parameter>' + \
+                            '</ac:structured-macro></p>\n'
+
+        if len(macroTag) > 0:
+            return macroTag
+        return None
+
+    def convert_code_block(self, tag):
+        """Returns the code macro for the given <pre><code> block."""
+        confML = '<ac:structured-macro ac:name="code">'
+#        confML += '<ac:parameter ac:name="theme">Midnight</ac:parameter>'
+        confML += '<ac:parameter ac:name="linenumbers">true</ac:parameter>'
+
+        lang = self._code_lang_re.search(tag)
+        if lang:
+            lang = lang.group(1)
+        else:
+            lang = 'none'
+
+        confML = confML + '<ac:parameter ac:name="language">' + lang + '</ac:parameter>'
+        content = self._code_content_re.search(tag).group(1)
+        content = '<ac:plain-text-body><![CDATA[' + content + ']]></ac:plain-text-body>'
+        confML = confML + content + '</ac:structured-macro>'
+        confML = confML.replace('&lt;', '<').replace('&gt;', '>')
+        confML = confML.replace('&quot;', '"').replace('&amp;', '&')
+        return confML
+
+    def convert_image(self, tag):
+        """Returns the ac:image for the given <img> tag."""
         import os.path
-        image_tags = re.findall('<img.*?>', xhtml, re.DOTALL)
-        if image_tags:
-            for tag in image_tags:
-                # Get the important attributes.
-                src = re.search('src="(.*?)"', tag)
-                if src:
-                    src = src.group(1)
-                filename = os.path.basename(src)
-
-                alt = re.search('alt="(.*?)"', tag)
-                if alt:
-                    alt = alt.group(1)
-
-                width = re.search('width="(.*?)"', tag)
-                if width:
-                    width = width.group(1)
-                
-                height = re.search('height="(.*?)"', tag)
-                if height:
-                    height = height.group(1)
-                
-                # Open an ac:image tag and shove the attributes in.
-                confML = '<ac:image ac:queryparams="effects=border-simple,blur-border" '
-                if alt:
-                    confML += 'ac:alt="%s" ac:title="%s" '%(alt, alt)
-                if width:
-                    confML += 'ac:width="%s" '%width
-                if height:
-                    confML += 'ac:height="%s" '%height
-                confML += '>'
-
-                # Point to the attached image.
-                confML += '<ri:attachment ri:filename="%s"/>'%filename
-
-                # Close the ac:image tag.
-                confML += '</ac:image>'
-            
-                xhtml = xhtml.replace(tag, confML)
-    
-        return xhtml
+        # Get the important attributes.
+        src = self._src_re.search(tag)
+        if src:
+            src = src.group(1)
+        filename = os.path.basename(src)
 
-    def strip_type(tag, type):
-        tag = re.sub('%s:\s' % type, '', tag.strip(), re.IGNORECASE)
-        tag = re.sub('%s\s:\s' % type, '', tag.strip(), re.IGNORECASE)
-        tag = re.sub('<.*?>%s:\s<.*?>' % type, '', tag, re.IGNORECASE)
-        tag = re.sub('<.*?>%s\s:\s<.*?>' % type, '', tag, re.IGNORECASE)
-        tag = re.sub('<(em|strong)>%s:<.*?>\s' % type, '', tag, re.IGNORECASE)
-        tag = re.sub('<(em|strong)>%s\s:<.*?>\s' % type, '', tag, re.IGNORECASE)
-        tag = re.sub('<(em|strong)>%s<.*?>:\s' % type, '', tag, re.IGNORECASE)
-        tag = re.sub('<(em|strong)>%s\s<.*?>:\s' % type, '', tag, re.IGNORECASE)
-        stringStart = re.search('<.*?>', tag)
-        tag = upper_chars(tag, [stringStart.end()])
-        return tag
-    
-    def upper_chars(string, indices):
-        upperString = "".join(c.upper() if i in indices else c for i, c in enumerate(string))
-        return upperString
-
-    def process_refs(xhtml):
-        refs = re.findall('\n(\[\^(\d)\].*)|<p>(\[\^(\d)\].*)', xhtml)
-        if len(refs) > 0:
-            for ref in refs:
-                if ref[0]:
-                    fullRef = ref[0].replace('</p>', '').replace('<p>', '')
-                    refID = ref[1]
-                else:
-                    fullRef = ref[2]
-                    refID = ref[3]
-        
-                fullRef = fullRef.replace('</p>', '').replace('<p>', '')
-                xhtml = xhtml.replace(fullRef, '')
-                href = re.search('href="(.*?)"', fullRef).group(1)
-
-                superscript = '<a id="test" href="%s"><sup>%s</sup></a>' % (href, refID)
-                xhtml = xhtml.replace('[^%s]' % refID, superscript)
-    
+        alt = self._alt_re.search(tag)
+        if alt:
+            alt = alt.group(1)
+
+        width = self._width_re.search(tag)
+        if width:
+            width = width.group(1)
+
+        height = self._height_re.search(tag)
+        if height:
+            height = height.group(1)
+
+        # Open an ac:image tag and shove the attributes in.
+        confML = '<ac:image ac:queryparams="effects=border-simple,blur-border" '
+        if alt:
+            confML += 'ac:alt="%s" ac:title="%s" '%(alt, alt)
+        if width:
+            confML += 'ac:width="%s" '%width
+        if height:
+            confML += 'ac:height="%s" '%height
+        confML += '>'
+
+        # Point to the attached image.
+        confML += '<ri:attachment ri:filename="%s"/>'%filename
+
+        # Close the ac:image tag.
+        confML += '</ac:image>'
+        return confML
+
+    def strip_type(self, tag, type):
+        tag = tag.strip()
+        for (i, pattern) in enumerate(self._strip_res[type]):
+            tag = pattern.sub('', tag, 2)
+            if i == 0:
+                tag = tag.strip()
+        stringStart = self._tag_re.search(tag)
+        # Capitalize the first character after the opening tag.
+        i = stringStart.end()
+        return tag[:i] + tag[i:i+1].upper() + tag[i+1:]
+
+    def process_refs(self, xhtml):
+        # Take the footnote definitions out (keeping the paragraph tags around
+        # them), then turn the references to them into superscript links.
+        superscripts = {}
+        def remove_ref(m):
+            if m.group(1):
+                (prefix, fullRef, refID) = ('\n', m.group(1), m.group(2))
+            else:
+                (prefix, fullRef, refID) = ('<p>', m.group(3), m.group(4))
+            href = self._href_re.search(fullRef.replace('</p>', '').replace('<p>', '')).group(1)
+            if refID not in superscripts:
+                superscripts[refID] = '<a id="test" href="%s"><sup>%s</sup></a>' % (href, refID)
+            return prefix + ''.join(self._p_tag_re.findall(fullRef))
+        xhtml = self._ref_re.sub(remove_ref, xhtml)
+        if superscripts:
+            xhtml = self._footnote_re.sub(lambda m: superscripts.get(m.group(1), m.group(0)), xhtml)
         return xhtml
 
-    def add_table_of_contents(xhtml, table_of_contents):
+    def add_table_of_contents(self, xhtml, table_of_contents):
         # See https://confluence.atlassian.com/doc/table-of-contents-macro-182682099.html
         # for macro parameter descriptions.
         min_level = 1
@@ -232,56 +513,207 @@ Given a (UTF-8) string containing Markdown content, this function returns a
         toc += '<ac:parameter ac:name="outline">false</ac:parameter>\n<ac:parameter ac:name="include"></ac:parameter>\n</ac:structured-macro>'
         return toc + '\n' + xhtml
 
-    def add_auto_gen(xhtml, draft_link):
+    def add_auto_gen(self, xhtml, draft_link):
         badge = '<ac:structured-macro ac:name="panel">\n<ac:parameter ac:name="title">This page is auto-generated. Please do not Edit directly.</ac:parameter>\n'
         badge += '<ac:rich-text-body>Make a suggestion or Pull Request to <a href="%s"><b>the source file.</b></a></ac:rich-text-body>\n'%draft_link
         badge += '</ac:structured-macro>'
         return badge + '\n' + xhtml
 
+class TreeSanitizer(Treeprocessor):
+    """TreeSanitizer: a Markdown tree processor that applies an
+XhtmlConverter's allow-list to the element tree before it's serialized, doing
+what bleach would do to the HTML made from it without parsing that HTML
+again. Documents holding raw HTML (other than code blocks and entities) are
+left alone for bleach to sanitize. After each document, sanitized says whether
+the tree was sanitized."""
 
-    # this bleach cleaner doesn't work for some of xhtml format.
-    def convert_html_to_xhtml(xhtml):
-        xhtml = re.sub(r'(<col(?:>|\s.*?>))', r'\1</col>', xhtml)
-        return xhtml
-    
-    # Convert to XHTML.
-    import markdown
-    xhtml = markdown.markdown(md_content, 
-                              extensions = ['markdown.extensions.tables', 
-                                            'markdown.extensions.fenced_code'])
-    # Sanitize HTML within. (Yes, we're kind of abusing bleach here.)
-    from bleach.sanitizer import Cleaner
-    allowed_tags = ['a', 'abbr', 'acronym', 'b', 'blockquote', 'col', 'colgroup', 'pre', 'code', 'em', 
-                    'i', 'li', 'ol', 'strong', 'ul', 'p', 'h1', 'h2', 'h3', 
-                    'h4', 'h5', 'h6', 'img', 'table', 'th', 'thead', 'tbody', 'tr', 'td']
-    allowed_attrs = {'a': ['href', 'title', 'id'], 
-                     'abbr': ['title'], 
-                     'acronym': ['title'],
-                     'col': ['width'],
-                     'colgroup': ['valign'],
-                     'img': ['alt', 'src', 'width', 'height'],
-                     '*': ['style'],
-                     'th': ['id'],
-                     'td': ['headers']}
-                     #'td': ['style', 'headers']}
-    allowed_styles = ['color', 'font-family', 'width']
-    cleaner = Cleaner(tags=allowed_tags, attributes = allowed_attrs, styles = allowed_styles)
-    xhtml = cleaner.clean(xhtml)
-    # Toss the first line if it matches our title.
-    xhtml_lines = xhtml.split('\n')
-    if title in xhtml_lines[0]:
-        xhtml_lines = xhtml_lines[1:]
-    # Now handle Confluence-specific stuff.
-    xhtml = '\n'.join(xhtml_lines)
-    xhtml = convert_macros(xhtml)
-    xhtml = convert_code_blocks(xhtml)
-    xhtml = convert_html_to_xhtml(xhtml)
-    xhtml = convert_images(xhtml)
-    xhtml = process_refs(xhtml)
-
-    if table_of_contents:
-        xhtml = add_table_of_contents(xhtml, table_of_contents)
-    if auto_gen:
-        xhtml = add_auto_gen(xhtml, auto_gen)
-    return xhtml
+    # Elements Markdown makes that bleach turns into text.
+    void_tags = ['br', 'hr']
+
+    # What fenced code blocks and entities look like in the HTML stash.
+    _code_block_re = re.compile(r'<pre><code(?: class="[^"<>&]*")?>((?:[^<>&]|&(?:amp|lt|gt|quot);)*)</code></pre>\Z')
+    _entity_re = re.compile(r'&(?:#[0-9]{1,7}|#x[0-9a-f]{1,6}|amp|lt|gt|quot|nbsp|copy|reg|trade|mdash|ndash|hellip);\Z')
+    # Characters escaped with a backslash in the Markdown.
+    _escaped_re = re.compile('\x02([0-9]+)\x03')
+    # What Markdown leaves alone as an entity in an attribute. (bleach
+    # escapes the ones it doesn't know, and browsers decode the rest.)
+    _attr_entity_re = re.compile(r'&(?:#[0-9]+|#x[0-9a-f]+|[0-9a-z]+);', re.IGNORECASE)
+
+    def __init__(self, md, cleaner):
+        """TreeSanitizer(md, cleaner) -> new TreeSanitizer for the given
+Markdown converter, allowing what the given bleach Cleaner allows."""
+        from bleach.sanitizer import BleachSanitizerFilter
+        Treeprocessor.__init__(self, md)
+        self.enabled = True
+        self.sanitized = False
+        self._allowed_tags = set(cleaner.tags)
+        self._allowed_attrs = cleaner.attributes
+        # bleach's own checks of URLs and styles.
+        self._filter = BleachSanitizerFilter(None, attributes = cleaner.attributes,
+                                             allowed_elements = cleaner.tags,
+                                             allowed_css_properties = cleaner.styles,
+                                             allowed_protocols = cleaner.protocols,
+                                             allowed_svg_properties = [])
+
+    def run(self, root):
+        self.sanitized = False
+        if not self.enabled:
+            return None
+        stash = self.md.htmlStash.rawHtmlBlocks
+        for (i, html) in enumerate(stash):
+            if not isinstance(html, str):
+                return None
+            m = self._code_block_re.match(html)
+            if m:
+                stash[i] = '<pre><code>%s</code></pre>'%m.group(1)
+            elif not self._entity_re.match(html):
+                return None
+        if not self._can_sanitize(root):
+            return None
+        self._sanitize(root)
+        self.sanitized = True
+        return None
+
+    def _can_sanitize(self, root):
+        """Returns True if everything in the tree under the given root is
+something we know how to sanitize."""
+        from markdown.util import AMP_SUBSTITUTE
+        for elem in root.iter():
+            if not isinstance(elem.tag, str):
+                return False
+            elif elem is root:
+                continue
+            elif elem.tag not in self._allowed_tags:
+                if elem.tag not in self.void_tags or len(elem) or elem.text or elem.attrib:
+                    return False
+            elif elem.tag == 'a' and any(a is not elem for a in elem.iter('a')):
+                # Nested links would be rearranged by an HTML parser.
+                return False
+            for value in elem.attrib.values():
+                value = self._unescape(value).replace(AMP_SUBSTITUTE, '&')
+                if self._attr_entity_re.search(value):
+                    return False
+        return True
+
+    def _unescape(self, text):
+        return self._escaped_re.sub(lambda m: chr(int(m.group(1))), text)
+
+    def _sanitize(self, parent):
+        """Sanitizes the children of the given element."""
+        from markdown.util import AMP_SUBSTITUTE
+        if parent.text:
+            parent.text = self._unescape(parent.text)
+        previous = None
+        for elem in list(parent):
+            if elem.tail:
+                elem.tail = self._unescape(elem.tail)
+            if elem.tag in self.void_tags:
+                # Replace the element with the text of its tag.
+                text = '<%s />'%elem.tag + (elem.tail or '')
+                if previous is None:
+                    parent.text = (parent.text or '') + text
+                else:
+                    previous.tail = (previous.tail or '') + text
+                parent.remove(elem)
+                continue
+            allowed = self._allowed_attrs.get(elem.tag, []) + self._allowed_attrs.get('*', [])
+            for (name, value) in list(elem.items()):
+                # (bleach leaves characters escaped in attributes as they are.)
+                if name not in allowed:
+                    del elem.attrib[name]
+                elif (None, name) in self._filter.attr_val_is_uri:
+                    value = self._unescape(value).replace(AMP_SUBSTITUTE, '&')
+                    if self._filter.sanitize_uri_value(value, self._filter.allowed_protocols) is None:
+                        del elem.attrib[name]
+                elif name == 'style':
+                    elem.set(name, self._filter.sanitize_css(self._unescape(value)))
+            self._sanitize(elem)
+            previous = elem
+
+def _convert_documents(documents):
+    """Converts the given (title, md_content, options) tuples in a worker
+process for markdown_to_xhtml_many, returning a list of their XHTML."""
+    return [_convert_document(document) for document in documents]
+
+def _convert_document(document):
+    (title, md_content, options) = document
+    options = options or {}
+    return converter().convert(title, md_content,
+                               table_of_contents = options.get('table_of_contents'),
+                               auto_gen = options.get('auto_gen'))
+
+def _render_section(md_content, sanitizer):
+    """Renders a section of a large document in a worker process for
+XhtmlConverter.render_sections."""
+    return converter(sanitizer).render(md_content)
+
+# Each thread gets its own XhtmlConverter, since they can't be shared.
+_converters = threading.local()
+
+def converter(sanitizer = 'tree'):
+    """converter(sanitizer = 'tree') -> the XhtmlConverter used by markdown_to_xhtml in this 
+thread, or the one using the given sanitizer."""
+    if not hasattr(_converters, 'converters'):
+        _converters.converters = {}
+    if sanitizer not in _converters.converters:
+        _converters.converters[sanitizer] = XhtmlConverter(sanitizer = sanitizer)
+    return _converters.converters[sanitizer]
+
+def markdown_to_xhtml(title,
+                      md_content,
+                      table_of_contents = None,
+                      auto_gen = None):
+    """markdown_to_xhtml(md_content, table_of_contents = None, auto_gen = None) -> xhtml_content
+Given a (UTF-8) string containing Markdown content, this function returns a
+(UTF-8) string containing the Confluence XHTML version of the content."""
+    return converter().convert(title, md_content, table_of_contents, auto_gen)
 
+def markdown_to_xhtml_many(documents, jobs = 1, max_pending = None, chunk_size = 1):
+    """markdown_to_xhtml_many(documents, jobs = 1, max_pending = None, chunk_size = 1) -> iterator of xhtml_content
+Converts each of the given (title, md_content, options) tuples the way
+markdown_to_xhtml does, where options is None or a dict that may hold
+'table_of_contents' and 'auto_gen', yielding the XHTML of each in the order
+given as soon as it's ready. Documents are taken from the iterable only as
+they're needed, so it can be a generator. If jobs is more than 1, documents
+are converted in that many separate processes, chunk_size at a time, with at
+most max_pending chunks (by default, 4 per process) in flight at once. The
+throughput is logged once every document has been converted."""
+    import time
+    from itertools import islice
+    if not isinstance(jobs, int) or jobs < 1:
+        raise ValueError('jobs must be a positive integer.')
+    if not isinstance(chunk_size, int) or chunk_size < 1:
+        raise ValueError('chunk_size must be a positive integer.')
+    start = time.time()
+    count = 0
+    if jobs == 1:
+        for document in documents:
+            yield _convert_document(document)
+            count += 1
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        from collections import deque
+        max_pending = max_pending or 4 * jobs
+        documents = iter(documents)
+        with ProcessPoolExecutor(max_workers = jobs) as executor:
+            pending = deque()
+            while True:
+                while len(pending) < max_pending:
+                    chunk = list(islice(documents, chunk_size))
+                    if not chunk:
+                        break
+                    pending.append(executor.submit(_convert_documents, chunk))
+                if not pending:
+                    break
+                try:
+                    results = pending.popleft().result()
+                except BaseException:
+                    for future in pending:
+                        future.cancel()
+                    raise
+                for xhtml in results:
+                    yield xhtml
+                count += len(results)
+    elapsed = time.time() - start
+    logging.info('Converted %i page(s) in %.2fs (%.1f pages/s).'%(count, elapsed,
+                                                                   count/elapsed if elapsed > 0 else 0.0))
@@ -30,21 +30,27 @@ given document, which is useful for automating a task list.
 """
 
 import datetime
+import io
 import json
 import logging
 import ssl
 import sys
+import threading
 import time
 import xml.etree.cElementTree
 
+import urllib3
+
 PY3 = sys.version_info > (3,)
 
 if PY3:
-    import urllib.request, urllib.parse, urllib.error
+    import urllib.request, urllib.parse, urllib.error, urllib.response
     Request = urllib.request.Request
     urlencode = urllib.parse.urlencode
     urlopen = urllib.request.urlopen
     HTTPError = urllib.error.HTTPError
+    URLError = urllib.error.URLError
+    addinfourl = urllib.response.addinfourl
 
     iteritems = dict.items
 
@@ -56,6 +62,8 @@ else:
     urlencode = urllib.urlencode
     urlopen = urllib2.urlopen
     HTTPError = urllib2.HTTPError
+    URLError = urllib2.URLError
+    addinfourl = urllib.addinfourl
 
     iteritems = dict.iteritems
 
@@ -118,7 +126,7 @@ class QuipClient(object):
     BLUE = range(5)
 
     def __init__(self, access_token=None, client_id=None, client_secret=None,
-                 base_url=None, request_timeout=None):
+                 base_url=None, request_timeout=None, pool_size=None):
         """Constructs a Quip API client.
 
         If `access_token` is given, all of the API methods in the client
@@ -127,12 +135,18 @@ class QuipClient(object):
         Otherwise, only `get_authorization_url` and `get_access_token`
         work, and we assume the client is for a server using the Quip API's
         OAuth endpoint.
+
+        Connections to the server are kept alive and reused, up to
+        `pool_size` of them at a time (4 by default).
         """
         self.access_token = access_token
         self.client_id = client_id
         self.client_secret = client_secret
         self.base_url = base_url if base_url else "https://platform.quip.com"
         self.request_timeout = request_timeout if request_timeout else 10
+        self.pool_size = pool_size if pool_size else 4
+        self._pool = None
+        self._pool_lock = threading.Lock()
 
     def get_authorization_url(self, redirect_uri, state=None):
         """Returns the URL the user should be redirected to to sign in."""
@@ -716,12 +730,11 @@ class QuipClient(object):
         The object is described in detail here:
         https://docs.python.org/2/library/urllib2.html#urllib2.urlopen
         """
-        request = Request(
-            url=self._url("blob/%s/%s" % (thread_id, blob_id)))
-        if self.access_token:
-            request.add_header("Authorization", "Bearer " + self.access_token)
+        url = self._url("blob/%s/%s" % (thread_id, blob_id))
         try:
-            return urlopen(request, timeout=self.request_timeout)
+            response = self._request(url)
+            return addinfourl(io.BytesIO(response.data), response.headers,
+                              url, response.status)
         except HTTPError as error:
             try:
                 # Extract the developer-friendly error message from the response
@@ -763,22 +776,17 @@ class QuipClient(object):
         return self._fetch_json("websockets/new", **kwargs)
 
     def _fetch_json(self, path, post_data=None, **args):
-        request = Request(url=self._url(path, **args))
+        url = self._url(path, **args)
+        request_data = None
         if post_data:
             post_data = dict((k, v) for k, v in post_data.items()
                              if v or isinstance(v, int))
             request_data = urlencode(self._clean(**post_data))
             if PY3:
-                request.data = request_data.encode()
-            else:
-                request.data = request_data
+                request_data = request_data.encode()
 
-        if self.access_token:
-            request.add_header("Authorization", "Bearer " + self.access_token)
         try:
-            return json.loads(
-                urlopen(
-                    request, timeout=self.request_timeout).read().decode())
+            return json.loads(self._request(url, request_data).data.decode())
         except HTTPError as error:
             try:
                 # Extract the developer-friendly error message from the response
@@ -787,6 +795,39 @@ class QuipClient(object):
                 raise error
             raise QuipError(error.code, message, error)
 
+    def _request(self, url, data=None):
+        """Sends a GET request to the given URL, or a POST if `data` is
+        given, over one of the pool's keep-alive connections, and returns
+        the whole response.
+
+        As with `urlopen`, error statuses raise `HTTPError` and failures to
+        reach the server raise `URLError`.
+        """
+        with self._pool_lock:
+            if self._pool is None:
+                # Stale keep-alive connections show up as read errors, so
+                # idempotent requests get one retry.
+                self._pool = urllib3.PoolManager(
+                    maxsize=self.pool_size,
+                    retries=urllib3.Retry(connect=2, read=1, redirect=10))
+        method = "GET"
+        headers = {}
+        if data is not None:
+            method = "POST"
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        if self.access_token:
+            headers["Authorization"] = "Bearer " + self.access_token
+        try:
+            response = self._pool.request(
+                method, url, body=data, headers=headers,
+                timeout=self.request_timeout)
+        except urllib3.exceptions.HTTPError as error:
+            raise URLError(getattr(error, "reason", None) or error)
+        if response.status >= 400:
+            raise HTTPError(url, response.status, response.reason,
+                            response.headers, io.BytesIO(response.data))
+        return response
+
     def _clean(self, **args):
         return dict((k, str(v) if isinstance(v, int) else v.encode("utf-8"))
                     for k, v in args.items() if v or isinstance(v, int))
@@ -0,0 +1,179 @@
+# Copyright (c) 2019, salesforce.com, inc.
+# All rights reserved.
+# SPDX-License-Identifier: BSD-3-Clause
+# For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+
+import json, os.path, random, sys, unittest
+
+from metro.markdown_to_xhtml import XhtmlConverter, markdown_to_xhtml
+
+class TreeSanitizerTest(unittest.TestCase):
+    """The tree sanitizer must produce exactly what bleach does."""
+
+    # Documents the tree sanitizer once let through with entities in URLs.
+    entity_vectors = [
+        '[x](javascript&colon;alert(1))',
+        '[x](java&NewLine;script:alert(1))',
+        '[x](java&Tab;script:alert(1))',
+        '[r]: javascript&colon;alert(1)\n\n[y][r]',
+        '[r]: java&Tab;script:alert(1)\n\n[r]',
+        '![x](javascript&colon;alert(1))',
+        '[x](javascript\\&colon;alert(1))',
+        '[x](javascript&#58;alert(1))',
+        '[x](javascript&#x3a;alert(1))',
+        '[x](JAVASCRIPT&COLON;alert(1))',
+        '[x](http://a.com "t&colon;")',
+        '[x](http://a.com?x=1&amp;y=2)',
+        '[x](http://a.com?x=1&y=2)',
+        '<javascript&colon;alert(1)>',
+    ]
+
+    # Other documents that exercise the sanitizer.
+    vectors = [
+        '[x](javascript:alert(1))',
+        '[x](JaVaScRiPt:alert(1))',
+        '[x](vbscript:msgbox)',
+        '[x](data:text/html;base64,PHNjcmlwdD4=)',
+        '![x](javascript:alert(1))',
+        '[x]: javascript:alert(1)\n\n[y][x] and [x]',
+        '[x](http://a.com "title \\" onmouseover=alert(1)")',
+        '![a" onerror="alert(1)](x.png)',
+        '*<img src=x onerror=alert(1)>*',
+        '<script>alert(1)</script>',
+        '```\n<script>alert(1)</script>\n```',
+        '\\<script\\>alert(1)\\</script\\>',
+        '[a [b](http://b)](http://a)',
+        'line  \nbreak\n\n***',
+        '| a | b |\n|---|---|\n| `x` | [l](javascript:1) |',
+    ]
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tree = XhtmlConverter(sanitizer = 'tree')
+        cls.bleach = XhtmlConverter(sanitizer = 'bleach')
+
+    def check(self, md):
+        self.assertEqual(self.tree.render(md), self.bleach.render(md), md)
+
+    def test_entities_in_urls(self):
+        for md in self.entity_vectors:
+            self.check(md)
+            self.assertNotIn('href="javascript&colon;', self.tree.render(md))
+
+    def test_vectors(self):
+        for md in self.vectors:
+            self.check(md)
+
+    def test_sanitizes_plain_documents(self):
+        self.tree.render('# Title\n\nSome *text* with [a link](http://a.com).')
+        self.assertTrue(self.tree._tree_sanitizer.sanitized)
+
+class SplitSectionsTest(unittest.TestCase):
+    """Converting a document a section at a time must give the same HTML as
+converting it whole."""
+
+    # Blocks that documents are made of, including ones that have fooled the
+    # splitter before.
+    blocks = [
+        '# Heading',
+        '## Subheading *emphasis*',
+        'A paragraph with *some* text, `code` and [a link](http://a.com).',
+        'A paragraph with [a reference][ref] and [another one].',
+        '[ref]: http://ref.com "Reference"',
+        '[another one]: http://another.com',
+        '```python\nx = 1\n\n# not a heading\n```',
+        '```rust,ignore\nfn main() {}\n\n# not a heading either',
+        '```',
+        '~~~\n# code\n~~~',
+        '    # indented code',
+        '<a name="anchor" />',
+        'Text with <b>inline\nHTML</b> in it.',
+        '<div>\nRaw block\n\n# inside a div\n</div>',
+        '<div><div>nested</div>\n\n# still inside\n</div>',
+        '<!-- a comment\n\n# in a comment\n-->',
+        'text <!-- comment',
+        '-->',
+        '| a | b |\n|---|---|\n| 1 | 2 |',
+        '+ one\n+ two\n\n    continued',
+        '> quoted\n>\n> # quoted heading',
+        '`inline <tag> & stuff` and `x<y`',
+        'A \\`<b>\\` escaped backtick',
+        'A code span `that <i>\ncarries on` to the next line',
+        '<p>`<b>`</p>',
+        '<![CDATA[\n# z\n]]>',
+        '<![CDATA[\n\n# in CDATA\n]]>',
+        '<?php echo 1;\n\n# in a processing instruction\n?>',
+        '<!DOCTYPE html\n>',
+        '<style>\np { color: red }\n</style>',
+        '<pre>\n\n# in pre\n</pre>',
+        '| a | b |\n|---|---|\n[ref]: http://ref.com "In a table"',
+    ]
+
+    @classmethod
+    def setUpClass(cls):
+        cls.converter = XhtmlConverter(jobs = 1)
+        cls.converter.large_document = 2000
+        cls.converter.section_size = 200
+
+    def check(self, md):
+        sections = self.converter.split_sections(md)
+        self.assertEqual(self.converter.render_sections(md), self.converter.render(md),
+                         '%i sections of %r'%(len(sections), md))
+
+    def test_random_documents(self):
+        rng = random.Random(21)
+        for n in range(200):
+            md = '\n\n'.join(rng.choice(self.blocks) for i in range(rng.randint(20, 80)))
+            self.check(md)
+
+    def test_raw_block_before_heading(self):
+        md = '# A\n\n' + 'filler text '*8 + '\n\n<![CDATA[\n# z\n]]>\n\n\n# B\n\n' + 'more text '*10
+        converter = XhtmlConverter(jobs = 1)
+        converter.large_document = 50
+        converter.section_size = 50
+        self.assertEqual(converter.convert('T', md), XhtmlConverter(jobs = 1).convert('T', md))
+        for block in ['<?php\n# z\n?>', '<!DOCTYPE html\n>', '<pre>\n# z\n</pre>']:
+            self.check(md.replace('<![CDATA[\n# z\n]]>', block)*20)
+
+    def test_readme(self):
+        readme = os.path.join(os.path.dirname(__file__), '..', 'README.md')
+        with open(readme, 'r') as f:
+            md = f.read()
+        self.check('\n\n'.join([md]*4))
+
+class CorpusTest(unittest.TestCase):
+    """The benchmark corpus must convert to what it did when the expected
+output was last updated, with
+
+    python -m tests.test_markdown_to_xhtml --update-corpus
+
+(The repository's own Markdown files are left out, so that editing them
+doesn't fail the test.)"""
+
+    expected_file = os.path.join(os.path.dirname(__file__), 'corpus_expected.json')
+
+    @staticmethod
+    def documents():
+        import importlib.util
+        corpus = os.path.join(os.path.dirname(__file__), '..', 'benchmarks', 'corpus.py')
+        spec = importlib.util.spec_from_file_location('corpus', corpus)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module.documents(repository_files = False)
+
+    def test_corpus(self):
+        with open(self.expected_file, 'r', encoding = 'utf-8') as f:
+            expected = json.load(f)
+        docs = self.documents()
+        self.assertEqual(len(docs), len(expected))
+        for (doc, xhtml) in zip(docs, expected):
+            self.assertEqual(markdown_to_xhtml(*doc), xhtml, 'converting %r'%doc[1])
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['--update-corpus']:
+        expected = [markdown_to_xhtml(*doc) for doc in CorpusTest.documents()]
+        with open(CorpusTest.expected_file, 'w', encoding = 'utf-8') as f:
+            json.dump(expected, f, indent = 0, ensure_ascii = False)
+            f.write('\n')
+    else:
+        unittest.main()